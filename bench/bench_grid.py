@@ -0,0 +1,108 @@
+"""
+Benchmark the GridIndex in spark_job/grid.py against the KD-trees in
+spark_job/kdtree.py.
+
+Usage:  python bench/bench_grid.py [bin_file ...]
+
+With no arguments, synthetic stations reporting over the months of the
+clean monthly data are used.  Otherwise, the points are loaded from each of
+the binary columnar files given, such as
+"data/clean/monthly_ozone_1990-2015.bin" and
+"data/clean/monthly_pm25_1990-2015.bin".  For each file and each time
+scale in TIME_SCALES, the build and query times of every engine are
+reported.
+"""
+
+
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'spark_job'))
+
+import grid
+import kdtree
+import point
+
+
+# Number of synthetic stations, and the chance that one reports in a month.
+SYNTHETIC_STATIONS = 1000
+SYNTHETIC_COVERAGE = 0.3
+
+# Number of queries timed against each engine.
+QUERIES = 5000
+
+# Number of neighbors requested by each query.
+NEIGHBORS = 3
+
+# Time scales of the learning and interpolation jobs to try.
+TIME_SCALES = [0.01, 0.1, 0.17, 1.2]
+
+# Widths of the grid cells to try, in degrees.
+CELL_SIZES = [0.25, 0.5, 1.0, 2.0, 4.0]
+
+
+def synthetic_points():
+    """ Return a list of Points reported by random stations. """
+    result = []
+    for _ in xrange(SYNTHETIC_STATIONS):
+        longitude = round(random.uniform(-124.0, -67.0), 4)
+        latitude = round(random.uniform(25.0, 49.0), 4)
+        for month in xrange(1, 313):
+            if random.random() < SYNTHETIC_COVERAGE:
+                result.append(point.Point(
+                    longitude=longitude, latitude=latitude, month=month,
+                    maximum=random.uniform(0.0, 0.1),
+                    mean=random.uniform(0.0, 0.08)))
+    return result
+
+def bench(name, build, points, queries):
+    """ Print the measurements for the engine built by build(points). """
+    start = time.time()
+    engine = build(points)
+    built = time.time() - start
+    start = time.time()
+    answers = [[q.distance(n.location) for n in engine.query(q, NEIGHBORS)]
+               for q in queries]
+    query = time.time() - start
+    print '    %-20s build %6.2fs  query %7.1fus' % (
+        name, built, 1e6 * query / len(queries))
+    return answers
+
+def bench_points(points):
+    """ Print the measurements for points at each time scale. """
+    queries = random.sample(points, min(QUERIES, len(points)))
+    for time_scale in TIME_SCALES:
+        points = [p.scale_time(time_scale) for p in points]
+        print '  Time scale %g:' % time_scale
+        expected = bench('KDTree', lambda p: kdtree.KDTree(list(p)), points,
+                         queries)
+        answers = bench('FlatKDTree', kdtree.FlatKDTree, points, queries)
+        assert answers == expected
+        for cell_size in CELL_SIZES:
+            # Cells of a year, and cubic cells.
+            for months in (12, None):
+                answers = bench(
+                    'Grid(%g, %s)' % (cell_size, months or 'cube'),
+                    lambda p: grid.GridIndex(p, cell_size, months=months),
+                    points, queries)
+                assert answers == expected
+
+def main():
+    """ Application main. """
+
+    random.seed(0)
+    if len(sys.argv) > 1:
+        for bin_file in sys.argv[1:]:
+            points = point.load_point_binary(bin_file)
+            print '%s: %d points' % (bin_file, len(points))
+            bench_points(points)
+    else:
+        points = synthetic_points()
+        print 'Synthetic: %d points' % len(points)
+        bench_points(points)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""
+Benchmark the FlatKDTree in spark_job/kdtree.py against the KDTree.
+
+Usage:  python bench/bench_kdtree.py [bin_file [time_scale]]
+
+With no arguments, synthetic points spread over the contiguous United
+States are used.  Otherwise, the points are loaded from a binary columnar
+file such as "data/clean/monthly_ozone_1990-2015.bin".  For each tree the
+build time, approximate memory footprint, pickled size, pickle and unpickle
+times and query time are reported.
+
+Then the points of the last INCREMENTAL_MONTHS months are added to a tree
+of the earlier points one month at a time, by KDTree.add(), by rebuilding a
+KDTree and by a KDForest, and the update and query times are reported.
+"""
+
+
+import cPickle
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'spark_job'))
+
+import kdtree
+import point
+
+
+# Number of synthetic points.
+SYNTHETIC_POINTS = 100000
+
+# Number of queries timed against each tree.
+QUERIES = 5000
+
+# Number of neighbors requested by each query.
+NEIGHBORS = 3
+
+# Time scale applied to the points when none is given.
+TIME_SCALE = 0.1
+
+# Number of months added one at a time in the incremental benchmark.
+INCREMENTAL_MONTHS = 24
+
+
+def synthetic_points(count):
+    """ Return a list of random Points in the clean monthly data ranges. """
+    return [point.Point(longitude=round(random.uniform(-124.0, -67.0), 4),
+                        latitude=round(random.uniform(25.0, 49.0), 4),
+                        month=random.randint(1, 312),
+                        maximum=random.uniform(0.0, 0.1),
+                        mean=random.uniform(0.0, 0.08))
+            for _ in xrange(count)]
+
+def deep_size(obj, seen=None):
+    """
+    Return the approximate number of bytes held by obj and every object
+    reachable from it through attributes, containers and tree nodes.
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+    return size
+
+def timed(func, *args):
+    """ Return a pair of the result of func(*args) and its running time. """
+    start = time.time()
+    result = func(*args)
+    return result, time.time() - start
+
+def bench(name, tree_class, points, queries):
+    """ Print the measurements for tree_class and return its answers. """
+    tree, build = timed(tree_class, list(points))
+    pickled, dump = timed(cPickle.dumps, tree, 2)
+    _, load = timed(cPickle.loads, pickled)
+
+    def run_queries():
+        return [[q.distance(n.location) for n in tree.query(q, NEIGHBORS)]
+                for q in queries]
+    answers, query = timed(run_queries)
+
+    print '%-11s build %6.2fs  memory %7.1fMB  pickle %7.1fMB ' \
+          'dump %5.2fs  load %5.2fs  query %6.1fus' % (
+              name, build, deep_size(tree) / 1e6, len(pickled) / 1e6, dump,
+              load, 1e6 * query / len(queries))
+    return answers
+
+def bench_incremental(points, queries):
+    """ Print the measurements for adding the latest months one by one. """
+    last_month = max(p.month for p in points)
+    first_month = last_month - INCREMENTAL_MONTHS + 1
+    initial = [p for p in points if p.month < first_month]
+    months = [[p for p in points if p.month == month]
+              for month in range(int(first_month), int(last_month) + 1)]
+
+    def add_each(tree):
+        for month in months:
+            for p in month:
+                tree.add(p)
+        return tree
+
+    def rebuild(tree):
+        seen = list(initial)
+        for month in months:
+            seen.extend(month)
+            tree = kdtree.KDTree(list(seen))
+        return tree
+
+    def add_monthly(forest):
+        for month in months:
+            forest.add_all(month)
+        return forest
+
+    expected = None
+    for name, build, update in [
+            ('KDTree.add', kdtree.KDTree, add_each),
+            ('rebuild', kdtree.KDTree, rebuild),
+            ('KDForest', kdtree.KDForest, add_monthly)]:
+        tree = build(list(initial))
+        tree, elapsed = timed(update, tree)
+        answers, query = timed(lambda: [[q.distance(n.location)
+                                         for n in tree.query(q, NEIGHBORS)]
+                                        for q in queries])
+        print '%-11s update %6.2fs  query %6.1fus' % (
+            name, elapsed, 1e6 * query / len(queries))
+        if expected is None:
+            expected = answers
+        assert answers == expected
+
+def main():
+    """ Application main. """
+
+    random.seed(0)
+    if len(sys.argv) > 1:
+        points = point.load_point_binary(sys.argv[1])
+    else:
+        points = synthetic_points(SYNTHETIC_POINTS)
+    time_scale = float(sys.argv[2]) if len(sys.argv) > 2 else TIME_SCALE
+    points = [p.scale_time(time_scale) for p in points]
+    queries = random.sample(points, min(QUERIES, len(points)))
+    print 'Points: %d  Queries: %d  Neighbors: %d' % (len(points),
+                                                      len(queries),
+                                                      NEIGHBORS)
+
+    expected = bench('KDTree', kdtree.KDTree, points, queries)
+    for leaf_size in (4, 8, 16, 32):
+        answers = bench('Flat(%d)' % leaf_size,
+                        lambda p: kdtree.FlatKDTree(p, leaf_size), points,
+                        queries)
+        assert answers == expected
+
+    print 'Adding the last %d months:' % INCREMENTAL_MONTHS
+    bench_incremental(points, queries)
+
+if __name__ == "__main__":
+    main()
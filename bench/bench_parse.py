@@ -0,0 +1,127 @@
+"""
+Benchmark the AQS daily CSV parser in epa/clean.py against the original
+"read_data_file.to_dictionary" parsing path.
+
+Usage:  python bench/bench_parse.py [pollutant year]
+
+With no arguments, a synthetic file in the AQS daily layout is parsed.
+Otherwise, the raw data file for the given pollutant and year is used.
+"""
+
+
+import csv
+import os.path
+import random
+import StringIO
+import sys
+import time
+
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import epa.clean
+
+
+# Number of rows in the synthetic data file.
+SYNTHETIC_ROWS = 200000
+
+# Number of timed runs of each parser, of which the best is reported.
+REPEAT = 3
+
+HEADERS = ['longitude',
+           'latitude',
+           'month',
+           'day',
+           'mean',
+           'max']
+
+
+def legacy_to_dictionary(record):
+    """ The original per-row parser of epa.clean.read_data_file(). """
+    date_obj = date(*[int(val) for val in record[11].split('-')])
+    month = 12 * (date_obj.year - 1990) + date_obj.month
+    record = dict(zip(HEADERS,
+                      [record[6],
+                       record[5],
+                       month,
+                       date_obj.day,
+                       float(record[16]),
+                       float(record[17])]))
+    return record
+
+def legacy_parse(lines):
+    """ Parse lines the way epa.clean.read_data_file() originally did. """
+    csv_reader = csv.reader(lines)
+    next(csv_reader)
+    record_list = list(csv_reader)
+    return [legacy_to_dictionary(record) for record in record_list]
+
+def fast_parse(lines):
+    """ Parse lines with the column-projection parser. """
+    csv_reader = csv.reader(lines)
+    next(csv_reader)
+    return [epa.clean._parse_daily_record(record) for record in csv_reader]
+
+def synthetic_lines(rows):
+    """ Return a list of CSV lines in the AQS daily layout. """
+    out = StringIO.StringIO()
+    writer = csv.writer(out, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(['State Code', 'County Code', 'Site Num',
+                     'Parameter Code', 'POC', 'Latitude', 'Longitude',
+                     'Datum', 'Parameter Name', 'Sample Duration',
+                     'Pollutant Standard', 'Date Local', 'Units of Measure',
+                     'Event Type', 'Observation Count',
+                     'Observation Percent', 'Arithmetic Mean',
+                     '1st Max Value', '1st Max Hour', 'AQI', 'Method Code',
+                     'Method Name', 'Local Site Name', 'Address',
+                     'State Name', 'County Name', 'City Name',
+                     'CBSA Name', 'Date of Last Change'])
+    for _ in xrange(rows):
+        day = date(2010, random.randint(1, 12), random.randint(1, 28))
+        writer.writerow(['01', '073', '%04d' % random.randint(1, 50),
+                         '44201', 1,
+                         round(random.uniform(25.0, 49.0), 6),
+                         round(random.uniform(-124.0, -67.0), 6),
+                         'WGS84', 'Ozone', '8-HR RUN AVG BEGIN HOUR',
+                         'Ozone 8-hour 2008', day.isoformat(),
+                         'Parts per million', 'None', 17, 100.0,
+                         round(random.uniform(0.0, 0.08), 6),
+                         round(random.uniform(0.0, 0.1), 3), 10, 40, '087',
+                         'INSTRUMENTAL - ULTRA VIOLET', 'Site', 'Address',
+                         'Alabama', 'Jefferson', 'Birmingham',
+                         'Birmingham-Hoover, AL', '2015-06-01'])
+    return out.getvalue().splitlines(True)
+
+def best_time(func, lines):
+    """ Return the best wall clock time of REPEAT runs of func(lines). """
+    best = None
+    for _ in range(REPEAT):
+        start = time.time()
+        func(lines)
+        elapsed = time.time() - start
+        best = elapsed if best is None or elapsed < best else best
+    return best
+
+def main():
+    """ Application main. """
+
+    if len(sys.argv) == 3:
+        data_file = epa.clean._load_data_file(sys.argv[1], int(sys.argv[2]))
+        lines = list(data_file)
+        data_file.close()
+    else:
+        random.seed(0)
+        lines = synthetic_lines(SYNTHETIC_ROWS)
+
+    assert legacy_parse(lines) == fast_parse(lines)
+
+    legacy = best_time(legacy_parse, lines)
+    fast = best_time(fast_parse, lines)
+    print 'Rows:    %d' % (len(lines) - 1)
+    print 'Legacy:  %.3fs' % legacy
+    print 'Fast:    %.3fs' % fast
+    print 'Speedup: %.2fx' % (legacy / fast)
+
+if __name__ == "__main__":
+    main()
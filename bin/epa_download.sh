@@ -6,38 +6,24 @@
 #
 # http://aqsdr1.epa.gov/aqsweb/aqstmp/airdata/download_files.html
 #
+# The downloads themselves are done by "python -m epa.download", which
+# fetches several archives at once, resumes partial downloads and skips
+# archives that are already present, so this script can simply be run
+# again after a failure. Any further options are passed along to it (see
+# "python -m epa.download --help").
+#
+# Pass "--no-extract" to keep the .ZIP archives as they are rather than
+# unpacking them. The cleaning process reads the CSV files straight out of
+# the archives, so this halves the disk space and I/O needed.
+#
 
 
-# URI at which the data are located.
-DATA_URI="http://aqsdr1.epa.gov/aqsweb/aqstmp/airdata/"
-
-
-# Build the filename of the required .ZIP file of no2 measurments.
-# Usage: no2_file year
-no2_file() {
-    local year
-
-    year="$1"
-    echo "daily_42602_$year.zip"
-}
-
-# Build the filename of the required .ZIP file of ozone measurments.
-# Usage: ozone_file year
-ozone_file() {
-    local year
-
-    year="$1"
-    echo "daily_44201_$year.zip"
-}
-
-# Build the filename of the required .ZIP file of pm25 measurments.
-# Usage: pm25_file year
-pm25_file() {
-    local year
-
-    year="$1"
-    echo "daily_88101_$year.zip"
-}
+# Whether to unpack the downloaded .ZIP archives.
+EXTRACT=1
+if [ "$1" = "--no-extract" ]; then
+    EXTRACT=0
+    shift
+fi
 
 
 # Switch to the project root directory.
@@ -49,26 +35,18 @@ if [ "$(basename $PWD)" != "epa-data" ]; then
     exit 1
 fi
 
-# Prepare "data/" directory for download of EPA data.
-if [ -d data/ ]; then
-    rm -rf data/*
-else
-    mkdir data/
-fi
-cd data/
-
 # Download all required .ZIP files.
-for year in {1990..2015}; do
-    wget --directory-prefix='no2_raw_data/'   "$DATA_URI$(no2_file $year)"
-    wget --directory-prefix='ozone_raw_data/' "$DATA_URI$(ozone_file $year)"
-    wget --directory-prefix='pm25_raw_data/'  "$DATA_URI$(pm25_file $year)"
-done
+python -m epa.download "$@" || exit 1
+cd data/
 
-# Unzip all .ZIP archives.
+# Unless told otherwise, unzip all .ZIP archives.
+if [ "$EXTRACT" -eq 0 ]; then
+    exit 0
+fi
 # TODO(jf): Sort out the problems using `unzip` with wildcards.
-pushd no2_raw_data/; unzip \*.zip; popd
-pushd ozone_raw_data/; unzip \*.zip; popd
-pushd pm25_raw_data/; unzip \*.zip; popd
+pushd no2_raw_data/; unzip -o \*.zip; popd
+pushd ozone_raw_data/; unzip -o \*.zip; popd
+pushd pm25_raw_data/; unzip -o \*.zip; popd
 
 # Remove .ZIP archives, leaving only the required .CSV files.
 rm no2_raw_data/*.zip ozone_raw_data/*.zip pm25_raw_data/*.zip
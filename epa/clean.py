@@ -3,11 +3,26 @@ Clean and amalgamate EPA data for analysis.
 """
 
 
+import argparse
+import array
+import contextlib
 import csv
+import functools
+import hashlib
+import heapq
+import io
 import itertools
+import json
+import multiprocessing
+import operator
 import os.path
+import shutil
+import struct
+import sys
+import tempfile
+import zipfile
 
-from datetime import date
+from epa.extsort import external_sorted
 
 
 # Project directory root.
@@ -19,75 +34,153 @@ NO2_DATA_ROOT = os.path.join(DATA_ROOT, 'no2_raw_data/')
 OZONE_DATA_ROOT = os.path.join(DATA_ROOT, 'ozone_raw_data/')
 PM25_DATA_ROOT = os.path.join(DATA_ROOT, 'pm25_raw_data/')
 
+# Clean data directory roots and the manifest of processed input files.
+CLEAN_ROOT = os.path.join(DATA_ROOT, 'clean/')
+SHARD_ROOT = os.path.join(CLEAN_ROOT, 'shards/')
+MANIFEST_PATH = os.path.join(CLEAN_ROOT, 'manifest.json')
 
-def _load_data_file(pollutant, year):
+# Magic string and field order of the binary columnar output files.
+COLUMNAR_MAGIC = 'EPACOL1\0'
+COLUMNAR_FIELDS = ['longitude', 'latitude', 'month', 'max', 'mean']
+
+
+# Pollutants covered by the raw data files, and the AQS parameter codes
+# used in their names.
+POLLUTANTS = ['no2', 'ozone', 'pm25']
+PARAMETER_CODES = {'no2': '42602',
+                   'ozone': '44201',
+                   'pm25': '88101'}
+
+# Field order of the joined output file, which holds the max and mean of
+# every pollutant for each site and month.
+JOINED_FIELDS = ['longitude', 'latitude', 'month'] +\
+                [pollutant + '_' + stat for pollutant in POLLUTANTS
+                 for stat in ('max', 'mean')]
+
+
+def _raw_data_path(pollutant, year, extension):
     """
-    Return a data file handle for the given pollutant ('ozone' or 'pm25')
-    and year.
+    Return the path to the raw data file with the given extension ('.csv'
+    or '.zip') for the given pollutant ('no2', 'ozone' or 'pm25') and year.
     """
 
-    # Select the correct file or raise an IOError.
+    # Select the correct data directory or raise an IOError.
     if pollutant == 'ozone' and year in range(1990, 2016):
-        path_to_file = os.path.join(OZONE_DATA_ROOT,
-                                    "daily_44201_" + str(year) +".csv")
-        result = open(path_to_file, 'r')
+        data_root = OZONE_DATA_ROOT
     elif pollutant == 'pm25' and year in range(1990, 2016):
-        path_to_file = os.path.join(PM25_DATA_ROOT,
-                                    "daily_88101_" + str(year) +".csv")
-        result = open(path_to_file, 'r')
+        data_root = PM25_DATA_ROOT
     elif pollutant == 'no2' and year in range(1990, 2016):
-        path_to_file = os.path.join(NO2_DATA_ROOT,
-                                    "daily_42602_" + str(year) +".csv")
-        result = open(path_to_file, 'r')
+        data_root = NO2_DATA_ROOT
     else:
         msg = "Data file with type '" + pollutant + "' and year '" +\
               str(year) + "' not found."
         raise IOError(msg)
 
-    # Return a handle to the selected file.
-    return result
+    return os.path.join(data_root, 'daily_' + PARAMETER_CODES[pollutant] +
+                        '_' + str(year) + extension)
 
-def read_data_file(pollutant, year):
+def archive_path(pollutant, year):
     """
-    Read records from a EPA data CSV file into a list of dictionaries.
+    Return the path at which the downloaded ZIP archive for the given
+    pollutant and year is stored.
+    """
+    return _raw_data_path(pollutant, year, '.zip')
 
-    This method also performs necessary type conversions for eeach field.
-    Also, raises IOError if bad specs are passed due to calling
-    _load_data_file().
-    """
-    headers = ['longitude',
-               'latitude',
-               'month',
-               'day',
-               'mean',
-               'max']
-
-    # NOTE:  Use an excpetion here if errors arrise in parsing missing values.
-    def to_dictionary(record):
-        """ Return a dictionary all critical data fields in a CSV record. """
-        # Convert to numerical month value first.
-        date_obj = date(*[int(val) for val in record[11].split('-')])
-        # NOTE: We start counting at 1!!!
-        month = 12 * (date_obj.year - 1990) + date_obj.month
-        # Generate dictionary of our record.
-        record = dict(zip(headers,
-                          [record[6],
-                           record[5],
-                           month,
-                           date_obj.day,
-                           float(record[16]),
-                           float(record[17])]))
-        return record
+def _data_file_path(pollutant, year):
+    """
+    Return the path to the raw data file for the given pollutant ('no2',
+    'ozone' or 'pm25') and year.
+
+    This is the extracted "daily_<code>_<year>.csv" file when it exists, and
+    the downloaded "daily_<code>_<year>.zip" archive otherwise.
+    """
+    path_to_file = _raw_data_path(pollutant, year, '.csv')
+    path_to_archive = archive_path(pollutant, year)
+    if not os.path.exists(path_to_file) and os.path.exists(path_to_archive):
+        return path_to_archive
+    return path_to_file
+
+def _load_data_file(pollutant, year):
+    """
+    Return a data file handle for the given pollutant ('ozone' or 'pm25')
+    and year.
+
+    If only the downloaded ZIP archive is present, the handle streams the
+    CSV member straight out of the archive without extracting it.
+    """
+    path_to_file = _data_file_path(pollutant, year)
+    if not path_to_file.endswith('.zip'):
+        return open(path_to_file, 'r')
+
+    try:
+        archive = zipfile.ZipFile(path_to_file, 'r')
+    except zipfile.BadZipfile as err:
+        raise IOError("Bad ZIP archive '" + path_to_file + "': " + str(err))
+    with contextlib.closing(archive):
+        member = os.path.basename(path_to_file)[:-len('.zip')] + '.csv'
+        if member not in archive.namelist():
+            msg = "ZIP archive '" + path_to_file + "' has no member '" +\
+                  member + "'."
+            raise IOError(msg)
+        # The member handle owns its own file object, so it outlives the
+        # archive.  Buffering it makes line iteration as fast as for a file.
+        return io.BufferedReader(archive.open(member, 'r'))
+
+# Columns of an AQS daily CSV record used by the cleaning process, in the
+# order "(longitude, latitude, date, mean, max)".
+_project_daily_record = operator.itemgetter(6, 5, 11, 16, 17)
+
+# Subtracted from "12 * year + month" to count months from January, 1990.
+# NOTE: We start counting at 1!!!
+_MONTH_OFFSET = 12 * 1990
+
+def _parse_daily_record(record):
+    """
+    Return a dictionary of all critical data fields in a CSV record.
+
+    Only the five columns we use are extracted from the record, and the
+    month and day are sliced straight out of the "YYYY-MM-DD" date string
+    rather than going through a datetime.date object.
+    """
+    longitude, latitude, date_local, mean, maximum =\
+        _project_daily_record(record)
+    return {'longitude': longitude,
+            'latitude': latitude,
+            'month': 12 * int(date_local[:4]) + int(date_local[5:7]) -\
+                     _MONTH_OFFSET,
+            'day': int(date_local[8:10]),
+            'mean': float(mean),
+            'max': float(maximum)}
+
+def iter_data_file(pollutant, year):
+    """
+    Yield records from a EPA data CSV file as dictionaries, one at a time.
 
+    This is the streaming counterpart to read_data_file().  Rows are parsed
+    lazily from the handle returned by _load_data_file(), so a raw file is
+    never held in memory, and the handle is closed once the generator is
+    exhausted or discarded.  Note that the IOError raised for bad specs
+    surfaces on the first call to next().
+    """
     data_file = _load_data_file(pollutant, year)
-    csv_reader = csv.reader(data_file)
-    next(csv_reader)
+    try:
+        csv_reader = csv.reader(data_file)
+        next(csv_reader)
+        for record in csv_reader:
+            yield _parse_daily_record(record)
+    finally:
+        data_file.close()
 
-    record_list = list(csv_reader)
-    record_list = [to_dictionary(record) for record in record_list]
+def read_data_file(pollutant, year):
+    """
+    Read records from a EPA data CSV file into a list of dictionaries.
 
-    data_file.close()
-    return record_list
+    This method also performs necessary type conversions for eeach field.
+    Also, raises IOError if bad specs are passed due to calling
+    _load_data_file().  Prefer iter_data_file() when the records are only
+    needed for aggregation.
+    """
+    return list(iter_data_file(pollutant, year))
 
 def _agg_day_key_func(dict_record):
     """
@@ -99,107 +192,504 @@ def _agg_day_key_func(dict_record):
             dict_record['month'],
             dict_record['day'])
 
-def _agg_day_iter(dict_record_list):
-    """ Return an interator over keys and groups in dict_record_list. """
+def _agg_day_iter(dict_record_list, buffer_size=None):
+    """
+    Return an interator over keys and groups in dict_record_list.
+
+    If buffer_size is given, the records are sorted by external_sorted(),
+    holding at most buffer_size of them in memory at once.
+    """
     # Note that itertools.groupby() recommended sorting first.
-    dict_record_list = sorted(dict_record_list, key=_agg_day_key_func)
+    if buffer_size is None:
+        dict_record_list = sorted(dict_record_list, key=_agg_day_key_func)
+    else:
+        dict_record_list = external_sorted(dict_record_list,
+                                           _agg_day_key_func, buffer_size)
     return itertools.groupby(dict_record_list, _agg_day_key_func)
 
+def _agg_running_totals(dict_records, key_func):
+    """
+    Fold dict_records into a dictionary mapping each key_func() key to a
+    running "[sum of means, count, max of maximums]" list.
+
+    The records may come from any iterable and are consumed exactly once,
+    so memory is bounded by the number of distinct keys rather than the
+    number of records.  Means are summed in input order, which matches the
+    order in which the old sort+reduce approach added them.
+    """
+    totals = {}
+    for rec in dict_records:
+        key = key_func(rec)
+        total = totals.get(key)
+        if total is None:
+            totals[key] = [rec['mean'], 1, rec['max']]
+        else:
+            total[0] += rec['mean']
+            total[1] += 1
+            if rec['max'] > total[2]:
+                total[2] = rec['max']
+    return totals
+
 def agg_day_duplicates(dict_record_list):
     """
     Aggregate duplicate records for days in a given list of dictionary records
     by averaging their means and taking the max of their maximums.  This works
     for all pollutant types.
-    """
-
-    # Get an iterator over (key, group) pairs and extract the list of groups.
-    iterator = _agg_day_iter(dict_record_list)
-    groups = [list(group) for _, group in iterator]
-
-    def reducer(rec1, rec2):
-        """ Amalgamate two records from the same group. """
-        maximum = rec1['max'] if rec1['max'] > rec2['max'] else rec2['max']
-        return {'longitude': rec1['longitude'],
-                'latitude': rec1['latitude'],
-                'month': rec1['month'],
-                'mean': rec1['mean'] + rec2['mean'],
-                'max': maximum}
 
+    Any iterable of records is accepted (e.g. the generator returned by
+    iter_data_file()), and the input records are left unmodified.  The result
+    is a list sorted by "(longitude, latitude, month, day)".
+    """
+    totals = _agg_running_totals(dict_record_list, _agg_day_key_func)
     result = []
-    for group in groups:
-        for elt in group:
-            del elt['day']
-        reduction = reduce(reducer, group)
-        reduction['mean'] /= len(group)
-        result.append(reduction)
+    for key in sorted(totals):
+        total = totals[key]
+        result.append({'longitude': key[0],
+                       'latitude': key[1],
+                       'month': key[2],
+                       'mean': total[0] / total[1],
+                       'max': total[2]})
     return result
 
 def agg_by_month(clean_dict_records):
     """
     Aggregate records by month, where the records have been cleaned by
     the agg_day_duplicates() procedure.
+
+    Like agg_day_duplicates(), any iterable of records is accepted and the
+    result is a list sorted by "(longitude, latitude, month)".
     """
-    # Note that this function was built quickly with but one simple functional
-    # test... more testing may be required if errors arise.
 
     def key_func(clean_dict_record):
-        """
-        Return a key to be used in sorting the records for
-        aggregation.
-        """
+        """ Return a key to be used in aggregating the records. """
         return (clean_dict_record['longitude'],
                 clean_dict_record['latitude'],
                 clean_dict_record['month'])
 
-    # Sort the records and get an iterator over the (key, group) pairs,
-    # extracting the groups from the iterator.
-    clean_dict_records = sorted(clean_dict_records, key=key_func)
-    iterator = itertools.groupby(clean_dict_records, key_func)
-    groups = [list(group) for _, group in iterator]
-
-    def reducer(rec1, rec2):
-        """ Amalgamate two cleaned records according to Dr. Zhou's rule. """
-        maximum = rec1['max'] if rec1['max'] > rec2['max'] else rec2['max']
-        return {'longitude': rec1['longitude'],
-                'latitude': rec1['latitude'],
-                'month': rec1['month'],
-                'mean': rec1['mean'] + rec2['mean'],
-                'max': maximum}
-    # Extract the groups and process them to build the result.
+    # Amalgamate records according to Dr. Zhou's rule: average the means
+    # and take the max of the maximums.
+    totals = _agg_running_totals(clean_dict_records, key_func)
+    result = []
+    for key in sorted(totals):
+        total = totals[key]
+        result.append({'longitude': key[0],
+                       'latitude': key[1],
+                       'month': key[2],
+                       'mean': total[0] / total[1],
+                       'max': total[2]})
+    return result
+
+def agg_site_months(dict_records):
+    """
+    Aggregate raw dictionary records straight to one record per site and
+    month, taking the mean of the daily means and the max of the daily
+    maximums.
+
+    This fuses agg_day_duplicates() and agg_by_month() into a single pass
+    over the records, keeping running sums, counts and maximums for each
+    "(longitude, latitude, month)" and day.  The result is identical to
+    "agg_by_month(agg_day_duplicates(dict_records))".
+    """
+    months = {}
+    for rec in dict_records:
+        month_key = (rec['longitude'], rec['latitude'], rec['month'])
+        days = months.get(month_key)
+        if days is None:
+            days = months[month_key] = {}
+        total = days.get(rec['day'])
+        if total is None:
+            days[rec['day']] = [rec['mean'], 1, rec['max']]
+        else:
+            total[0] += rec['mean']
+            total[1] += 1
+            if rec['max'] > total[2]:
+                total[2] = rec['max']
+
+    # Reduce the days of each month in day order, just as agg_by_month()
+    # does with the sorted output of agg_day_duplicates().
     result = []
-    for group in groups:
-        reduction = reduce(reducer, group)
-        reduction['mean'] /= len(group)
-        result.append(reduction)
+    for month_key in sorted(months):
+        days = months[month_key]
+        mean_sum = 0.0
+        maximum = None
+        for day in sorted(days):
+            total = days[day]
+            mean_sum += total[0] / total[1]
+            if maximum is None or total[2] > maximum:
+                maximum = total[2]
+        result.append({'longitude': month_key[0],
+                       'latitude': month_key[1],
+                       'month': month_key[2],
+                       'mean': mean_sum / len(days),
+                       'max': maximum})
     return result
 
-def write_clean_records(records, pollutant):
+@contextlib.contextmanager
+def _atomic_open(path, mode='w'):
     """
-    Given a list of processed records with the type and year, write them
-    to the appropriate output file.
+    Open a temporary file for writing that replaces path once the "with"
+    block exits cleanly.  If an error occurs, path is left untouched.
     """
-    path = os.path.join(DATA_ROOT,
-                        'clean/monthly_' + pollutant + '_1990-2015.csv')
-    with open(path, 'a') as outfile:
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                        prefix='.tmp-')
+    try:
+        with os.fdopen(handle, mode) as outfile:
+            yield outfile
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def _file_checksum(path):
+    """ Return the SHA-1 hex digest of the file at path. """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _shard_path(pollutant, year):
+    """ Return the path to the clean shard for a pollutant and year. """
+    return os.path.join(SHARD_ROOT,
+                        'monthly_' + pollutant + '_' + str(year) + '.csv')
+
+def _output_path(pollutant, extension='.csv'):
+    """ Return the path to the clean output file for a pollutant. """
+    return os.path.join(CLEAN_ROOT,
+                        'monthly_' + pollutant + '_1990-2015' + extension)
+
+def load_manifest():
+    """
+    Return the manifest of processed input files, or an empty manifest if
+    none has been written yet.
+
+    The manifest maps "<pollutant>/<year>" to a dictionary recording the
+    raw input file's "source" path, "size", "mtime" and "sha1" checksum, as
+    well as the path to the "output" shard it produced.  Paths are relative
+    to DATA_ROOT.
+    """
+    if not os.path.exists(MANIFEST_PATH):
+        return {}
+    with open(MANIFEST_PATH, 'r') as infile:
+        return json.load(infile)
+
+def save_manifest(manifest):
+    """ Atomically write the manifest of processed input files. """
+    with _atomic_open(MANIFEST_PATH) as outfile:
+        json.dump(manifest, outfile, indent=2, sort_keys=True)
+
+def _manifest_key(pollutant, year):
+    """ Return the manifest key for a pollutant and year. """
+    return pollutant + '/' + str(year)
+
+def _is_current(entry, pollutant, year):
+    """
+    Return True if a manifest entry is up to date with the raw input file
+    for the given pollutant and year, and its output shard exists.
+
+    The size and mtime are checked first.  If only the mtime has changed
+    (e.g. the file was downloaded again), the checksum decides, and the
+    entry's mtime is refreshed when the contents are unchanged.  A raw file
+    that has been deleted since it was cleaned, e.g. to save disk space,
+    leaves its shard current.
+    """
+    if entry is None or\
+            not os.path.exists(os.path.join(DATA_ROOT, entry['output'])):
+        return False
+    source = _data_file_path(pollutant, year)
+    if not os.path.exists(source):
+        return True
+    if entry['source'] != os.path.relpath(source, DATA_ROOT):
+        return False
+    stat = os.stat(source)
+    if stat.st_size != entry['size']:
+        return False
+    if stat.st_mtime != entry['mtime']:
+        if _file_checksum(source) != entry['sha1']:
+            return False
+        entry['mtime'] = stat.st_mtime
+    return True
+
+def agg_site_months_external(dict_records, buffer_size):
+    """
+    Yield the records of agg_site_months(dict_records), in the same order,
+    while holding at most buffer_size raw records in memory.
+
+    The raw records are sorted by "(longitude, latitude, month, day)" with
+    an external sort that spills to temporary files, so each day's records
+    and each month's days arrive together and are reduced as they stream
+    past.  Use this for inputs that are too large for agg_site_months().
+    """
+    day_iter = _agg_day_iter(dict_records, buffer_size)
+
+    def reduce_day(group):
+        """ Return "(month_key, mean, max)" for a group of day records. """
+        group = iter(group)
+        first = next(group)
+        mean_sum, count, maximum = first['mean'], 1, first['max']
+        for rec in group:
+            mean_sum += rec['mean']
+            count += 1
+            if rec['max'] > maximum:
+                maximum = rec['max']
+        return (first['longitude'], first['latitude'], first['month']),\
+               mean_sum / count, maximum
+
+    days = (reduce_day(group) for _, group in day_iter)
+    for month_key, group in itertools.groupby(days, operator.itemgetter(0)):
+        mean_sum = 0.0
+        maximum = None
+        count = 0
+        for _, mean, day_max in group:
+            mean_sum += mean
+            count += 1
+            if maximum is None or day_max > maximum:
+                maximum = day_max
+        yield {'longitude': month_key[0],
+               'latitude': month_key[1],
+               'month': month_key[2],
+               'mean': mean_sum / count,
+               'max': maximum}
+
+def write_clean_records(records, pollutant, year):
+    """
+    Given a list of processed records with the type and year, atomically
+    write them to the appropriate shard file and return its path.
+    """
+    path = _shard_path(pollutant, year)
+    with _atomic_open(path) as outfile:
         fieldnames = ['longitude', 'latitude', 'month', 'max', 'mean']
         writer = csv.DictWriter(outfile, fieldnames)
         # writer.writeheader()
         for row in records:
             writer.writerow(row)
+    return path
+
+def write_columnar_records(rows, path):
+    """
+    Atomically write rows of clean CSV fields, in the order of
+    COLUMNAR_FIELDS, to path in the binary columnar format.
+
+    The file holds the COLUMNAR_MAGIC string and the row count as a
+    little-endian unsigned 64-bit integer, followed by one little-endian
+    float64 array per field.  Every column is 8-byte aligned, so readers
+    such as spark_job/point.load_point_columns() can memory-map the file and
+    use it without any parsing.
+    """
+    columns = [array.array('d') for _ in COLUMNAR_FIELDS]
+    for row in rows:
+        for column, value in zip(columns, row):
+            column.append(float(value))
+    if sys.byteorder != 'little':
+        for column in columns:
+            column.byteswap()
+
+    with _atomic_open(path, 'wb') as outfile:
+        outfile.write(COLUMNAR_MAGIC)
+        outfile.write(struct.pack('<Q', len(columns[0])))
+        for column in columns:
+            column.tofile(outfile)
+
+def merge_shards(pollutant, years):
+    """
+    Atomically concatenate the shards for a pollutant, in the order of
+    years, into its clean output file, and write the same records to its
+    binary columnar output file.
+    """
+    with _atomic_open(_output_path(pollutant)) as outfile:
+        for year in years:
+            with open(_shard_path(pollutant, year), 'r') as shard:
+                shutil.copyfileobj(shard, outfile)
+    with open(_output_path(pollutant), 'r') as infile:
+        write_columnar_records(csv.reader(infile),
+                               _output_path(pollutant, '.bin'))
+
+def _read_shard(pollutant, year):
+    """
+    Yield "(key, max, mean)" triples from the shard for a pollutant and
+    year in the order they were written, where the key is "(longitude,
+    latitude, month)".  Nothing is yielded if the shard does not exist.
+    """
+    path = _shard_path(pollutant, year)
+    if not os.path.exists(path):
+        return
+    with open(path, 'r') as shard:
+        for longitude, latitude, month, maximum, mean in csv.reader(shard):
+            yield ((longitude, latitude, int(month)), maximum, mean)
+
+def join_site_months(streams):
+    """
+    Merge streams of "(key, max, mean)" triples, each sorted by key as the
+    output of agg_site_months() is, into one wide row per key.
 
-def main():
+    Each row is a list holding the longitude, latitude and month followed
+    by the max and mean from every stream in turn, with '' standing in for
+    a stream that has no record for that site and month.  The streams are
+    consumed in a single merge pass.
+    """
+
+    def decorate(index, stream):
+        """ Tag the triples of a stream with the index of the stream. """
+        for key, maximum, mean in stream:
+            yield (key, index, maximum, mean)
+
+    merged = heapq.merge(*[decorate(index, stream)
+                           for index, stream in enumerate(streams)])
+    for key, group in itertools.groupby(merged, operator.itemgetter(0)):
+        row = list(key) + [''] * (2 * len(streams))
+        for _, index, maximum, mean in group:
+            row[3 + 2 * index] = maximum
+            row[4 + 2 * index] = mean
+        yield row
+
+def merge_joined_shards(years):
+    """
+    Atomically write the joined output file from the shards of every
+    pollutant, one year at a time in the order of years.
+    """
+    with _atomic_open(_output_path('joined')) as outfile:
+        writer = csv.writer(outfile)
+        for year in years:
+            streams = [_read_shard(pollutant, year)
+                       for pollutant in POLLUTANTS]
+            writer.writerows(join_site_months(streams))
+
+def clean_data_file(spec, buffer_size=None):
+    """
+    Clean the raw data file for a "(pollutant, year)" spec, write its shard
+    and return the spec paired with its new manifest entry.
+
+    If buffer_size is given, the records are aggregated by
+    agg_site_months_external() with at most buffer_size raw records held in
+    memory.  This is a module level function so that it can be shipped to
+    the worker processes of a multiprocessing.Pool.
+    """
+    pollutant, year = spec
+    source = _data_file_path(pollutant, year)
+
+    # Take the signature before reading, so that a file modified while it
+    # is being cleaned is picked up by the next run.
+    stat = os.stat(source)
+    entry = {'source': os.path.relpath(source, DATA_ROOT),
+             'size': stat.st_size,
+             'mtime': stat.st_mtime,
+             'sha1': _file_checksum(source)}
+    if buffer_size is None:
+        records = agg_site_months(iter_data_file(pollutant, year))
+    else:
+        records = agg_site_months_external(iter_data_file(pollutant, year),
+                                           buffer_size)
+    output = write_clean_records(records, pollutant, year)
+    entry['output'] = os.path.relpath(output, DATA_ROOT)
+    return (spec, entry)
+
+def is_stale(manifest, spec):
+    """
+    Return True if the raw data file for a "(pollutant, year)" spec must be
+    cleaned, because it is new or has changed since the manifest entry for
+    it was recorded.
+    """
+    return not _is_current(manifest.get(_manifest_key(*spec)), *spec)
+
+def record_clean_data_file(manifest, spec, entry):
+    """
+    Record the manifest entry returned by clean_data_file() for a spec and
+    save the manifest.
+    """
+    manifest[_manifest_key(*spec)] = entry
+    save_manifest(manifest)
+
+def prepare_clean_roots():
+    """ Create the clean data and shard directories if they are missing. """
+    for directory in (CLEAN_ROOT, SHARD_ROOT):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+def merge_outputs(files_specs, joined=False):
+    """
+    Rebuild the clean output file of each pollutant in files_specs from its
+    shards, in spec order, along with the joined output file if joined is
+    True.
+    """
+    pollutants = []
+    for pollutant, _ in files_specs:
+        if pollutant not in pollutants:
+            pollutants.append(pollutant)
+    for pollutant in pollutants:
+        merge_shards(pollutant, [year for pol, year in files_specs
+                                 if pol == pollutant])
+    if joined:
+        years = []
+        for _, year in files_specs:
+            if year not in years:
+                years.append(year)
+        merge_joined_shards(years)
+
+def update_clean_data(files_specs, workers=1, force=False, joined=False,
+                      buffer_size=None):
+    """
+    Clean the raw data files in files_specs that have changed since the
+    last run, then rebuild the clean output files from their shards.
+
+    The manifest is saved after each shard is written, so an interrupted
+    run resumes where it left off.  Pass force=True to re-clean every file,
+    and joined=True to also write the joined output file, whose fields are
+    given by JOINED_FIELDS.  See clean_data_file() for buffer_size.  Return
+    the list of specs that were cleaned.
+    """
+    prepare_clean_roots()
+    manifest = load_manifest()
+    stale_specs = [spec for spec in files_specs
+                   if force or is_stale(manifest, spec)]
+
+    # Clean each file, in a pool of worker processes if requested.  Note
+    # that Pool.imap() yields results in the order of stale_specs.
+    clean_func = functools.partial(clean_data_file, buffer_size=buffer_size)
+    pool = None
+    if workers > 1 and len(stale_specs) > 1:
+        pool = multiprocessing.Pool(workers)
+        results = pool.imap(clean_func, stale_specs)
+    else:
+        results = itertools.imap(clean_func, stale_specs)
+
+    try:
+        for i, (spec, entry) in enumerate(results):
+            record_clean_data_file(manifest, spec, entry)
+            print 'Processed ' + str(i + 1) + '/' + str(len(stale_specs)) +\
+                  '...'
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    save_manifest(manifest)
+
+    merge_outputs(files_specs, joined)
+    return stale_specs
+
+def main(argv=None):
     """ Application main. """
 
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes used to clean the '
+                             'data files (default: 1)')
+    parser.add_argument('--force', action='store_true',
+                        help='clean every data file, even those that are '
+                             'unchanged since the last run')
+    parser.add_argument('--joined', action='store_true',
+                        help='also write the joined site-month table of all '
+                             'pollutants to ' + _output_path('joined'))
+    parser.add_argument('--memory-budget', type=int, metavar='RECORDS',
+                        help='aggregate each data file with an external sort '
+                             'that holds at most RECORDS raw records in '
+                             'memory, spilling the rest to temporary files')
+    args = parser.parse_args(argv)
+
     # Enumerate all (pollutant_type, year) pairs.
-    files_specs = itertools.product(['no2', 'ozone', 'pm25'],
-                                    range(1990, 2016))
-
-    # Clean and write data from each file.
-    for i, spec in enumerate(files_specs):
-        dirty = read_data_file(spec[0], spec[1])
-        clean = agg_by_month(agg_day_duplicates(dirty))
-        write_clean_records(clean, spec[0])
-        print 'Processed ' + str(i + 1) + '/78...'
+    files_specs = list(itertools.product(POLLUTANTS, range(1990, 2016)))
+    update_clean_data(files_specs, args.workers, args.force, args.joined,
+                      args.memory_budget)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,236 @@
+"""
+Download the raw EPA data archives.
+
+The archives are fetched concurrently, partial downloads are resumed with
+HTTP range requests, and archives that are already present are skipped.
+The site hosting the data can be found at the following URI...
+
+http://aqsdr1.epa.gov/aqsweb/aqstmp/airdata/download_files.html
+"""
+
+
+import argparse
+import contextlib
+import httplib
+import itertools
+import os.path
+import shutil
+import socket
+import sys
+import urllib2
+import zipfile
+
+from multiprocessing.pool import ThreadPool
+
+import epa.clean
+
+
+# URI at which the data are located.
+BASE_URL = 'http://aqsdr1.epa.gov/aqsweb/aqstmp/airdata/'
+
+# Seconds to wait on a stalled connection before giving up on it.
+TIMEOUT = 60
+
+# Number of times a failed download is resumed before giving up.
+RETRIES = 3
+
+# Suffix of the file an archive is downloaded to before it is verified.
+PART_SUFFIX = '.part'
+
+
+def verify_archive(path, checksum=None):
+    """
+    Raise an IOError unless the file at path is a ZIP archive whose members
+    all pass their CRC checks and, if checksum is given, whose SHA-1 hex
+    digest equals checksum.
+    """
+    if checksum is not None and epa.clean._file_checksum(path) != checksum:
+        raise IOError("Checksum mismatch for '" + path + "'.")
+    try:
+        with contextlib.closing(zipfile.ZipFile(path, 'r')) as archive:
+            bad_member = archive.testzip()
+    except zipfile.BadZipfile as err:
+        raise IOError("Bad ZIP archive '" + path + "': " + str(err))
+    if bad_member is not None:
+        raise IOError("Bad CRC for '" + bad_member + "' in '" + path + "'.")
+
+def _fetch(url, part_path):
+    """
+    Download url to part_path, resuming from the end of part_path if it
+    exists and the server honours range requests.  Raise an IOError if the
+    response ends before the advertised number of bytes has arrived.
+    """
+    offset = 0
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=' + str(offset) + '-')
+    try:
+        response = urllib2.urlopen(request, timeout=TIMEOUT)
+    except urllib2.HTTPError as err:
+        # The partial file is already complete, or is not a prefix of the
+        # archive, so start over.
+        if err.code == 416 and offset:
+            os.remove(part_path)
+            return _fetch(url, part_path)
+        raise
+
+    with contextlib.closing(response):
+        if offset and response.getcode() != 206:
+            offset = 0
+        length = response.info().getheader('Content-Length')
+        with open(part_path, 'ab' if offset else 'wb') as outfile:
+            shutil.copyfileobj(response, outfile, 1 << 16)
+
+    if length is not None and\
+            os.path.getsize(part_path) != offset + int(length):
+        raise IOError("Incomplete download of '" + url + "'.")
+
+def download_file(url, path, checksum=None, retries=None):
+    """
+    Download url to path, unless a verified archive is already there.
+
+    The archive is written to path + PART_SUFFIX and is only renamed to
+    path once verify_archive() accepts it.  Network errors and truncated
+    responses are retried up to retries times (RETRIES by default), each
+    attempt resuming where the last left off.  Return True if the archive
+    was downloaded and False if it was already present.
+    """
+    if retries is None:
+        retries = RETRIES
+    if os.path.exists(path):
+        try:
+            verify_archive(path, checksum)
+            return False
+        except IOError:
+            os.remove(path)
+
+    part_path = path + PART_SUFFIX
+    for attempt in itertools.count():
+        try:
+            _fetch(url, part_path)
+            break
+        except urllib2.HTTPError as err:
+            # Only server errors are worth another try.
+            if err.code < 500 or attempt >= retries:
+                raise
+        except (IOError, httplib.HTTPException, socket.error):
+            if attempt >= retries:
+                raise
+
+    try:
+        verify_archive(part_path, checksum)
+    except IOError:
+        os.remove(part_path)
+        raise
+    os.rename(part_path, path)
+    return True
+
+def _download_spec(args):
+    """
+    Download the archive for a "(pollutant, year)" spec and return a
+    "(spec, downloaded, error)" triple, where downloaded is the result of
+    download_file() and error is the exception that stopped it, if any.
+    """
+    spec, base_url, checksums, retries = args
+    try:
+        # An archive that was extracted and then removed counts as present.
+        if os.path.exists(epa.clean._raw_data_path(spec[0], spec[1],
+                                                   '.csv')):
+            return (spec, False, None)
+        path = epa.clean.archive_path(*spec)
+        name = os.path.basename(path)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                # Another thread made it first.
+                if not os.path.isdir(os.path.dirname(path)):
+                    raise
+        downloaded = download_file(base_url + name, path,
+                                   checksums.get(name), retries)
+    except (EnvironmentError, httplib.HTTPException) as err:
+        return (spec, False, err)
+    return (spec, downloaded, None)
+
+def iter_downloads(files_specs, base_url=None, workers=4, checksums=None,
+                   retries=None):
+    """
+    Download the archives for files_specs with a pool of worker threads,
+    yielding "(spec, downloaded, error)" triples in the order the downloads
+    finish.  downloaded is False for archives that were already present,
+    and error holds the exception that stopped a failed download.
+
+    Archives are fetched from base_url (BASE_URL by default) into the raw
+    data directories of epa.clean, at most workers at a time.  files_specs
+    may be any iterable, and is read lazily, so a generator can hold back
+    the downloads that follow.  checksums may map archive names to their
+    SHA-1 hex digests.
+    """
+    if base_url is None:
+        base_url = BASE_URL
+    if checksums is None:
+        checksums = {}
+    pool = ThreadPool(max(1, workers))
+    try:
+        for result in pool.imap_unordered(
+                _download_spec, ((spec, base_url, checksums, retries)
+                                 for spec in files_specs)):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def read_checksums(checksum_file):
+    """
+    Return a dictionary mapping archive names to SHA-1 hex digests, read
+    from a file in the output format of "sha1sum".
+    """
+    checksums = {}
+    with open(checksum_file, 'r') as infile:
+        for line in infile:
+            fields = line.split()
+            if len(fields) == 2:
+                checksums[os.path.basename(fields[1].lstrip('*'))] =\
+                    fields[0].lower()
+    return checksums
+
+def main(argv=None):
+    """ Application main. """
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--base-url', default=BASE_URL,
+                        help='URL of the directory holding the archives '
+                             '(default: ' + BASE_URL + ')')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of concurrent downloads (default: 4)')
+    parser.add_argument('--checksums', metavar='FILE',
+                        help='"sha1sum" style file of archive checksums to '
+                             'verify the downloads against')
+    args = parser.parse_args(argv)
+
+    checksums = None
+    if args.checksums is not None:
+        checksums = read_checksums(args.checksums)
+
+    # Enumerate all (pollutant_type, year) pairs.
+    files_specs = list(itertools.product(epa.clean.POLLUTANTS,
+                                         range(1990, 2016)))
+    failures = 0
+    downloads = iter_downloads(files_specs, args.base_url, args.workers,
+                               checksums)
+    for i, (spec, downloaded, error) in enumerate(downloads):
+        name = os.path.basename(epa.clean.archive_path(*spec))
+        if error is not None:
+            print >> sys.stderr, 'Failed to download ' + name + ': ' +\
+                                 str(error)
+            failures += 1
+            continue
+        print ('Downloaded ' if downloaded else 'Skipped ') + name +\
+              ' (' + str(i + 1) + '/' + str(len(files_specs)) + ')...'
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
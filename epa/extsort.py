@@ -0,0 +1,98 @@
+"""
+Sort iterables that do not fit in memory.
+"""
+
+
+import cPickle as pickle
+import heapq
+import itertools
+import tempfile
+
+
+# The most run files merged at once.  This bounds the number of run files
+# open at a time to about MERGE_FAN_IN for each level of merging.
+MERGE_FAN_IN = 64
+
+
+def _write_run(items):
+    """
+    Write a sorted list of items to a temporary file and return the file,
+    rewound to its start.
+    """
+    run_file = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(run_file, pickle.HIGHEST_PROTOCOL)
+    for item in items:
+        pickler.dump(item)
+        # Drop the memo, which would otherwise hold on to every item.
+        pickler.clear_memo()
+    run_file.seek(0)
+    return run_file
+
+def _read_run(run_file):
+    """ Yield the items of a run file, closing it when it is exhausted. """
+    try:
+        unpickler = pickle.Unpickler(run_file)
+        while True:
+            try:
+                yield unpickler.load()
+            except EOFError:
+                return
+    finally:
+        run_file.close()
+
+def _merge_runs(run_files):
+    """ Merge run files into a new run file and return it. """
+    return _write_run(heapq.merge(*[_read_run(run_file)
+                                    for run_file in run_files]))
+
+def external_sorted(iterable, key, buffer_size, fan_in=MERGE_FAN_IN):
+    """
+    Yield the items of iterable sorted by key, holding at most buffer_size
+    items in memory while reading it.
+
+    Items are sorted in runs of buffer_size, and every run but the last is
+    spilled to a temporary file.  Whenever fan_in runs of the same size
+    have been spilled, they are merged into one larger run, so at most
+    fan_in runs of each size are open at a time.  The remaining runs
+    are then merged with a k-way merge.  Like sorted(), the sort is stable,
+    and if iterable fits in a single run nothing is written to disk.  The
+    items must be picklable.
+    """
+    if buffer_size < 1:
+        raise ValueError('buffer_size must be positive.')
+    if fan_in < 2:
+        raise ValueError('fan_in must be at least 2.')
+
+    # Decorate each item with its position so that the sort is stable and
+    # the items themselves are never compared.
+    decorated = ((key(item), index, item)
+                 for index, item in enumerate(iterable))
+    # The spilled runs of each level, where the runs of level i are merged
+    # from fan_in ** i runs of buffer_size items.
+    levels = []
+    try:
+        while True:
+            run = sorted(itertools.islice(decorated, buffer_size))
+            if len(run) < buffer_size or not run:
+                break
+            run_file = _write_run(run)
+            del run
+            for level in itertools.count():
+                if level == len(levels):
+                    levels.append([])
+                levels[level].append(run_file)
+                if len(levels[level]) < fan_in:
+                    break
+                run_file = _merge_runs(levels[level])
+                levels[level] = []
+    except BaseException:
+        for level in levels:
+            for run_file in level:
+                run_file.close()
+        raise
+
+    runs = [_read_run(run_file) for level in reversed(levels)
+            for run_file in level]
+    runs.append(iter(run))
+    for _, _, item in heapq.merge(*runs):
+        yield item
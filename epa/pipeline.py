@@ -0,0 +1,214 @@
+"""
+Download and clean the EPA data in one pipeline.
+
+Each (pollutant, year) archive moves into cleaning as soon as it has been
+downloaded, rather than after every archive has arrived, so time spent on
+the network hides time spent parsing and aggregating.  A download is only
+started once there is room for it, so the downloads never run far ahead of
+cleaning.  There is no separate extract stage, as epa.clean reads the CSV
+file inside each downloaded ZIP archive directly.
+"""
+
+
+import argparse
+import collections
+import functools
+import itertools
+import multiprocessing
+import Queue
+import sys
+import threading
+
+import epa.clean
+import epa.download
+
+
+# Marks the end of the stream of finished downloads.
+_DONE = object()
+
+
+def _put(queue, item, stop):
+    """
+    Put item on queue, unless the stop event is set while waiting for room.
+    Return True if item was put.
+    """
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+def _throttled(files_specs, pending, stop):
+    """
+    Yield each of files_specs once there is room for it on the pending
+    queue, stopping early if the stop event is set.  Whoever finishes with
+    a spec takes an item off pending to make room for the next one.
+    """
+    for spec in files_specs:
+        if not _put(pending, spec, stop):
+            return
+        yield spec
+
+def _download_stage(downloads, queue, stop):
+    """
+    Put the "(spec, downloaded, error)" triples of the downloads generator
+    on queue as they arrive, followed by _DONE, or by the exception that
+    stopped the downloads.
+
+    Once the stop event is set, the downloads generator is closed as soon as
+    its next download finishes, which stops its worker threads.
+    """
+    try:
+        for result in downloads:
+            if not _put(queue, result, stop):
+                return
+    except Exception as err:
+        _put(queue, err, stop)
+    else:
+        _put(queue, _DONE, stop)
+    finally:
+        downloads.close()
+
+def run_pipeline(files_specs, base_url=None, download_workers=4,
+                 clean_workers=2, queue_size=None, checksums=None,
+                 force=False, joined=False, buffer_size=None):
+    """
+    Download the archives for files_specs, clean each one as soon as it
+    arrives, and then rebuild the clean output files.
+
+    Archives are downloaded by download_workers threads (see
+    epa.download.iter_downloads()) and cleaned by clean_workers processes.
+    At most queue_size finished downloads wait to be cleaned, at most
+    queue_size cleaning jobs are in flight (2 * clean_workers by default),
+    and at most download_workers + queue_size archives are downloading or
+    waiting to be cleaned at once.
+    As with epa.clean.update_clean_data(), only new or changed files are
+    cleaned unless force is True.  Return a list of "(spec, error)" pairs
+    for the files that could not be downloaded or cleaned; the output files
+    of their pollutants are left as they were.
+    """
+    if queue_size is None:
+        queue_size = 2 * max(1, clean_workers)
+
+    epa.clean.prepare_clean_roots()
+    manifest = epa.clean.load_manifest()
+    clean_func = functools.partial(epa.clean.clean_data_file,
+                                   buffer_size=buffer_size)
+    failures = []
+
+    # The download stage runs in the background until it is done or stop is
+    # set.  Its threads are only started by feeder.start().  Each spec holds
+    # a place on pending from the start of its download until it has been
+    # cleaned or skipped.
+    downloaded = Queue.Queue(queue_size)
+    pending = Queue.Queue(max(1, download_workers) + queue_size)
+    stop = threading.Event()
+    downloads = epa.download.iter_downloads(
+        _throttled(files_specs, pending, stop), base_url, download_workers,
+        checksums)
+    feeder = threading.Thread(target=_download_stage,
+                              args=(downloads, downloaded, stop))
+    feeder.daemon = True
+
+    # Cleaning jobs in the order they were started.
+    cleaning = collections.deque()
+
+    def collect(limit):
+        """
+        Record the cleaning jobs that have finished at the head of the
+        queue, waiting on the head until at most limit jobs are left.
+        """
+        while cleaning and (len(cleaning) > limit or cleaning[0][1].ready()):
+            spec, job = cleaning.popleft()
+            try:
+                _, entry = job.get()
+            except Exception as err:
+                failures.append((spec, err))
+                continue
+            finally:
+                pending.get_nowait()
+            epa.clean.record_clean_data_file(manifest, spec, entry)
+            print 'Cleaned ' + spec[0] + ' data for ' + str(spec[1]) + '...'
+
+    # Fork the worker processes before any other thread is started, so that
+    # no lock held by another thread is copied into them.
+    pool = multiprocessing.Pool(max(1, clean_workers))
+    try:
+        feeder.start()
+        while True:
+            item = downloaded.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            spec, _, error = item
+            if error is not None:
+                failures.append((spec, error))
+                pending.get_nowait()
+            elif force or epa.clean.is_stale(manifest, spec):
+                cleaning.append((spec,
+                                 pool.apply_async(clean_func, (spec,))))
+            else:
+                pending.get_nowait()
+            collect(queue_size)
+        collect(0)
+    finally:
+        stop.set()
+        pool.terminate()
+        pool.join()
+
+    # Rebuild the outputs of the pollutants whose files all made it.
+    failed = set(pollutant for (pollutant, _), _ in failures)
+    epa.clean.merge_outputs([(pollutant, year)
+                             for pollutant, year in files_specs
+                             if pollutant not in failed],
+                            joined and not failures)
+    return failures
+
+def main(argv=None):
+    """ Application main. """
+
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--base-url', default=epa.download.BASE_URL,
+                        help='URL of the directory holding the archives '
+                             '(default: ' + epa.download.BASE_URL + ')')
+    parser.add_argument('--download-workers', type=int, default=4,
+                        help='number of concurrent downloads (default: 4)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='number of worker processes used to clean the '
+                             'data files (default: 2)')
+    parser.add_argument('--checksums', metavar='FILE',
+                        help='"sha1sum" style file of archive checksums to '
+                             'verify the downloads against')
+    parser.add_argument('--force', action='store_true',
+                        help='clean every data file, even those that are '
+                             'unchanged since the last run')
+    parser.add_argument('--joined', action='store_true',
+                        help='also write the joined site-month table of all '
+                             'pollutants')
+    parser.add_argument('--memory-budget', type=int, metavar='RECORDS',
+                        help='aggregate each data file with an external sort '
+                             'that holds at most RECORDS raw records in '
+                             'memory')
+    args = parser.parse_args(argv)
+
+    checksums = None
+    if args.checksums is not None:
+        checksums = epa.download.read_checksums(args.checksums)
+
+    # Enumerate all (pollutant_type, year) pairs.
+    files_specs = list(itertools.product(epa.clean.POLLUTANTS,
+                                         range(1990, 2016)))
+    failures = run_pipeline(files_specs, args.base_url, args.download_workers,
+                            args.workers, checksums=checksums,
+                            force=args.force, joined=args.joined,
+                            buffer_size=args.memory_budget)
+    for (pollutant, year), error in failures:
+        print >> sys.stderr, 'Failed on ' + pollutant + ' data for ' +\
+                             str(year) + ': ' + str(error)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,27 @@
 """
 Here, we train our model on the EPA data sets in the local "partitions/"
-directory.  The settings for our learning task are below, and they will be
-run a total of six times (once for each of three pollutant types and once
-for each of the mean and max metrics that must be learned).
+directory.  The settings for our learning task are below, and they are run
+for every pollutant type and every target (the mean and max metrics that
+must be learned) from one RDD of results.  Each configuration finds its
+neighbors once and evaluates both targets from them.
+
+The results are written by one saveAsTextFile() job per pollutant and
+target.  The first of these computes the cross validations and caches the
+results, and the rest read them back from the cache.  Any cached partition
+that Spark evicts is recomputed, so the executors need the memory to hold
+every result (a few short tuples per configuration).
 
 Settings:
 ---------
   Folds:        10
-  Neighbors:    3
+  Neighbors:    3 (the nearest within the radius, when one is set)
   Power:        4.5
-  Time Scale:   (only trained parameter here, see below)
+  Time Scale:   (trained, see below)
+  Radius:       None (a sweep of radii may be added, see below)
   Alpha:        0.75
   Bags:         3
 
-Expect a "results_[pollutant]_[metric].csv" as output in the local "results/"
+Expect a "[pollutant]_[target]_results" as output in the local "results/"
 directory.
 """
 
@@ -44,6 +52,7 @@ def report(result_record):
     return (str(result_record[0].folds) +               # folds
             ',' + str(result_record[0].neighbors) +     # neighbors
             ',' + str(result_record[0].power) +         # power
+            ',' + str(result_record[0].radius) +        # radius
             ',' + str(result_record[0].time_scale) +    # time_scale
             ',' + str(result_record[0].alpha) +         # alpha
             ',' + str(result_record[0].m) +             # m
@@ -57,12 +66,19 @@ def main():
     K = [10]   # folds
     N = [3]    # neighbors
     P = [4.5]  # powers
-    # The time scale is the only parameter being trained here, so we
+    # The time scale is the main parameter being trained here, so we
     # consider a number of options.
     C = [0.001 * i for i in range(1, 25)]
     C.extend([0.025 * i for i in range(1, 81)])
     A = [0.75] # alphas
     M = [3]    # bags
+    # Radii of the fixed-bandwidth configurations, which interpolate from
+    # the N nearest neighbors within the radius only.  The cap keeps the
+    # work per query bounded where the radius spans many months of many
+    # stations (see kfold.radius_neighbors()).  None are run by default:
+    # each radius adds another run of every time scale, so list radii here
+    # (e.g. [0.5, 1.0, 2.0]) to sweep them.
+    R = []
 
     # Build the list of k-fold configurations under analysis.
     conf_list = [kfold.KFoldConf(k, n, p, None, c, a, m)
@@ -72,42 +88,59 @@ def main():
                  for c in C
                  for a in A
                  for m in M]
+    conf_list.extend(kfold.KFoldConf(k, n, p, r, c, a, m)
+                     for k in K
+                     for n in N
+                     for p in P
+                     for r in R
+                     for c in C
+                     for a in A
+                     for m in M)
+
+    # Group all the partitions that are to be examined.  These are the
+    # binary columnar partitions written by "partition.py".
+    partition_files = {
+        'ozone': 'partitions/monthly_ozone_1990-2015_partition.bin',
+        'pm25': 'partitions/monthly_pm25_1990-2015_partition.bin'}
+    pollutants = sorted(partition_files)
+
+    # Note that we reuse the method from "point.py" here.  A PointSet
+    # broadcasts as a few arrays rather than an object per point.
+    point_lists_brd = SC.broadcast(dict(
+        (pollutant, point.load_point_set(file_name))
+        for pollutant, file_name in partition_files.items()))
+
+    # Define a mapper to run your statistical routines.
+    def fold(job):
+        """
+        Return a list of "((pollutant, target), result tuple)" pairs for
+        the given "(pollutant, configuration)" job, one for each target.
+        """
+        pollutant, conf = job
+        results = kfold.evaluate(conf, point_lists_brd.value[pollutant],
+                                 ['mare', 'rmspe'], point.TARGETS)
+        return [((pollutant, target), (conf, mare, rmspe))
+                for target, (mare, rmspe) in zip(point.TARGETS, results)]
+
+    # Distribute the k-fold configurations of every pollutant, one to a
+    # slice, and run the learning routines for all of them at once.
+    job_list = [(pollutant, conf) for pollutant in pollutants
+                for conf in conf_list]
+    result_rdd = SC.parallelize(job_list, len(job_list)).\
+                    flatMap(fold).\
+                    cache()
+
+    # Write the report for each pollutant and target to a file in a
+    # "results/" directory.  The results are computed by the first of
+    # these and then read from the cache.
+    for pollutant in pollutants:
+        for target in point.TARGETS:
+            key = (pollutant, target)
+            result_rdd.filter(lambda pair, key=key: pair[0] == key).\
+                       map(lambda pair: report(pair[1])).\
+                       saveAsTextFile('results/' + pollutant + '_' + target +
+                                      '_results')
 
-    # Distribute the RDD of k-fold configurations.
-    conf_rdd = SC.parallelize(conf_list, 104).cache()
-
-    # Group all the partitions that are to be examined.
-    partition_files = ['partitions/monthly_ozone_1990-2015_partition.csv',
-                       'partitions/monthly_pm25_1990-2015_partition.csv']
-
-    # Run learning tasks for each partition.
-    for file_name in partition_files:
-
-        # Note that we reuse the method from "point.py" here.
-        point_list = point.load_point_file(file_name)
-        point_list_brd = SC.broadcast(point_list)
-
-        # Define a mapper to run your statistical routines.
-        def fold(conf):
-            """ Return a result tuple for the given configuration. """
-            return (conf,                               # KFoldConf object
-                    kfold.mare(conf, point_list_brd),   # MARE statistic
-                    kfold.rmspe(conf, point_list_brd))  # RMSPE statistic
-
-        # Run the learning routines and generate the report.
-        report_rdd = conf_rdd.map(fold).map(report)
-
-        # Write the output to a file in a "results/" directory, regardless of
-        # the order in which the partitions were analysed.
-        if 'no2' in file_name:
-            report_rdd.saveAsTextFile('results/no2_max_results')
-        elif 'ozone' in file_name:
-            report_rdd.saveAsTextFile('results/ozone_max_results')
-        elif 'pm25' in file_name:
-            report_rdd.saveAsTextFile('results/pm25_max_results')
-        else:
-            import sys
-            sys.exit(1)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,182 @@
+"""
+A uniform grid index over points, as an alternative to kdtree.KDTree.
+
+Our points are longitude, latitude and scaled month on a bounded domain
+with a fairly even density of stations, so they can be hashed into cells
+of a fixed size rather than split into a deep tree.  A query searches the
+cells around its point ring by ring, outwards, until no unsearched cell can
+hold a nearer point.
+"""
+
+
+import array
+import heapq
+import itertools
+import math
+
+import kdtree
+
+
+# Fraction of a cell by which the reach of a search is cut short.
+_SLACK = 1e-9
+
+
+class GridIndex(object):
+    """
+    A grid of cells holding the points given, with the query(), query_radius()
+    and query_many() contracts of kdtree.FlatKDTree.
+
+    The cells are cell_size wide along every axis but time.  Along the time
+    axis they are time_cell_size wide in scaled units or, if months is given
+    instead, wide enough to hold that many months at the time scale of the
+    points.  By default the cells are cubes.
+    """
+
+    def __init__(self, points, cell_size=1.0, time_cell_size=None,
+                 months=None):
+        self.dimension = len(points[0].location())
+        if time_cell_size is None:
+            time_cell_size = cell_size
+            if months is not None:
+                time_cell_size = months * points[0].time_scale
+        self.cell_sizes = tuple([float(cell_size)] * (self.dimension - 1) +
+                                [float(time_cell_size)])
+        self._build(points)
+
+    def cell(self, location):
+        """ Return the key of the cell holding location. """
+        return tuple(int(math.floor(x / size))
+                     for x, size in zip(location, self.cell_sizes))
+
+    def _build(self, points):
+        """ Fill in the cells and the point arrays for points. """
+        locations = [p.location() for p in points]
+        keys = [self.cell(location) for location in locations]
+        order = sorted(range(len(points)), key=keys.__getitem__)
+
+        # Each cell maps to the range of its points in the point arrays.
+        self.cells = {}
+        start = 0
+        for key, group in itertools.groupby(order, keys.__getitem__):
+            end = start + len(list(group))
+            self.cells[key] = (start, end)
+            start = end
+
+        # The extent of the occupied cells along each axis.
+        self.lows = tuple(min(key[axis] for key in self.cells)
+                          for axis in range(self.dimension))
+        self.highs = tuple(max(key[axis] for key in self.cells)
+                           for axis in range(self.dimension))
+
+        # Coordinates in cell order, along with the position of each point
+        # among the points given.  The values are kept in the order given.
+        self.columns = [array.array('d', [locations[i][axis] for i in order])
+                        for axis in range(self.dimension)]
+        self.indices = array.array('l', order)
+        self.values = array.array('d', [p.value() for p in points])
+        self.maxes = array.array('d', [getattr(p, 'max', kdtree._NAN)
+                                       for p in points])
+        self.means = array.array('d', [getattr(p, 'mean', kdtree._NAN)
+                                       for p in points])
+
+    def __len__(self):
+        """ Return the number of points in this GridIndex. """
+        return len(self.indices)
+
+    def location(self, position):
+        """ Return the location of the point stored at position. """
+        return tuple(column[position] for column in self.columns)
+
+    def neighbor(self, position):
+        """ Return a kdtree.Neighbor for the point stored at position. """
+        index = self.indices[position]
+        return kdtree.Neighbor(self.location(position), self.values[index],
+                               self.maxes[index], self.means[index])
+
+    def _ring(self, center, radius):
+        """
+        Yield the keys of the occupied range of cells whose furthest offset
+        from the cell center along any axis is radius.
+        """
+        ranges = [xrange(max(low, c - radius), min(high, c + radius) + 1)
+                  for c, low, high in zip(center, self.lows, self.highs)]
+        last, low, high = center[-1], self.lows[-1], self.highs[-1]
+        ends = [t for t in sorted(set([last - radius, last + radius]))
+                if low <= t <= high]
+        for prefix in itertools.product(*ranges[:-1]):
+            on_ring = any(abs(c - center[axis]) == radius
+                          for axis, c in enumerate(prefix))
+            for t in (ranges[-1] if on_ring else ends):
+                yield prefix + (t,)
+
+    def _search(self, location, k, limit):
+        """
+        Return a max-heap of entries of the form (-squared_distance, -index,
+        position) for the k points nearest to location, leaving out any
+        whose squared distance from it exceeds limit.
+        """
+        cells, columns, indices = self.cells, self.columns, self.indices
+        center = self.cell(location)
+        last_ring = max(max(c - low, high - c) for c, low, high in
+                        zip(center, self.lows, self.highs))
+        worst = limit
+        heap = []
+        for radius in xrange(last_ring + 1):
+            for key in self._ring(center, radius):
+                if key not in cells:
+                    continue
+                start, end = cells[key]
+                distances = [0.0] * (end - start)
+                for coordinate, column in zip(location, columns):
+                    distances = [d + (coordinate - c) * (coordinate - c)
+                                 for d, c in zip(distances,
+                                                 column[start:end])]
+                for position, distance in enumerate(distances, start):
+                    if distance > worst:
+                        continue
+                    entry = (-distance, -indices[position], position)
+                    if len(heap) < k:
+                        heapq.heappush(heap, entry)
+                        if len(heap) == k:
+                            worst = -heap[0][0]
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+                        worst = -heap[0][0]
+
+            # Every point outside the rings searched so far is at least as
+            # far away as the nearest face of the block of cells they cover,
+            # less a little slack for points rounded into the next cell.
+            reach = min(min(x - (c - radius) * size,
+                            (c + radius + 1) * size - x) - _SLACK * size
+                        for x, c, size in zip(location, center,
+                                              self.cell_sizes))
+            if reach > 0 and reach * reach > worst:
+                break
+        return heap
+
+    def query(self, point, k=1):
+        """
+        Return a list of kdtree.Neighbor objects for the k points nearest to
+        point, nearest first.  Points at equal distances are taken in the
+        order in which they were given to the constructor.
+        """
+        heap = self._search(point.location(), k, kdtree._INF)
+        return [self.neighbor(entry[2]) for entry in sorted(heap,
+                                                            reverse=True)]
+
+    def query_radius(self, point, r, k=None):
+        """
+        Return a list of kdtree.Neighbor objects for the points within
+        distance r of point, as kdtree.KDTree.query_radius() does.
+        """
+        heap = self._search(point.location(),
+                            kdtree._INF if k is None else k, r * r)
+        return [self.neighbor(entry[2]) for entry in sorted(heap,
+                                                            reverse=True)]
+
+    def query_many(self, points, k=1):
+        """
+        Return the k nearest neighbours of each of points as a pair of
+        arrays (indices, distances), as kdtree.KDTree.query_many() does.
+        """
+        return kdtree._query_many(self, points, k, self.location)
@@ -2,6 +2,10 @@
 The interpolation job for the EPA data set.
 """
 
+import os.path
+import shutil
+import tempfile
+
 import pyspark
 
 import kdtree
@@ -20,51 +24,83 @@ POWER = 4.5
 ALPHA = 0.75
 NUM_BAGS = 3
 
+# Set a radius to interpolate from the neighbors within it instead, at most
+# NEIGHBORS of them (see kfold.radius_neighbors()).
+RADIUS = None
+RADIUS_CONF = kfold.KFoldConf(None, NEIGHBORS, POWER, RADIUS, None, None,
+                              None)
+
 
-def _data_interpolation(centroid_rdd, pollutant):
-    """ Run the interpolation of ozone at the centroid locations. """
+def _data_interpolation(centroid_rdd, pollutant, tree_dir):
+    """
+    Run the interpolation of ozone at the centroid locations.  The trees of
+    the bags are saved in tree_dir.
+    """
 
     # Set parameters unique for this interpolation task.
     if pollutant == 'ozone':
         time_scale = (0.4 + 2.0) / 2.0
-        data_file = '../data/clean/monthly_ozone_1990-2015.csv'
-        point_list = point.load_point_file(data_file)
-        point_list = [p.scale_time(time_scale) for p in point_list]
+        data_file = '../data/clean/monthly_ozone_1990-2015.bin'
+        point_list = point.load_point_set(data_file).scale_time(time_scale)
     else:
         time_scale = (0.18 + 0.16) / 2.0
-        data_file = '../data/clean/monthly_pm25_1990-2015.csv'
-        point_list = point.load_point_file(data_file)
-        point_list = [p.scale_time(time_scale) for p in point_list]
+        data_file = '../data/clean/monthly_pm25_1990-2015.bin'
+        point_list = point.load_point_set(data_file).scale_time(time_scale)
 
     # Bag the point list and produce a list of trees to use for prediction.
+    # The trees are saved to files that are shipped to every node, where
+    # all Python workers map the same copy rather than unpickling their own.
     bag_size = int(len(point_list) * ALPHA)
     bags = [kfold.sample_with_replacement(point_list, bag_size)
             for _ in range(NUM_BAGS)]
-    trees = [kdtree.KDTree(bag) for bag in bags]
-    tree_tuple_brd = SC.broadcast(trees)
-
-    # Define a mapper for interpolating each query point.
-    def interpolation_mapper(query_point, tree_tuple_brd):
+    tree_names = []
+    for i, bag in enumerate(bags):
+        tree_name = pollutant + '_bag_' + str(i) + '.kdt'
+        kdtree.FlatKDTree(bag).save(os.path.join(tree_dir, tree_name))
+        SC.addFile(os.path.join(tree_dir, tree_name))
+        tree_names.append(tree_name)
+
+    # Define a mapper for interpolating a partition of query points.
+    def interpolation_mapper(query_points, tree_names):
         """
-        Set the max and mean estimates for query_point using the list
-        of KDTree objects for interpolation.
+        Set the max and mean estimates for each of query_points using the
+        tree files named by tree_names for interpolation.  Each tree answers
+        the queries of the whole partition in one call to query_many(),
+        unless RADIUS is set.
         """
-
-        # Generate a list of estimates for this query point.
-        estimates = []
-        for tree in tree_tuple_brd.value:
-            nodes = tree.query(query_point, NEIGHBORS)
-            estimates.append(query_point.interpolate(nodes, POWER))
-
-        # Average the estimates from each bag.
-        max_est = sum([est[0] for est in estimates]) / len(estimates)
-        mean_est = sum([est[1] for est in estimates]) / len(estimates)
-
-        # Fix the results within query_point.
-        query_point.max_est = max_est
-        query_point.mean_est = mean_est
-
-        return query_point
+        query_points = list(query_points)
+        if not query_points:
+            return query_points
+
+        # Sum the estimates from each bag.
+        trees = [kdtree.open_tree(pyspark.SparkFiles.get(name))
+                 for name in tree_names]
+        max_ests = [0.0] * len(query_points)
+        mean_ests = [0.0] * len(query_points)
+        for tree in trees:
+            if RADIUS is not None:
+                for row, query_point in enumerate(query_points):
+                    nodes = kfold.radius_neighbors(RADIUS_CONF, tree,
+                                                   query_point)
+                    max_est, mean_est = query_point.interpolate(nodes, POWER)
+                    max_ests[row] += max_est
+                    mean_ests[row] += mean_est
+                continue
+            indices, distances = tree.query_many(query_points, NEIGHBORS)
+            tree_max_ests, tree_mean_ests = point.idw_estimates(
+                indices, distances, len(query_points), POWER,
+                [tree.maxes, tree.means])
+            for row in xrange(len(query_points)):
+                max_ests[row] += tree_max_ests[row]
+                mean_ests[row] += tree_mean_ests[row]
+
+        # Fix the averaged results within each query point.
+        for query_point, max_est, mean_est in zip(query_points, max_ests,
+                                                  mean_ests):
+            query_point.max_est = max_est / len(trees)
+            query_point.mean_est = mean_est / len(trees)
+
+        return query_points
 
     # Transform centroid_rdd into an RDD of query points, scale the time
     # dimension, and cache the intermediate result.
@@ -77,8 +113,8 @@ def _data_interpolation(centroid_rdd, pollutant):
     query_point_rdd = query_point_rdd.map(lambda q: q.scale_time(time_scale))
     query_point_rdd = query_point_rdd.cache()
 
-    # Map the query_point_rdd through the interpolation mapper.
-    query_point_rdd = query_point_rdd.map(lambda q: interpolation_mapper(q, tree_tuple_brd)).cache()
+    # Map the partitions of query_point_rdd through the interpolation mapper.
+    query_point_rdd = query_point_rdd.mapPartitions(lambda qs: interpolation_mapper(qs, tree_names)).cache()
 
     # ----------------------  Aggregation  ----------------------------------
 
@@ -160,14 +196,19 @@ def main():
                       flatMap(lambda r: [(r, m) for m in range(1, 313)]).\
                       cache()
 
-    # Interpolate the ozone values.
-    _data_interpolation(centroid_rdd, 'ozone')
+    # The tree files of every interpolation are removed once it is done.
+    tree_dir = tempfile.mkdtemp(prefix='epa_trees_')
+    try:
+        # Interpolate the ozone values.
+        _data_interpolation(centroid_rdd, 'ozone', tree_dir)
 
-    # Filter out the unnecessary values.
-    centroid_rdd = centroid_rdd.filter(lambda pair: pair[1] >= 88)
+        # Filter out the unnecessary values.
+        centroid_rdd = centroid_rdd.filter(lambda pair: pair[1] >= 88)
 
-    # Interpolate the pm25 values.
-    _data_interpolation(centroid_rdd, 'pm25')
+        # Interpolate the pm25 values.
+        _data_interpolation(centroid_rdd, 'pm25', tree_dir)
+    finally:
+        shutil.rmtree(tree_dir)
 
 
 if __name__ == "__main__":
@@ -1,12 +1,109 @@
+import array
+import collections
+import heapq
+import itertools
+import math
+import mmap
+import struct
+import sys
+
+
+# Magic string of the tree files written by FlatKDTree.save().
+TREE_MAGIC = 'EPAKDT1\0'
+
+# The tree file header holds the magic string, then the dimension, leaf
+# size, node count and point count as little-endian 64-bit integers.
+_TREE_HEADER = struct.Struct('<8sQQQQ')
+
+# Stand-in for the max and mean of points that have none.
+_NAN = float('nan')
+
+_INF = float('inf')
+
+# The trees opened by open_tree(), keyed by path.
+_OPEN_TREES = {}
+
+
+def _consume(iterator):
+    """ Run an iterator to exhaustion, discarding its items. """
+    collections.deque(iterator, maxlen=0)
+
+
+def _squared_distance(location1, location2):
+    """ Return the squared Euclidean distance between two locations. """
+    distance = 0.0
+    for a, b in zip(location1, location2):
+        distance += (a - b) * (a - b)
+    return distance
+
+
+def _locality_order(locations, bucket_size=8):
+    """
+    Return a permutation of the indices of locations in which neighbouring
+    entries tend to be near one another.  The locations are split at the
+    median along each axis in turn, as in a KD-tree, until at most
+    bucket_size are left in each part.
+    """
+    order = range(len(locations))
+    if not locations:
+        return order
+    dimension = len(locations[0])
+    stack = [(0, len(order), 0)]
+    while stack:
+        start, end, depth = stack.pop()
+        if end - start <= bucket_size:
+            continue
+        axis = depth % dimension
+        order[start:end] = sorted(order[start:end],
+                                  key=lambda i: locations[i][axis])
+        median = (start + end) // 2
+        stack.append((start, median, depth + 1))
+        stack.append((median, end, depth + 1))
+    return order
+
+
+def _query_many(tree, points, k, location_of):
+    """
+    Run the batched queries of KDTree.query_many() and
+    FlatKDTree.query_many() against tree.  location_of maps the last item
+    of an entry of the heap returned by tree._search() to its location.
+    """
+    locations = [p.location() for p in points]
+    width = min(k, len(tree))
+    indices = array.array('l', [0]) * (len(points) * width)
+    distances = array.array('d', [0.0]) * (len(points) * width)
+    if width == 0:
+        return indices, distances
+
+    # Queries are answered in an order that keeps consecutive ones close,
+    # and the neighbours of each query bound the search for the next.
+    previous = []
+    for row in _locality_order(locations):
+        location = locations[row]
+        limit = _INF
+        if previous:
+            limit = max(_squared_distance(location, other)
+                        for other in previous)
+        entries = sorted(tree._search(location, width, limit), reverse=True)
+        offset = row * width
+        for column, entry in enumerate(entries):
+            indices[offset + column] = -entry[1]
+            distances[offset + column] = math.sqrt(-entry[0])
+        previous = [location_of(entry[2]) for entry in entries]
+    return indices, distances
+
+
 class KDTree:
 
     def __init__(self, points):
         self.dimension = len(points[0].location())
         self.root = None
+        self.size = 0
         self.add_all(points)
 
     def add(self, point):
-        new_node = KDNode(point)
+        new_node = KDNode(point, self.size)
+        self.size += 1
         if not self.root:
             self.root = new_node
         else:
@@ -29,6 +126,16 @@ class KDTree:
                 depth += 1
 
     def add_all(self, points, depth=0):
+        """
+        Add a list of points to this tree.
+
+        An empty tree is built in bulk by _build().  Otherwise, the median
+        along each axis is inserted with add() before the points on either
+        side of it, which keeps the new points as balanced as add() allows.
+        """
+        if self.root is None and depth == 0:
+            self.root = self._build(points)
+            return
         if len(points) == 0:
             return
         axis = depth % self.dimension
@@ -38,44 +145,184 @@ class KDTree:
         self.add_all(points[:median], depth + 1)
         self.add_all(points[median + 1:], depth + 1)
 
-    def query(self, point, k=1):
-        """ Return a list of the k KDNode objects nearest to point. """
-
-        def search_node(bpq, curr, depth, point):
-            """ Recursive helper search method. """
-            if curr is None:
-                return
-            bpq.add(curr, point.distance(curr.location))
-            axis = depth % self.dimension
-            if point.location()[axis] < curr.location[axis]:
-                search_node(bpq, curr.left, depth + 1, point)
-                searched = 'LEFT'
+    def _build(self, points):
+        """
+        Return the root KDNode of a balanced tree over points, or None if
+        there are none.
+
+        The point indices are sorted along each axis once, up front.  Each
+        node takes the median of its points along its axis, and the sorted
+        index lists are then split between its children in linear time, so
+        building the tree takes O(n log n) time.  Children are linked to
+        their parents directly rather than by descending from the root.  As
+        with add(), points that tie with a node along its axis may be on
+        either side of it, which query() allows for.
+        """
+        if len(points) == 0:
+            return None
+        dimension = self.dimension
+        nodes = [KDNode(p, self.size + i) for i, p in enumerate(points)]
+        self.size += len(nodes)
+
+        # Index lists sorted along each axis, ties broken by index.
+        orders = []
+        for axis in range(dimension):
+            column = [node.location[axis] for node in nodes]
+            orders.append(sorted(range(len(nodes)), key=column.__getitem__))
+
+        # Flags marking the indices that go to each child of the current
+        # node.  These are set and read with C-level itertools loops.
+        in_left = bytearray(len(nodes))
+        in_right = bytearray(len(nodes))
+        root = None
+        stack = [(orders, 0, None, False)]
+        while stack:
+            orders, depth, parent, is_right = stack.pop()
+            axis = depth % dimension
+            order = orders[axis]
+            median = len(order) // 2
+            median_index = order[median]
+            node = nodes[median_index]
+            if parent is None:
+                root = node
+            elif is_right:
+                parent.right = node
             else:
-                search_node(bpq, curr.right, depth + 1, point)
-                searched = 'RIGHT'
-            diff = abs(curr.location[axis] - point.location()[axis])
-            c1 = len(bpq) < k
-            c2 = diff < bpq.contents[-1][1]
-            if (c1 or c2):
-                if searched == 'LEFT':
-                    search_node(bpq, curr.right, depth + 1, point)
+                parent.left = node
+
+            # Subtrees of up to three points are their own sorted order.
+            if len(order) <= 3:
+                if len(order) > 1:
+                    node.left = nodes[order[0]]
+                if len(order) > 2:
+                    node.right = nodes[order[2]]
+                continue
+
+            # Split every sorted index list between the two children.
+            left_order = order[:median]
+            right_order = order[median + 1:]
+            _consume(itertools.imap(in_left.__setitem__, left_order,
+                                    itertools.repeat(1)))
+            _consume(itertools.imap(in_right.__setitem__, left_order,
+                                    itertools.repeat(0)))
+            _consume(itertools.imap(in_left.__setitem__, right_order,
+                                    itertools.repeat(0)))
+            _consume(itertools.imap(in_right.__setitem__, right_order,
+                                    itertools.repeat(1)))
+            in_left[median_index] = in_right[median_index] = 0
+            left_orders = []
+            right_orders = []
+            for other_axis, other in enumerate(orders):
+                if other_axis == axis:
+                    left_orders.append(left_order)
+                    right_orders.append(right_order)
                 else:
-                    search_node(bpq, curr.left, depth + 1, point)
+                    left_orders.append(list(itertools.compress(
+                        other, itertools.imap(in_left.__getitem__, other))))
+                    right_orders.append(list(itertools.compress(
+                        other, itertools.imap(in_right.__getitem__, other))))
+            if right_order:
+                stack.append((right_orders, depth + 1, node, True))
+            if left_order:
+                stack.append((left_orders, depth + 1, node, False))
+        return root
 
-        result = BoundedPriorityQueue(k)
-        search_node(result, self.root, 0, point)
+    def __len__(self):
+        """ Return the number of points in this KDTree. """
+        return self.size
+
+    def _search(self, location, k, limit):
+        """
+        Return a max-heap of entries of the form (-squared_distance, -index,
+        node) for the k nodes nearest to location, leaving out any whose
+        squared distance from it exceeds limit.  Squared distances give the
+        same order as distances without the square roots.
+        """
+        dimension = self.dimension
+        worst = limit
+        heap = []
+        stack = [(self.root, 0, 0.0)]
+        while stack:
+            node, axis, bound = stack.pop()
+            if bound > worst:
+                continue
+
+            # Walk down to the leaf nearest to location, saving the far side
+            # of each split along with a lower bound on its distance.
+            while node is not None:
+                node_location = node.location
+                distance = 0.0
+                for a, b in zip(location, node_location):
+                    distance += (a - b) * (a - b)
+                if distance <= worst:
+                    entry = (-distance, -node.index, node)
+                    if len(heap) < k:
+                        heapq.heappush(heap, entry)
+                        if len(heap) == k:
+                            worst = -heap[0][0]
+                    elif entry > heap[0]:
+                        heapq.heapreplace(heap, entry)
+                        worst = -heap[0][0]
+
+                diff = location[axis] - node_location[axis]
+                next_axis = axis + 1
+                if next_axis == dimension:
+                    next_axis = 0
+                if diff < 0:
+                    if node.right is not None:
+                        stack.append((node.right, next_axis, diff * diff))
+                    node = node.left
+                else:
+                    if node.left is not None:
+                        stack.append((node.left, next_axis, diff * diff))
+                    node = node.right
+                axis = next_axis
+        return heap
+
+    def query(self, point, k=1):
+        """
+        Return a list of the k KDNode objects nearest to point, nearest
+        first.  Nodes at equal distances are taken in the order in which
+        their points were added to this tree.
+        """
+        heap = self._search(point.location(), k, _INF)
+        return [entry[2] for entry in sorted(heap, reverse=True)]
 
-        result = [x[0] for x in result.contents]
-        return result
+    def query_radius(self, point, r, k=None):
+        """
+        Return a list of the KDNode objects within distance r of point,
+        nearest first and ordered as by query().  If k is given, only the k
+        nearest of them are returned.  Subtrees farther than r from point,
+        or farther than the k-th nearest node found so far, are skipped.
+        """
+        heap = self._search(point.location(), _INF if k is None else k,
+                            r * r)
+        return [entry[2] for entry in sorted(heap, reverse=True)]
+
+    def query_many(self, points, k=1):
+        """
+        Return the k nearest neighbours of each of points as a pair of
+        arrays (indices, distances).
+
+        Both arrays hold min(k, len(self)) entries per point, in the order
+        of points, each row nearest first and ordered as by query().  The
+        indices give the positions of the neighbours among the points added
+        to this tree.  The queries are sorted so that nearby ones are
+        answered one after another, and each is bounded from the start by
+        the neighbours found for the one before it.
+        """
+        return _query_many(self, points, k, lambda node: node.location)
 
 
 class KDNode:
 
-    def __init__(self, point):
+    def __init__(self, point, index=None):
         self.location = point.location()
         self.value = point.value()
         self.max = getattr(point, 'max', None)
         self.mean = getattr(point, 'mean', None)
+        # The position of point among the points of its tree.
+        self.index = index
         self.left = None
         self.right = None
 
@@ -86,25 +333,469 @@ class KDNode:
         pass
 
 
-class BoundedPriorityQueue:
+class FlatKDTree(object):
+    """
+    A static KD-tree whose nodes and points are held in flat typed arrays.
 
-    def __init__(self, member_max):
-        self.contents = list()
-        self.member_max = member_max
+    Internal nodes are stored as parallel arrays of split axes, split values
+    and child indices, and the points of each leaf sit in a contiguous range
+    of up to leaf_size entries of the coordinate arrays.  Such a tree takes
+    a fraction of the memory of a KDTree and pickles quickly, which matters
+    when trees are broadcast to Spark executors.  query() honours the
+    contract of KDTree.query(), returning Neighbor objects.
+    """
 
-    def add(self, kdnode, priority):
-        if len(self.contents) < self.member_max:
-            self.contents.append((kdnode, priority))
-            self.contents = sorted(self.contents, key=lambda e: e[1])
-        else:
-            index = 0
-            for element in self.contents:
-                if priority < element[1]:
-                    self.contents.insert(index, (kdnode, priority))
-                    self.contents.pop()
-                    break
-                index += 1
+    def __init__(self, points, leaf_size=16):
+        self.dimension = len(points[0].location())
+        self.leaf_size = max(1, leaf_size)
+        self._build(points)
+
+    def _build(self, points):
+        """ Fill in the node and point arrays for points. """
+        dimension = self.dimension
+        locations = [p.location() for p in points]
+        columns = [[location[axis] for location in locations]
+                   for axis in range(dimension)]
+
+        # Node arrays.  Leaves have an axis of -1, and their "children" are
+        # the start and end of their range of points.
+        self.axes = array.array('b')
+        self.splits = array.array('d')
+        self.lefts = array.array('l')
+        self.rights = array.array('l')
+
+        order = range(len(points))
+        stack = [(0, len(order), 0, -1, False)]
+        while stack:
+            start, end, depth, parent, is_right = stack.pop()
+            node = len(self.axes)
+            if parent >= 0:
+                (self.rights if is_right else self.lefts)[parent] = node
+            if end - start <= self.leaf_size:
+                self.axes.append(-1)
+                self.splits.append(0.0)
+                self.lefts.append(start)
+                self.rights.append(end)
+                continue
+
+            # Split at the median along this node's axis.  Points equal to
+            # the split value may fall on either side.
+            axis = depth % dimension
+            column = columns[axis]
+            order[start:end] = sorted(order[start:end],
+                                      key=column.__getitem__)
+            median = (start + end) // 2
+            self.axes.append(axis)
+            self.splits.append(column[order[median]])
+            self.lefts.append(-1)
+            self.rights.append(-1)
+            stack.append((median, end, depth + 1, node, True))
+            stack.append((start, median, depth + 1, node, False))
+
+        # Coordinates in leaf order, along with the position of each point
+        # among the points given.  The values are kept in the order given.
+        self.columns = [array.array('d', [values[i] for i in order])
+                        for values in columns]
+        self.indices = array.array('l', order)
+        self.values = array.array('d', [p.value() for p in points])
+        self.maxes = array.array('d', [getattr(p, 'max', _NAN)
+                                       for p in points])
+        self.means = array.array('d', [getattr(p, 'mean', _NAN)
+                                       for p in points])
 
     def __len__(self):
-        """ Return the length of this BoundedPriorityQueue. """
-        return len(self.contents)
+        """ Return the number of points in this FlatKDTree. """
+        return len(self.indices)
+
+    def location(self, position):
+        """ Return the location of the point stored at position. """
+        return tuple(column[position] for column in self.columns)
+
+    def neighbor(self, position):
+        """ Return a Neighbor for the point stored at position. """
+        index = self.indices[position]
+        return Neighbor(self.location(position), self.values[index],
+                        self.maxes[index], self.means[index])
+
+    def _search(self, location, k, limit):
+        """
+        Return a max-heap of entries of the form (-squared_distance, -index,
+        position) for the k points nearest to location, leaving out any
+        whose squared distance from it exceeds limit.
+        """
+        axes, splits = self.axes, self.splits
+        lefts, rights = self.lefts, self.rights
+        columns, indices = self.columns, self.indices
+        worst = limit
+        heap = []
+        stack = [(0, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if bound > worst:
+                continue
+
+            # Descend to the nearest leaf, saving the far side of each split.
+            axis = axes[node]
+            while axis >= 0:
+                diff = location[axis] - splits[node]
+                if diff < 0:
+                    stack.append((rights[node], diff * diff))
+                    node = lefts[node]
+                else:
+                    stack.append((lefts[node], diff * diff))
+                    node = rights[node]
+                axis = axes[node]
+
+            # Scan the points of the leaf.
+            start, end = lefts[node], rights[node]
+            distances = [0.0] * (end - start)
+            for coordinate, column in zip(location, columns):
+                distances = [d + (coordinate - c) * (coordinate - c)
+                             for d, c in zip(distances, column[start:end])]
+            for position, distance in enumerate(distances, start):
+                if distance > worst:
+                    continue
+                entry = (-distance, -indices[position], position)
+                if len(heap) < k:
+                    heapq.heappush(heap, entry)
+                    if len(heap) == k:
+                        worst = -heap[0][0]
+                elif entry > heap[0]:
+                    heapq.heapreplace(heap, entry)
+                    worst = -heap[0][0]
+        return heap
+
+    def query(self, point, k=1):
+        """
+        Return a list of Neighbor objects for the k points nearest to point,
+        nearest first.  Points at equal distances are taken in the order in
+        which they were given to the constructor.
+        """
+        heap = self._search(point.location(), k, _INF)
+        return [self.neighbor(entry[2]) for entry in sorted(heap,
+                                                            reverse=True)]
+
+    def query_radius(self, point, r, k=None):
+        """
+        Return a list of Neighbor objects for the points within distance r
+        of point, as KDTree.query_radius() does.
+        """
+        heap = self._search(point.location(), _INF if k is None else k,
+                            r * r)
+        return [self.neighbor(entry[2]) for entry in sorted(heap,
+                                                            reverse=True)]
+
+    def query_many(self, points, k=1):
+        """
+        Return the k nearest neighbours of each of points as a pair of
+        arrays (indices, distances), as KDTree.query_many() does.  The
+        indices give the positions of the neighbours among the points given
+        to the constructor, and so also index values, maxes and means.
+        """
+        return _query_many(self, points, k, self.location)
+
+    def save(self, path):
+        """
+        Write this tree to a file at path that MappedKDTree can open.
+
+        After the header come the node arrays (axes, splits, lefts and
+        rights), the coordinate columns, the indices and then the values,
+        maxes and means, each as a block of little-endian 64-bit integers
+        or doubles.
+        """
+        with open(path, 'wb') as tree_file:
+            tree_file.write(_TREE_HEADER.pack(TREE_MAGIC, self.dimension,
+                                              self.leaf_size, len(self.axes),
+                                              len(self)))
+            blocks = [self.axes, self.splits, self.lefts, self.rights]
+            blocks.extend(self.columns)
+            blocks.extend([self.indices, self.values, self.maxes,
+                           self.means])
+            for block in blocks:
+                if block.typecode == 'd':
+                    block = array.array('d', block)
+                    if sys.byteorder != 'little':
+                        block.byteswap()
+                    block.tofile(tree_file)
+                else:
+                    tree_file.write(struct.pack('<' + str(len(block)) + 'q',
+                                                *block))
+
+
+class MappedKDTree(FlatKDTree):
+    """
+    A FlatKDTree opened from a file written by FlatKDTree.save().
+
+    The file is memory-mapped.  The node arrays, which are small, are copied
+    out when the tree is opened, but the coordinates and values of the
+    points are read in place, so every process that opens the same file
+    shares one copy of them in the page cache.  A MappedKDTree pickles as
+    the path of its file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as tree_file:
+            self.mapped = mmap.mmap(tree_file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
+        if len(self.mapped) < _TREE_HEADER.size or\
+                self.mapped[:len(TREE_MAGIC)] != TREE_MAGIC:
+            self.mapped.close()
+            raise IOError("'" + path + "' is not a KD-tree file.")
+        _, self.dimension, self.leaf_size, node_count, point_count =\
+            _TREE_HEADER.unpack_from(self.mapped, 0)
+
+        offset = _TREE_HEADER.size
+        nodes = []
+        for typecode in ['l', 'd', 'l', 'l']:
+            nodes.append(array.array(typecode, struct.unpack_from(
+                '<' + str(node_count) + ('d' if typecode == 'd' else 'q'),
+                self.mapped, offset)))
+            offset += 8 * node_count
+        self.axes, self.splits, self.lefts, self.rights = nodes
+
+        columns = []
+        for code in ['d'] * self.dimension + ['q', 'd', 'd', 'd']:
+            columns.append(_MappedColumn(self.mapped, offset, code,
+                                         point_count))
+            offset += 8 * point_count
+        self.columns = columns[:self.dimension]
+        self.indices, self.values, self.maxes, self.means =\
+            columns[self.dimension:]
+
+    def close(self):
+        """ Unmap the file of this MappedKDTree. """
+        self.mapped.close()
+
+    def __getstate__(self):
+        """ Pickle this MappedKDTree as the path of its file. """
+        return self.path
+
+    def __setstate__(self, path):
+        """ Open the file of an unpickled MappedKDTree. """
+        self.__init__(path)
+
+
+def open_tree(path):
+    """
+    Return a MappedKDTree for the file at path.  Each file is opened only
+    once in each process, and the tree is shared by later calls.
+    """
+    if path not in _OPEN_TREES:
+        _OPEN_TREES[path] = MappedKDTree(path)
+    return _OPEN_TREES[path]
+
+
+class _MappedColumn(object):
+    """
+    A read-only sequence of little-endian doubles ('d') or 64-bit integers
+    ('q') at offset in a memory-mapped file.  Slices are returned as
+    tuples.
+    """
+
+    __slots__ = ['mapped', 'offset', 'code', 'typecode', 'length', 'item']
+
+    def __init__(self, mapped, offset, code, length):
+        self.mapped = mapped
+        self.offset = offset
+        self.code = code
+        # The array typecode of the items, for FlatKDTree.save().
+        self.typecode = 'd' if code == 'd' else 'l'
+        self.length = length
+        self.item = struct.Struct('<' + code)
+
+    def __len__(self):
+        """ Return the number of items in this column. """
+        return self.length
+
+    def __getitem__(self, key):
+        """ Return the item at an index, or a tuple of a slice of them. """
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step != 1:
+                return tuple(self[i] for i in xrange(start, stop, step))
+            return struct.unpack_from(
+                '<' + str(max(0, stop - start)) + self.code, self.mapped,
+                self.offset + 8 * start)
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError('column index out of range')
+        return self.item.unpack_from(self.mapped, self.offset + 8 * key)[0]
+
+
+class Neighbor(object):
+    """
+    A point found by FlatKDTree.query().  It has the same location, value,
+    max and mean attributes as a KDNode.
+    """
+
+    __slots__ = ['location', 'value', 'max', 'mean']
+
+    def __init__(self, location, value, maximum, mean):
+        self.location = location
+        self.value = value
+        self.max = maximum
+        self.mean = mean
+
+
+class KDForest(object):
+    """
+    A KD-tree that points can be added to cheaply, made of a forest of
+    static FlatKDTrees in the manner of the logarithmic method.
+
+    New points are kept in a small buffer, which is searched directly.
+    When the buffer fills, its points become a new tree, which is merged
+    with the smallest trees of the forest for as long as they are no more
+    than twice its size.  So there are O(log n) trees, every tree stays
+    balanced, and each point is rebuilt into a larger tree only O(log n)
+    times.  query(), query_radius() and query_many() honour the contracts
+    of those of FlatKDTree, with points indexed in the order they were
+    added.
+    """
+
+    def __init__(self, points=(), leaf_size=16, buffer_size=256):
+        self.leaf_size = leaf_size
+        self.buffer_size = max(1, buffer_size)
+        # Pairs of a FlatKDTree and an array mapping the positions of its
+        # points among those it was built from to their indices here,
+        # largest tree first.
+        self.trees = []
+        # Pairs of an index and a point not yet in any tree.
+        self.buffer = []
+        self.size = 0
+        self.add_all(points)
+
+    def __len__(self):
+        """ Return the number of points in this KDForest. """
+        return self.size
+
+    def add(self, point):
+        """ Add a point to this KDForest. """
+        self.buffer.append((self.size, point))
+        self.size += 1
+        if len(self.buffer) >= self.buffer_size:
+            self._flush()
+
+    def add_all(self, points):
+        """ Add a list of points to this KDForest. """
+        for point in points:
+            self.buffer.append((self.size, point))
+            self.size += 1
+        if len(self.buffer) >= self.buffer_size:
+            self._flush()
+
+    def _flush(self):
+        """ Turn the buffer into a tree, merging it into the forest. """
+        entries = self.buffer
+        self.buffer = []
+        while self.trees and len(self.trees[-1][0]) <= 2 * len(entries):
+            tree, indices = self.trees.pop()
+            entries.extend((indices[tree.indices[position]],
+                            _StoredPoint(tree, position))
+                           for position in xrange(len(tree)))
+        # Keep the points in the order they were added, so that a tree
+        # ranks the points at equal distances as this forest does.
+        entries.sort(key=lambda entry: entry[0])
+        tree = FlatKDTree([point for _, point in entries], self.leaf_size)
+        self.trees.append((tree, array.array('l', [index for index, _ in
+                                                   entries])))
+
+    def _search(self, location, k, limit):
+        """
+        Return a max-heap of entries of the form (-squared_distance, -index,
+        (tree, position)) for the k points nearest to location, leaving out
+        any whose squared distance from it exceeds limit.  For a point in
+        the buffer, tree is None and position is the point itself.
+        """
+        worst = limit
+        heap = []
+
+        def offer(entry):
+            """ Add entry to the heap if it is among the k best. """
+            if len(heap) < k:
+                heapq.heappush(heap, entry)
+                return -heap[0][0] if len(heap) == k else worst
+            if entry > heap[0]:
+                heapq.heapreplace(heap, entry)
+            return -heap[0][0]
+
+        # Each tree is searched within the bound set by the trees before.
+        for tree, indices in self.trees:
+            for distance, index, position in tree._search(location, k,
+                                                          worst):
+                worst = offer((distance, -indices[-index],
+                               (tree, position)))
+        for index, point in self.buffer:
+            distance = _squared_distance(location, point.location())
+            if distance <= worst:
+                worst = offer((-distance, -index, (None, point)))
+        return heap
+
+    def location(self, found):
+        """ Return the location of a "(tree, position)" pair. """
+        tree, position = found
+        if tree is None:
+            return position.location()
+        return tree.location(position)
+
+    def neighbor(self, found):
+        """ Return a Neighbor for a "(tree, position)" pair. """
+        tree, position = found
+        if tree is None:
+            return Neighbor(position.location(), position.value(),
+                            getattr(position, 'max', _NAN),
+                            getattr(position, 'mean', _NAN))
+        return tree.neighbor(position)
+
+    def query(self, point, k=1):
+        """
+        Return a list of Neighbor objects for the k points nearest to point,
+        nearest first.  Points at equal distances are taken in the order in
+        which they were added.
+        """
+        heap = self._search(point.location(), k, _INF)
+        return [self.neighbor(entry[2]) for entry in sorted(heap,
+                                                            reverse=True)]
+
+    def query_radius(self, point, r, k=None):
+        """
+        Return a list of Neighbor objects for the points within distance r
+        of point, as KDTree.query_radius() does.
+        """
+        heap = self._search(point.location(), _INF if k is None else k,
+                            r * r)
+        return [self.neighbor(entry[2]) for entry in sorted(heap,
+                                                            reverse=True)]
+
+    def query_many(self, points, k=1):
+        """
+        Return the k nearest neighbours of each of points as a pair of
+        arrays (indices, distances), as KDTree.query_many() does.  The
+        indices give the order in which the neighbours were added.
+        """
+        return _query_many(self, points, k, self.location)
+
+
+class _StoredPoint(object):
+    """
+    The point stored at position in a FlatKDTree, with the location(),
+    value(), max and mean of a Point.
+    """
+
+    __slots__ = ['coordinates', 'stored_value', 'max', 'mean']
+
+    def __init__(self, tree, position):
+        index = tree.indices[position]
+        self.coordinates = tree.location(position)
+        self.stored_value = tree.values[index]
+        self.max = tree.maxes[index]
+        self.mean = tree.means[index]
+
+    def location(self):
+        """ Return the location of this point. """
+        return self.coordinates
+
+    def value(self):
+        """ Return the value of this point. """
+        return self.stored_value
@@ -1,14 +1,14 @@
 """
-Run MARE and RMSPE based learning functions.
+Run MARE, RMSPE and other error statistic based learning functions.
 
 Kind of a mess, but uses bagging accurately, which is fine for our purposes.
 """
 
-import copy
 import math
 import random
 
 import kdtree
+import point
 
 
 class KFoldConf:
@@ -52,108 +52,184 @@ def sample_with_replacement(population, k):
     return result
 
 
-def mare(conf, point_list_brd):
+def radius_neighbors(conf, tree, query_point):
     """
-    Return the MARE error statistic generated from K-fold cross validation.
+    Return the nodes of tree used to estimate the value at query_point when
+    conf.radius is set.  These are the nodes within conf.radius of it, or
+    the conf.neighbors nearest of them if conf.neighbors is set.  If there
+    are none, the conf.neighbors (or the one) nearest nodes are used.
+    """
+    nodes = tree.query_radius(query_point, conf.radius, conf.neighbors)
+    if not nodes:
+        nodes = tree.query(query_point, conf.neighbors or 1)
+    return nodes
 
-    Take the given KFoldConf object and an ordered broadcasted list of point
-    objects and return the desired error statistic.
+
+def scaled_points(points, time_scale):
     """
+    Return a PointSet of points with the given time scale, leaving points
+    as they are.  A PointSet shares its columns with the result, while a
+    list of Points is gathered into a new PointSet first.
+    """
+    if not isinstance(points, point.PointSet):
+        points = point.PointSet.from_points(points)
+    return points.scaled(time_scale)
 
-    # deep copy point_list
-    points = copy.deepcopy(point_list_brd.value)
 
-    # scale time dimensions
-    for p in points:
-        p.scale_time(conf.time_scale)
+def bagged_estimates(conf, bags, trees, points, targets=('max',)):
+    """
+    Return a list holding, for each of targets, a list of the estimates of
+    that measurement at each of points, averaged over the trees built from
+    bags.  The neighbors of each point are found once per tree and shared
+    by every target.  Each tree answers the queries for all of points in
+    one call to query_many(), unless conf.radius is set, in which case the
+    neighbors are found by radius_neighbors().
+    """
+    estimates = [[0.0] * len(points) for _ in targets]
+    if conf.radius is not None:
+        for tree in trees:
+            for row, p in enumerate(points):
+                nodes = radius_neighbors(conf, tree, p)
+                lambdas = point.inverse_distance_weights(
+                    [p.distance(n.location) for n in nodes], conf.power)
+                for target, target_estimates in zip(targets, estimates):
+                    target_estimates[row] += sum(
+                        [l * getattr(n, target)
+                         for l, n in zip(lambdas, nodes)])
+    else:
+        for bag, tree in zip(bags, trees):
+            indices, distances = tree.query_many(points, conf.neighbors)
+            tree_estimates = point.idw_estimates(
+                indices, distances, len(points), conf.power,
+                [[p.value(target) for p in bag] for target in targets])
+            for target_estimates, tree_target_estimates in zip(
+                    estimates, tree_estimates):
+                for row, estimate in enumerate(tree_target_estimates):
+                    target_estimates[row] += estimate
+    return [[estimate / conf.m for estimate in target_estimates]
+            for target_estimates in estimates]
 
-    # build a list of sets representing the relevant partition
-    partition = [list() for i in range(conf.folds)]
-    for i, p in enumerate(points):
-        partition[i % conf.folds].append(p)
 
-    # generate results for kfold cross validation with this err stat
-    results = [0.0] * conf.folds
-    for i in range(conf.folds):
+def _relative_error(estimate, actual):
+    """ Return the absolute error of estimate relative to actual. """
+    return abs(estimate - actual) / actual
 
-        # initialize validation set and training set
-        validation_set = partition[i]
-        training_set = list()
-        for j in range(conf.folds):
-            if j != i:
-                training_set.extend(partition[j])
 
-        # generate conf.m bags and trees at conf.alpha by sampling with
-        # replacement
-        n_prime = int(len(training_set) * conf.alpha)
-        bags = [sample_with_replacement(training_set, n_prime)
-                for i in range(conf.m)]
-        trees = [kdtree.KDTree(bag) for bag in bags]
+def _squared_relative_error(estimate, actual):
+    """ Return the squared error of estimate relative to actual. """
+    return ((estimate - actual) / actual) ** 2.0
 
-        for p in validation_set:
-            # compute the average estimate for pollution at p over bags
-            avg_estimate = 0.0
-            for tree in trees:
-                nnl = tree.query(p, conf.neighbors)
-                avg_estimate += p.interpolate(nnl, conf.power)
-            avg_estimate /= conf.m
-            # incorporate this information into the results vector
-            results[i] += (abs(avg_estimate - p.value()) / p.value())
-        results[i] /= len(validation_set)
 
-    # return the average of the elements in the results vector
-    return sum(results) / len(results)
+def _absolute_error(estimate, actual):
+    """ Return the absolute error of estimate. """
+    return abs(estimate - actual)
 
 
-def rmspe(conf, point_list_brd):
-    """
-    Return the RMSPE error statistic generated from K-fold cross validation.
+def _squared_error(estimate, actual):
+    """ Return the squared error of estimate. """
+    return (estimate - actual) ** 2.0
 
-    Take the given KFoldConf object and an ordered broadcasted list of point
-    objects and return the desired error statistic.
-    """
 
-    # deep copy point_list
-    points = copy.deepcopy(point_list_brd.value)
+def _error(estimate, actual):
+    """ Return the signed error of estimate. """
+    return estimate - actual
+
+
+def _root_percent(mean):
+    """ Return the square root of mean as a percentage. """
+    return math.sqrt(mean) * 100
+
+
+# The error statistics known to evaluate().  Each is given by the error term
+# averaged over the validation set of a fold, and by the function (if any)
+# applied to that average.  The results of the folds are then averaged.
+METRICS = {'mare': (_relative_error, None),
+           'rmspe': (_squared_relative_error, _root_percent),
+           'mae': (_absolute_error, None),
+           'rmse': (_squared_error, math.sqrt),
+           'bias': (_error, None)}
+
+
+def evaluate(conf, points, metrics=('mare', 'rmspe'), targets=('max',)):
+    """
+    Return a list holding, for each of targets (see point.TARGETS), a list
+    of the error statistics named by metrics (see METRICS) generated from
+    a single K-fold cross validation.
+
+    Take the given KFoldConf object and an ordered list of point objects,
+    or a PointSet.  The folds are partitioned, bagged and searched once, and
+    every statistic of every target is computed from the same estimates.
+    The points are left as they are (see scaled_points()).
+    """
 
     # scale time dimensions
-    for p in points:
-        p.scale_time(conf.time_scale)
+    points = scaled_points(points, conf.time_scale)
 
     # build a list of sets representing the relevant partition
     partition = [list() for i in range(conf.folds)]
     for i, p in enumerate(points):
         partition[i % conf.folds].append(p)
 
-    # generate results for kfold cross validation with this err stat
-    results = [0.0] * conf.folds
+    # generate results for kfold cross validation with these err stats
+    metric_funcs = [METRICS[name] for name in metrics]
+    totals = [[0.0] * len(metrics) for _ in targets]
     for i in range(conf.folds):
 
-        # initialize validation_set and training_set
+        # initialize validation set and training set
         validation_set = partition[i]
         training_set = list()
         for j in range(conf.folds):
             if j != i:
                 training_set.extend(partition[j])
 
-        # generate conf.m bags at conf.alpha by sampling with replacement
+        # generate conf.m bags and trees at conf.alpha by sampling with
+        # replacement
         n_prime = int(len(training_set) * conf.alpha)
         bags = [sample_with_replacement(training_set, n_prime)
-                for i in range(conf.m)]
+                for _ in range(conf.m)]
         trees = [kdtree.KDTree(bag) for bag in bags]
 
-        for point in validation_set:
-            # compute the average estimate for pollution at point over bags
-            avg_estimate = 0.0
-            for tree in trees:
-                nnl = tree.query(point, conf.neighbors)
-                avg_estimate += point.interpolate(nnl, conf.power)
-            avg_estimate /= conf.m
-            # incorporate this information into the results vector
-            results[i] += ((avg_estimate - point.value()) /
-                           point.value()) ** 2.0
-        results[i] /= len(validation_set)
-        results[i] = math.sqrt(results[i]) * 100
-
-    # return the average of the elements in the results vector
-    return sum(results) / len(results)
+        # compute the average estimate for pollution at each p over bags
+        estimates = bagged_estimates(conf, bags, trees, validation_set,
+                                     targets)
+        for target, target_totals, target_estimates in zip(
+                targets, totals, estimates):
+            actuals = [p.value(target) for p in validation_set]
+            for m, (term, finish) in enumerate(metric_funcs):
+                # incorporate this information into the totals
+                result = sum([term(estimate, actual) for estimate, actual
+                              in zip(target_estimates, actuals)])
+                result /= len(validation_set)
+                if finish is not None:
+                    result = finish(result)
+                target_totals[m] += result
+
+    # return the average of each statistic over the folds
+    return [[total / conf.folds for total in target_totals]
+            for target_totals in totals]
+
+
+def mare(conf, point_list_brd, target='max'):
+    """
+    Return the MARE error statistic generated from K-fold cross validation.
+
+    Take the given KFoldConf object and an ordered broadcasted list of point
+    objects and return the desired error statistic for target (one of
+    point.TARGETS).  Use evaluate() to compute several statistics, or
+    several targets, from one cross validation.
+    """
+    (result,), = evaluate(conf, point_list_brd.value, ['mare'], [target])
+    return result
+
+
+def rmspe(conf, point_list_brd, target='max'):
+    """
+    Return the RMSPE error statistic generated from K-fold cross validation.
+
+    Take the given KFoldConf object and an ordered broadcasted list of point
+    objects and return the desired error statistic for target (one of
+    point.TARGETS).  Use evaluate() to compute several statistics, or
+    several targets, from one cross validation.
+    """
+    (result,), = evaluate(conf, point_list_brd.value, ['rmspe'], [target])
+    return result
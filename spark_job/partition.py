@@ -3,8 +3,11 @@ Generate distinct partitions over which to average k-fold results.
 """
 
 
+import os.path
 import random
 
+import point
+
 
 def read_records(file_name):
     """ Return a list of the CSV records from file_name. """
@@ -15,16 +18,38 @@ def read_records(file_name):
     return record_list
 
 def write_records(file_name):
-    """ Shuffle the global record list and write to "filename". """
+    """
+    Shuffle the global record list and write to "filename".
+
+    If the binary columnar file for "filename" exists, its records are
+    shuffled in the same order and written alongside the CSV partition.  An
+    IOError is raised if it does not hold as many records as the CSV file.
+    """
 
     record_list = read_records(file_name)
-    random.shuffle(record_list)
-    out_file = open('partitions/' +\
-                    file_name[file_name.rfind('/') + 1:].\
-                    replace('.csv', '_partition.csv'), 'w')
-    out_file.writelines(record_list)
+    bin_file_name = file_name.replace('.csv', '.bin')
+    columns = None
+    if os.path.exists(bin_file_name):
+        columns = point.load_point_columns(bin_file_name)
+        if len(columns[point.COLUMNAR_FIELDS[0]]) != len(record_list):
+            raise IOError("'" + bin_file_name + "' does not match '" +
+                          file_name + "'.")
+
+    order = range(len(record_list))
+    random.shuffle(order)
+    out_name = 'partitions/' +\
+               file_name[file_name.rfind('/') + 1:].\
+               replace('.csv', '_partition.csv')
+    out_file = open(out_name, 'w')
+    out_file.writelines([record_list[i] for i in order])
     out_file.close()
 
+    if columns is not None:
+        columns = dict((field, [column[i] for i in order])
+                       for field, column in columns.items())
+        point.write_point_columns(columns,
+                                  out_name.replace('.csv', '.bin'))
+
 def main():
     """ Application main. """
 
@@ -3,32 +3,80 @@ This module provides facilities for training our model on the EPA data set.
 """
 
 
+import array
 import csv
 import math
-import StringIO
+import mmap
+import struct
+import sys
 
 
-class Point(object):
-    """ A single EPA data point. """
+# Magic string and field order of the binary columnar files written by
+# epa.clean.write_columnar_records().
+COLUMNAR_MAGIC = 'EPACOL1\0'
+COLUMNAR_FIELDS = ['longitude', 'latitude', 'month', 'maximum', 'mean']
 
-    def __init__(self, **kwargs):
-        """ Initialize a new Point object from a decoded CSV record. """
+# The columnar header holds the magic string and a little-endian row count.
+_COLUMNAR_HEADER = struct.Struct('<8sQ')
 
-        self.longitude = float(kwargs['longitude'])
-        self.latitude = float(kwargs['latitude'])
-        self.month = float(kwargs['month'])
+# The measurements a model can be trained to estimate, named by the Point
+# attributes that hold them.
+TARGETS = ['max', 'mean']
 
-        # These don't conflict with the 'pm25' attribute for this project,
-        # so we add them now.
-        self.max = float(kwargs['maximum'])
-        self.mean = float(kwargs['mean'])
+# The estimate given to a query point with no neighbors.
+_NAN = float('nan')
 
-        # Swap these two when running training tasks.
-        # self.pm25 = float(kwargs['mean'])
-        self.pm25 = float(kwargs['maximum'])
 
-        self.scaled_time = None
-        self.time_scale = None
+def inverse_distance_weights(distances, power):
+    """
+    Return the weights given to neighbors at the given distances by inverse
+    distance weighting with the given power.  The weights sum to one.
+
+    A neighbor at distance zero would have an infinite weight, so if there
+    are any, they share all of the weight equally and the others get none.
+    """
+    if 0.0 in distances:
+        share = 1.0 / distances.count(0.0)
+        return [share if d == 0.0 else 0.0 for d in distances]
+    inv_distances = [(1.0 / d) ** power for d in distances]
+    sum_inv_distances = sum(inv_distances)
+    return [i / sum_inv_distances for i in inv_distances]
+
+
+def idw_estimates(indices, distances, count, power, targets):
+    """
+    Return a list holding an array of inverse distance weighted estimates
+    for each of the sequences in targets.
+
+    indices and distances are the arrays of a batched neighbor search of
+    count query points, such as KDTree.query_many() returns, with the same
+    number of neighbors for each query point.  Each target is indexed by
+    neighbor index, like the values, maxes and means of a FlatKDTree.  The
+    weights of each query point are computed once and shared by every
+    target.  A query point with no neighbors gets NaN estimates.
+    """
+    width = len(indices) // count if count else 0
+    results = [array.array('d', [_NAN]) * count for _ in targets]
+    if width == 0:
+        return results
+    for row in xrange(count):
+        start = row * width
+        neighbors = indices[start:start + width]
+        lambdas = inverse_distance_weights(
+            list(distances[start:start + width]), power)
+        for result, target in zip(results, targets):
+            result[row] = sum([l * target[i]
+                               for l, i in zip(lambdas, neighbors)])
+    return results
+
+
+class _BasePoint(object):
+    """
+    The methods shared by Point and PointView, which both hold their fields
+    in slots rather than in a __dict__.
+    """
+
+    __slots__ = []
 
     def distance(self, location):
         """ Return the Euclidean distance between this Point and location. """
@@ -38,16 +86,50 @@ class Point(object):
         return math.sqrt(sum([(a - b) ** 2
                               for a, b in zip(endpoint1, endpoint2)]))
 
-    def interpolate(self, nodes, power):
-        """ Return an estimate of self.pm25 given nodes list. """
+    def interpolate(self, nodes, power, target='max'):
+        """ Return an estimate of the target measurement given nodes list. """
 
-        inv_distances = [(1.0 / self.distance(n.location)) ** power
-                         for n in nodes]
-        sum_inv_distances = sum(inv_distances)
-        lambdas = [i / sum_inv_distances for i in inv_distances]
-        result = sum([l * n.value for l, n in zip(lambdas, nodes)])
+        lambdas = inverse_distance_weights(
+            [self.distance(n.location) for n in nodes], power)
+        result = sum([l * getattr(n, target) for l, n in zip(lambdas, nodes)])
         return result
 
+    def value(self, target='max'):
+        """
+        Return the pollution measurement of the given target (one of
+        TARGETS) recorded at this location.
+        """
+        return getattr(self, target)
+
+    def __str__(self):
+        """ Return the string representation of this object. """
+        return '< PMPoint -- ' +\
+               str(self.location()) +\
+               ', ' +\
+               str(self.value()) +\
+               '>'
+
+
+class Point(_BasePoint):
+    """ A single EPA data point. """
+
+    __slots__ = ['longitude', 'latitude', 'month', 'max', 'mean',
+                 'scaled_time', 'time_scale']
+
+    def __init__(self, **kwargs):
+        """ Initialize a new Point object from a decoded CSV record. """
+
+        self.longitude = float(kwargs['longitude'])
+        self.latitude = float(kwargs['latitude'])
+        self.month = float(kwargs['month'])
+
+        # The measurements that can be learned (see TARGETS).
+        self.max = float(kwargs['maximum'])
+        self.mean = float(kwargs['mean'])
+
+        self.scaled_time = None
+        self.time_scale = None
+
     def location(self):
         """ Return a tuple representing the location of this PMPoint. """
         return (self.longitude, self.latitude, self.scaled_time)
@@ -61,18 +143,6 @@ class Point(object):
         self.time_scale = scale
         return self
 
-    def value(self):
-        """ Return the pollution measurement recorded at this location. """
-        return self.pm25
-
-    def __str__(self):
-        """ Return the string representation of this object. """
-        return '< PMPoint -- ' +\
-               str(self.location()) +\
-               ', ' +\
-               str(self.value()) +\
-               '>'
-
 
 class QueryPoint(object):
     """ A single query point. """
@@ -99,10 +169,8 @@ class QueryPoint(object):
         """ Set the estimated max and mean for this node. """
 
         # Note that objects in 'nodes' now have 'max' and 'mean' attribues.
-        inv_distances = [(1.0 / self.distance(n.location)) ** power
-                         for n in nodes]
-        sum_inv_distances = sum(inv_distances)
-        lambdas = [i / sum_inv_distances for i in inv_distances]
+        lambdas = inverse_distance_weights(
+            [self.distance(n.location) for n in nodes], power)
 
         # The above can be shared.
         self.max_est = sum([l * n.max for l, n in zip(lambdas, nodes)])
@@ -141,26 +209,56 @@ class QueryPoint(object):
         return self
 
 
-def load_point_rdd(csv_rdd):
+def parse_point_records(lines):
+    """
+    Return a dictionary mapping each of COLUMNAR_FIELDS to an array of
+    doubles parsed from an iterable of CSV records.
+
+    The records are read by a single csv.reader and converted one column at
+    a time, rather than through a reader and a Point for every record.
+    Blank records are skipped, and a ValueError is raised for any record
+    that does not hold one value for each of COLUMNAR_FIELDS.
+    """
+    records = [record for record in csv.reader(lines) if record]
+    for record in records:
+        if len(record) != len(COLUMNAR_FIELDS):
+            raise ValueError("'" + ','.join(record) + "' is not a point " +
+                             "record of " + str(len(COLUMNAR_FIELDS)) +
+                             " fields.")
+    columns = zip(*records) or [()] * len(COLUMNAR_FIELDS)
+    return dict((field, array.array('d', [float(x) for x in column]))
+                for field, column in zip(COLUMNAR_FIELDS, columns))
+
+
+def points_from_columns(columns):
+    """
+    Return a list of Point objects for a dictionary of columns, as returned
+    by parse_point_records() or load_point_columns().
+    """
+    return [Point(longitude=lon, latitude=lat, month=month, maximum=maximum,
+                  mean=mean)
+            for lon, lat, month, maximum, mean in
+            zip(*[columns[field] for field in COLUMNAR_FIELDS])]
+
+
+def load_point_rdd(csv_rdd, arrays=False):
     """
     Return an RDD of Point objects.
 
     The rdd argument must be an RDD of CSV records representative of Point
-    objects.
+    objects.  Each partition is parsed in bulk by parse_point_records().  If
+    arrays is True, the RDD instead holds one PointSet per partition, so no
+    Point object is made for each record.
     """
 
-    def load_record(record):
-        """ Parse a single CSV record. """
-        result = StringIO.StringIO(record)
-        fieldnames = ['longitude',
-                      'latitude',
-                      'month',
-                      'maximum',
-                      'mean']
-        reader = csv.DictReader(result, fieldnames)
-        return reader.next()
+    def load_partition(records):
+        """ Parse a whole partition of CSV records. """
+        columns = parse_point_records(records)
+        if arrays:
+            return [PointSet(columns)]
+        return points_from_columns(columns)
 
-    return csv_rdd.map(load_record).map(lambda rec: Point(**rec))
+    return csv_rdd.mapPartitions(load_partition)
 
 
 def load_point_file(csv_file):
@@ -170,21 +268,233 @@ def load_point_file(csv_file):
     Rather than loading Points from an RDD of CSV records, load them from
     a file directly.
     """
-    csv_file_obj = open(csv_file, 'r')
+    with open(csv_file, 'r') as csv_file_obj:
+        return points_from_columns(parse_point_records(csv_file_obj))
 
-    def load_record(record):
-        """ Parse a single CSV record. """
-        result = StringIO.StringIO(record)
-        fieldnames = ['longitude',
-                      'latitude',
-                      'month',
-                      'maximum',
-                      'mean']
-        reader = csv.DictReader(result, fieldnames)
-        return reader.next()
 
-    records = [load_record(r) for r in csv_file_obj]
-    result = [Point(**r) for r in records]
-    csv_file_obj.close()
+def load_point_columns(bin_file):
+    """
+    Return a dictionary mapping each of COLUMNAR_FIELDS to an array of
+    doubles loaded from a binary columnar file.
 
+    The file is memory-mapped and every column is copied out as a block of
+    raw machine doubles, so no parsing takes place.
+    """
+    with open(bin_file, 'rb') as bin_file_obj:
+        mapped = mmap.mmap(bin_file_obj.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, count = _COLUMNAR_HEADER.unpack_from(mapped, 0)
+        if magic != COLUMNAR_MAGIC:
+            raise IOError("'" + bin_file + "' is not a columnar point file.")
+        result = {}
+        start = _COLUMNAR_HEADER.size
+        for field in COLUMNAR_FIELDS:
+            column = array.array('d')
+            column.fromstring(mapped[start:start + 8 * count])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            result[field] = column
+            start += 8 * count
+    finally:
+        mapped.close()
     return result
+
+
+def write_point_columns(columns, bin_file):
+    """
+    Write a dictionary of columns, as returned by load_point_columns(), to
+    a binary columnar file.
+    """
+    count = len(columns[COLUMNAR_FIELDS[0]])
+    with open(bin_file, 'wb') as bin_file_obj:
+        bin_file_obj.write(_COLUMNAR_HEADER.pack(COLUMNAR_MAGIC, count))
+        for field in COLUMNAR_FIELDS:
+            column = array.array('d', columns[field])
+            if sys.byteorder != 'little':
+                column.byteswap()
+            column.tofile(bin_file_obj)
+
+
+def load_point_binary(bin_file):
+    """
+    Return a list of Point objects loaded from a binary columnar file.
+
+    This is the counterpart to load_point_file() for the ".bin" files
+    written alongside the clean CSV files.
+    """
+    return points_from_columns(load_point_columns(bin_file))
+
+
+def load_point_set(bin_file):
+    """
+    Return a PointSet loaded from a binary columnar file.
+
+    Unlike load_point_binary(), no Point object is made for each record.
+    """
+    return PointSet(load_point_columns(bin_file))
+
+
+class PointSet(object):
+    """
+    A set of EPA data points stored as one array of doubles per field.
+
+    This takes a small fraction of the memory of a list of Point objects
+    and pickles as a few blocks of raw doubles.  Indexing or iterating over
+    a PointSet yields PointView objects, which behave as Points.  The time
+    scale is set for the whole set, and the scaled time column is only
+    computed when a location is first asked for.
+    """
+
+    def __init__(self, columns=None):
+        """
+        Initialize a new PointSet from a dictionary mapping each of
+        COLUMNAR_FIELDS to a sequence of values, as returned by
+        load_point_columns().
+        """
+        columns = columns or {}
+        self.longitude = array.array('d', columns.get('longitude', ()))
+        self.latitude = array.array('d', columns.get('latitude', ()))
+        self.month = array.array('d', columns.get('month', ()))
+        self.maximum = array.array('d', columns.get('maximum', ()))
+        self.mean = array.array('d', columns.get('mean', ()))
+        self.time_scale = None
+        self._scaled_time = None
+
+    @classmethod
+    def from_points(cls, points):
+        """ Return a new PointSet holding the fields of a list of Points. """
+        return cls({'longitude': [p.longitude for p in points],
+                    'latitude': [p.latitude for p in points],
+                    'month': [p.month for p in points],
+                    'maximum': [p.max for p in points],
+                    'mean': [p.mean for p in points]})
+
+    def columns(self):
+        """ Return a dictionary mapping COLUMNAR_FIELDS to their arrays. """
+        return dict((field, getattr(self, field))
+                    for field in COLUMNAR_FIELDS)
+
+    def take(self, indices):
+        """
+        Return a new PointSet of the points at indices, which may repeat,
+        with the time scale of this PointSet.
+        """
+        result = PointSet(dict((field, [column[i] for i in indices])
+                               for field, column in self.columns().items()))
+        result.time_scale = self.time_scale
+        return result
+
+    def scale_time(self, scale):
+        """
+        Alter the scale applied to the time dimension of every point in this
+        PointSet.  You must do this before anything useful can be done with
+        its points.
+        """
+        if scale != self.time_scale:
+            self.time_scale = scale
+            self._scaled_time = None
+        return self
+
+    def scaled(self, scale):
+        """
+        Return a PointSet sharing the columns of this PointSet, with the
+        given time scale.  Unlike scale_time(), this leaves this PointSet as
+        it is, so a shared PointSet, such as a broadcast one, can be scaled
+        by any number of tasks without being copied.
+        """
+        result = PointSet()
+        for field in COLUMNAR_FIELDS:
+            setattr(result, field, getattr(self, field))
+        return result.scale_time(scale)
+
+    def scaled_time(self):
+        """ Return the array of scaled times, computing it if need be. """
+        if self._scaled_time is None:
+            scale = self.time_scale
+            self._scaled_time = array.array('d', [m * scale
+                                                  for m in self.month])
+        return self._scaled_time
+
+    def location(self, index):
+        """ Return a tuple representing the location of a point. """
+        if self.time_scale is None:
+            return (self.longitude[index], self.latitude[index], None)
+        return (self.longitude[index], self.latitude[index],
+                self.scaled_time()[index])
+
+    def __len__(self):
+        """ Return the number of points in this PointSet. """
+        return len(self.month)
+
+    def __getitem__(self, index):
+        """ Return a PointView of the point at index. """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('PointSet index out of range')
+        return PointView(self, index)
+
+    def __iter__(self):
+        """ Yield a PointView of each point in turn. """
+        for index in xrange(len(self)):
+            yield PointView(self, index)
+
+    def __getstate__(self):
+        """ Leave the scaled time column out of pickles. """
+        state = self.__dict__.copy()
+        state['_scaled_time'] = None
+        return state
+
+
+class PointView(_BasePoint):
+    """
+    A single point of a PointSet, with the attributes and methods of a
+    Point.  Its fields are read only, and its time is scaled along with the
+    rest of the PointSet by PointSet.scale_time().
+    """
+
+    __slots__ = ['points', 'index']
+
+    def __init__(self, points, index):
+        """ Initialize a new view of the point at index in points. """
+        self.points = points
+        self.index = index
+
+    @property
+    def longitude(self):
+        """ Return the longitude of this point. """
+        return self.points.longitude[self.index]
+
+    @property
+    def latitude(self):
+        """ Return the latitude of this point. """
+        return self.points.latitude[self.index]
+
+    @property
+    def month(self):
+        """ Return the month of this point. """
+        return self.points.month[self.index]
+
+    @property
+    def max(self):
+        """ Return the maximum value of the pollutant at this point. """
+        return self.points.maximum[self.index]
+
+    @property
+    def mean(self):
+        """ Return the mean value of the pollutant at this point. """
+        return self.points.mean[self.index]
+
+    @property
+    def scaled_time(self):
+        """ Return the scaled month of this point, or None if unscaled. """
+        return self.location()[2]
+
+    @property
+    def time_scale(self):
+        """ Return the time scale of the PointSet. """
+        return self.points.time_scale
+
+    def location(self):
+        """ Return a tuple representing the location of this PointView. """
+        return self.points.location(self.index)
@@ -10,14 +10,18 @@ def print_record(record):
     """ Format and print a CSV record. """
 
     fields = record.split(',')
+    # Records from before the radius sweep have no radius field.
+    if len(fields) == 8:
+        fields.insert(3, 'None')
     print "    Folds : %s" % fields[0]
     print "    Neighbors : %s" % fields[1]
     print "    Power : %s" % fields[2]
-    print "    Time Scale : %s" % fields[3]
-    print "    Alpha : %s" % fields[4]
-    print "    Bags : %s" % fields[5]
-    print "    MARE : %s" % fields[6]
-    print "    RMSPE : %s" % fields[7]
+    print "    Radius : %s" % fields[3]
+    print "    Time Scale : %s" % fields[4]
+    print "    Alpha : %s" % fields[5]
+    print "    Bags : %s" % fields[6]
+    print "    MARE : %s" % fields[7]
+    print "    RMSPE : %s" % fields[8]
 
 
 def main():
@@ -37,12 +41,12 @@ def main():
         print "Summary for '" + file_name + "':"
 
         # sort records by MARE and print optimal record
-        record_list.sort(key=lambda s: float(s.split(',')[6]))
+        record_list.sort(key=lambda s: float(s.split(',')[-2]))
         print "\nOptimal MARE result:"
         print_record(record_list[0])
 
         # sort records by RMSPE and print optimal record
-        record_list.sort(key=lambda s: float(s.split(',')[7]))
+        record_list.sort(key=lambda s: float(s.split(',')[-1]))
         print "\nOptimal RMSPE result:"
         print_record(record_list[0])
 
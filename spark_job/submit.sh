@@ -10,6 +10,8 @@
 
 #hdfs dfs -rm -R results/ozone_max_results
 #hdfs dfs -rm -R results/pm25_max_results
+#hdfs dfs -rm -R results/ozone_mean_results
+#hdfs dfs -rm -R results/pm25_mean_results
 
 # local clean up code
 if [ -d "ozone_interpolation_results.csv/" ]; then
@@ -23,16 +25,16 @@ fi
 spark-submit \
      --master 'local[*]' \
      --name 'Interpolation Testing' \
-     --py-files kdtree.py,kfold.py,point.py \
+     --py-files grid.py,kdtree.py,kfold.py,point.py \
      interpolation_job.py;
 
 
 # Submit on "gsu-hue".
 # spark-submit \
 #     --master 'yarn' \
-#     --name 'EPA Data: Learning the Max' \
+#     --name 'EPA Data: Learning the Max and Mean' \
 #     --deploy-mode client \
-#     --py-files kdtree.py,kfold.py,point.py \
+#     --py-files grid.py,kdtree.py,kfold.py,point.py \
 #     --num-executors 14 \
 #     --executor-cores 16 \
 #     --executor-memory 2G \
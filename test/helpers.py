@@ -0,0 +1,140 @@
+"""
+Helpers shared by the tests of the epa package.
+
+These point epa.clean at a temporary data directory, write raw AQS records
+and serve ZIP archives from a local HTTP server that stands in for the EPA
+site.
+"""
+
+
+import BaseHTTPServer
+import os.path
+import shutil
+import StringIO
+import tempfile
+import threading
+import zipfile
+
+import epa.clean
+
+
+def raw_ozone_record(date_local):
+    """
+    Return a line of a raw daily ozone file holding one record for the
+    site at (-86.8, 33.5) on date_local, with a mean of 0.03 and a maximum
+    of 0.04.
+    """
+    return ','.join(['01', '073', '0023', '44201', '1', '33.5', '-86.8',
+                     'WGS84', 'Ozone', '1 HOUR', 'Ozone 1-hour 1979',
+                     date_local, 'ppm', 'None', '17', '100.0', '0.03',
+                     '0.04']) + '\n'
+
+def make_archive(member, payload):
+    """ Return the bytes of a ZIP archive holding one member. """
+    buf = StringIO.StringIO()
+    archive = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    archive.writestr(member, payload)
+    archive.close()
+    return buf.getvalue()
+
+
+class ArchiveRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve the archives of the server's "files" dictionary, honouring range
+    requests.  The server's "truncate" set names files whose next response
+    is cut off halfway.
+    """
+
+    def do_GET(self):
+        """ Serve a whole archive, or the range of it requested. """
+        name = self.path.rsplit('/', 1)[-1]
+        self.server.requests.append((name, self.headers.getheader('Range')))
+        if name not in self.server.files:
+            self.send_error(404)
+            return
+        body = self.server.files[name]
+
+        start = 0
+        range_header = self.headers.getheader('Range')
+        if range_header is not None:
+            start = int(range_header.split('=')[1].split('-')[0])
+            if start >= len(body):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes ' + str(start) + '-' +
+                             str(len(body) - 1) + '/' + str(len(body)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body) - start))
+        self.end_headers()
+
+        if name in self.server.truncate:
+            self.server.truncate.remove(name)
+            self.wfile.write(body[start:start + (len(body) - start) // 2])
+            return
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        """ Keep the test output quiet. """
+        pass
+
+
+class ArchiveServerMixin(object):
+    """
+    Run an ArchiveRequestHandler on a local port.  Test cases call
+    start_server() from setUp() and stop_server() from tearDown().
+    """
+
+    def start_server(self, path='/'):
+        """
+        Start serving no archives, and set base_url to the URL of the
+        directory at path.
+        """
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                ArchiveRequestHandler)
+        self.server.requests = []
+        self.server.truncate = set()
+        self.server.files = {}
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:' +\
+                        str(self.server.server_address[1]) + path
+
+    def stop_server(self):
+        """ Stop the server. """
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class DataRootMixin(object):
+    """
+    Point the data directory roots of epa.clean at a temporary directory.
+    Test cases call patch_data_roots() from setUp() and
+    restore_data_roots() from tearDown().
+    """
+
+    # Module attributes that are pointed at the temporary directory.
+    PATCHED = ['DATA_ROOT', 'NO2_DATA_ROOT', 'OZONE_DATA_ROOT',
+               'PM25_DATA_ROOT', 'CLEAN_ROOT', 'SHARD_ROOT', 'MANIFEST_PATH']
+
+    def patch_data_roots(self):
+        """ Make the temporary directory data_root and patch epa.clean. """
+        self.saved_roots = dict((name, getattr(epa.clean, name))
+                                for name in self.PATCHED)
+        self.data_root = tempfile.mkdtemp()
+        epa.clean.DATA_ROOT = self.data_root
+        epa.clean.NO2_DATA_ROOT = os.path.join(self.data_root, 'no2/')
+        epa.clean.OZONE_DATA_ROOT = os.path.join(self.data_root, 'ozone/')
+        epa.clean.PM25_DATA_ROOT = os.path.join(self.data_root, 'pm25/')
+        epa.clean.CLEAN_ROOT = os.path.join(self.data_root, 'clean/')
+        epa.clean.SHARD_ROOT = os.path.join(self.data_root, 'clean/shards/')
+        epa.clean.MANIFEST_PATH = os.path.join(self.data_root,
+                                               'clean/manifest.json')
+
+    def restore_data_roots(self):
+        """ Restore the data directory roots and remove data_root. """
+        for name, value in self.saved_roots.items():
+            setattr(epa.clean, name, value)
+        shutil.rmtree(self.data_root)
@@ -7,13 +7,19 @@ our EPA data work as expected.
 
 
 import os.path
+import shutil
+import struct
+import tempfile
 import unittest
+import zipfile
 
 from glob import glob
 from random import sample
 
 import epa.clean
 
+from test.helpers import DataRootMixin, raw_ozone_record
+
 
 class LoadDataTestCase(unittest.TestCase):
     """
@@ -96,6 +102,81 @@ class LoadDataTestCase(unittest.TestCase):
         self.assertRaises(IOError, epa.clean._load_data_file, 'pm25', 2020)
 
 
+class LoadZipDataTestCase(unittest.TestCase):
+    """
+    Test that data files are read straight out of their ZIP archives when
+    they have not been extracted.
+    """
+
+    def setUp(self):
+        """ Build a temporary data directory holding one ZIP archive. """
+        self.saved_root = epa.clean.NO2_DATA_ROOT
+        epa.clean.NO2_DATA_ROOT = tempfile.mkdtemp()
+        self.lines = ['header\n',
+                      '01,073,0023,42602,1,33.5,-86.8,WGS84,NO2,1 HOUR,'
+                      'NO2 1-hour,2001-02-03,ppb,None,24,100.0,12.5,20.0\n']
+        path = os.path.join(epa.clean.NO2_DATA_ROOT, 'daily_42602_2001.zip')
+        archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('daily_42602_2001.csv', ''.join(self.lines))
+        archive.close()
+
+    def tearDown(self):
+        """ Restore the no2 data directory root. """
+        shutil.rmtree(epa.clean.NO2_DATA_ROOT)
+        epa.clean.NO2_DATA_ROOT = self.saved_root
+
+    def test_load_zip_file(self):
+        """ Test loading and parsing a data file from its archive. """
+        self.assertTrue(
+            epa.clean._data_file_path('no2', 2001).endswith('.zip'))
+        no2_file = epa.clean._load_data_file('no2', 2001)
+        self.assertEqual(list(no2_file), self.lines)
+        no2_file.close()
+
+        records = epa.clean.read_data_file('no2', 2001)
+        self.assertEqual(records, [{'longitude': '-86.8',
+                                    'latitude': '33.5',
+                                    'month': 134,
+                                    'day': 3,
+                                    'mean': 12.5,
+                                    'max': 20.0}])
+
+    def test_extracted_file_preferred(self):
+        """ Test that an extracted CSV file is read before its archive. """
+        path = os.path.join(epa.clean.NO2_DATA_ROOT, 'daily_42602_2001.csv')
+        with open(path, 'w') as outfile:
+            outfile.writelines(self.lines)
+        self.assertEqual(epa.clean._data_file_path('no2', 2001), path)
+        no2_file = epa.clean._load_data_file('no2', 2001)
+        self.assertIsInstance(no2_file, file)
+        no2_file.close()
+
+
+class ParseDailyRecordTestCase(unittest.TestCase):
+    """ Test that epa.clean._parse_daily_record() performs correctly. """
+
+    def test_parse_daily_record(self):
+        """ Test parsing a record in the AQS daily CSV layout. """
+        record = ['01', '073', '0023', '44201', '1', '33.553056',
+                  '-86.815', 'WGS84', 'Ozone', '8-HR RUN AVG BEGIN HOUR',
+                  'Ozone 8-hour 2008', '1997-03-09', 'Parts per million',
+                  'None', '17', '100.0', '0.031588', '0.038', '10', '35',
+                  '087', 'INSTRUMENTAL - ULTRA VIOLET', 'North Birmingham']
+        result = epa.clean._parse_daily_record(record)
+        self.assertEqual(result, {'longitude': '-86.815',
+                                  'latitude': '33.553056',
+                                  'month': 12 * 7 + 3,
+                                  'day': 9,
+                                  'mean': 0.031588,
+                                  'max': 0.038})
+
+        # Months are counted from 1 in January, 1990.
+        record[11] = '1990-01-31'
+        self.assertEqual(epa.clean._parse_daily_record(record)['month'], 1)
+        record[11] = '2015-12-01'
+        self.assertEqual(epa.clean._parse_daily_record(record)['month'], 312)
+
+
 class AggregateDayDuplicatesTestCase(unittest.TestCase):
     """ Test that epa.clean.agg_day_duplicates() performs correctly. """
 
@@ -139,6 +220,16 @@ class AggregateDayDuplicatesTestCase(unittest.TestCase):
             total_len += len(group)
         self.assertEquals(total_len, len(self.records))
 
+    def test_agg_site_months(self):
+        """
+        Test that the fused epa.clean.agg_site_months() aggregation agrees
+        with agg_by_month(agg_day_duplicates()) on the chosen data file.
+        """
+        expected = epa.clean.agg_by_month(
+            epa.clean.agg_day_duplicates(self.records))
+        result = epa.clean.agg_site_months(self.records)
+        self.assertEqual(result, expected)
+
     def test_agg_day_duplicates(self):
         """
         Establish a record list fixture and apply epa.clean.agg_day_duplicates
@@ -305,3 +396,209 @@ class AggregateDayDuplicatesTestCase(unittest.TestCase):
         self.assertEqual(result[3]['mean'], 7.5)
         self.assertEqual(result[3]['max'], 10.0)
         self.assertNotIn('day', result[3].keys())
+
+
+class StreamingAggregationTestCase(unittest.TestCase):
+    """
+    Test that the aggregation routines in epa.clean consume iterators of
+    records without modifying them.
+    """
+
+    def setUp(self):
+        """ Establish a record list fixture with day duplicates. """
+        self.records = [{'day': 3,
+                         'latitude': '35.0',
+                         'longitude': '30.0',
+                         'max': 10.0,
+                         'mean': 5.0,
+                         'month': 3},
+                        {'day': 3,
+                         'latitude': '35.0',
+                         'longitude': '30.0',
+                         'max': 1.0,
+                         'mean': 10.0,
+                         'month': 3},
+                        {'day': 4,
+                         'latitude': '35.0',
+                         'longitude': '30.0',
+                         'max': 2.0,
+                         'mean': 2.5,
+                         'month': 3},
+                        {'day': 1,
+                         'latitude': '15.0',
+                         'longitude': '10.0',
+                         'max': 4.0,
+                         'mean': 1.0,
+                         'month': 1}]
+
+    def test_agg_day_duplicates_iterator(self):
+        """ Test agg_day_duplicates() on a generator of records. """
+        result = epa.clean.agg_day_duplicates(r for r in self.records)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(result[0]['longitude'], '10.0')
+        self.assertEqual(result[1]['mean'], 7.5)
+        self.assertEqual(result[1]['max'], 10.0)
+        self.assertEqual(result[2]['mean'], 2.5)
+
+        # The input records must be left as they were.
+        for rec in self.records:
+            self.assertIn('day', rec.keys())
+
+    def test_agg_by_month_iterator(self):
+        """ Test agg_by_month() on the output of agg_day_duplicates(). """
+        days = epa.clean.agg_day_duplicates(iter(self.records))
+        result = epa.clean.agg_by_month(iter(days))
+        self.assertEqual(len(result), 2)
+        self.assertEqual(result[0]['month'], 1)
+        self.assertEqual(result[0]['mean'], 1.0)
+        self.assertEqual(result[1]['month'], 3)
+        self.assertEqual(result[1]['mean'], 5.0)
+        self.assertEqual(result[1]['max'], 10.0)
+
+    def test_agg_site_months_iterator(self):
+        """ Test agg_site_months() against the two-stage aggregation. """
+        expected = epa.clean.agg_by_month(
+            epa.clean.agg_day_duplicates(self.records))
+        result = epa.clean.agg_site_months(iter(self.records))
+        self.assertEqual(result, expected)
+        self.assertEqual(len(result), 2)
+
+    def test_agg_site_months_external(self):
+        """ Test that spilling to disk does not change the aggregation. """
+        expected = epa.clean.agg_site_months(self.records)
+        for buffer_size in (1, 2, 100):
+            result = epa.clean.agg_site_months_external(iter(self.records),
+                                                        buffer_size)
+            self.assertEqual(list(result), expected)
+
+
+class JoinSiteMonthsTestCase(unittest.TestCase):
+    """ Test that epa.clean.join_site_months() performs correctly. """
+
+    def test_join_site_months(self):
+        """ Test joining sorted streams with missing site-months. """
+        no2 = [(('10.0', '15.0', 1), '2.0', '1.0'),
+               (('20.0', '25.0', 2), '4.0', '3.0')]
+        ozone = []
+        pm25 = [(('10.0', '15.0', 1), '6.0', '5.0'),
+                (('10.0', '15.0', 2), '8.0', '7.0')]
+        result = list(epa.clean.join_site_months([iter(no2), iter(ozone),
+                                                  iter(pm25)]))
+        self.assertEqual(result,
+                         [['10.0', '15.0', 1, '2.0', '1.0', '', '', '6.0',
+                           '5.0'],
+                          ['10.0', '15.0', 2, '', '', '', '', '8.0', '7.0'],
+                          ['20.0', '25.0', 2, '4.0', '3.0', '', '', '', '']])
+        self.assertEqual(len(result[0]), len(epa.clean.JOINED_FIELDS))
+
+
+class IncrementalCleaningTestCase(DataRootMixin, unittest.TestCase):
+    """
+    Test that epa.clean.update_clean_data() only re-cleans raw data files
+    that have changed, and never duplicates output records.
+    """
+
+    def setUp(self):
+        """ Build a temporary data directory with two raw ozone files. """
+        self.patch_data_roots()
+        os.mkdir(epa.clean.OZONE_DATA_ROOT)
+        self.specs = [('ozone', 1995), ('ozone', 1996)]
+        self.write_raw_file(1995, ['1995-01-02', '1995-01-03'])
+        self.write_raw_file(1996, ['1996-05-02'])
+
+    def tearDown(self):
+        """ Restore the data directory roots. """
+        self.restore_data_roots()
+
+    def write_raw_file(self, year, dates):
+        """ Write a raw ozone file holding one record for each date. """
+        path = epa.clean._data_file_path('ozone', year)
+        with open(path, 'w') as outfile:
+            outfile.write('header\n')
+            for date_local in dates:
+                outfile.write(raw_ozone_record(date_local))
+
+    def read_output(self):
+        """ Return the lines of the clean ozone output file. """
+        with open(epa.clean._output_path('ozone'), 'r') as infile:
+            return infile.readlines()
+
+    def test_update_clean_data(self):
+        """ Test that only new or changed raw files are cleaned. """
+        self.assertEqual(epa.clean.update_clean_data(self.specs),
+                         self.specs)
+        self.assertEqual(len(self.read_output()), 2)
+        manifest = epa.clean.load_manifest()
+        self.assertEqual(sorted(manifest.keys()), ['ozone/1995',
+                                                   'ozone/1996'])
+
+        # A repeated run does no work and does not duplicate records.
+        self.assertEqual(epa.clean.update_clean_data(self.specs), [])
+        self.assertEqual(len(self.read_output()), 2)
+
+        # Only the changed year is cleaned again.
+        self.write_raw_file(1996, ['1996-05-02', '1996-06-02'])
+        self.assertEqual(epa.clean.update_clean_data(self.specs),
+                         [('ozone', 1996)])
+        output = self.read_output()
+        self.assertEqual(len(output), 3)
+        self.assertTrue(output[0].startswith('-86.8,33.5,61,'))
+
+        # Unless every year is forced.
+        self.assertEqual(epa.clean.update_clean_data(self.specs, force=True),
+                         self.specs)
+        self.assertEqual(len(self.read_output()), 3)
+
+    def test_columnar_output(self):
+        """ Test the binary columnar file written next to the CSV file. """
+        epa.clean.update_clean_data(self.specs)
+        with open(epa.clean._output_path('ozone', '.bin'), 'rb') as infile:
+            data = infile.read()
+        magic, count = struct.unpack_from('<8sQ', data, 0)
+        self.assertEqual(magic, epa.clean.COLUMNAR_MAGIC)
+        self.assertEqual(count, 2)
+        self.assertEqual(len(data), 16 + 5 * 8 * count)
+
+        # Columns follow the header in the order of COLUMNAR_FIELDS.
+        columns = struct.unpack_from('<10d', data, 16)
+        self.assertEqual(columns, (-86.8, -86.8, 33.5, 33.5, 61.0, 77.0,
+                                   0.04, 0.04, 0.03, 0.03))
+
+    def test_joined_output(self):
+        """ Test the joined output file of all pollutants. """
+        epa.clean.update_clean_data(self.specs, joined=True)
+        with open(epa.clean._output_path('joined'), 'r') as infile:
+            output = infile.readlines()
+        self.assertEqual(output, ['-86.8,33.5,61,,,0.04,0.03,,\r\n',
+                                  '-86.8,33.5,77,,,0.04,0.03,,\r\n'])
+
+    def test_parallel_workers(self):
+        """ Test that cleaning in worker processes matches a serial run. """
+        self.assertEqual(epa.clean.update_clean_data(self.specs), self.specs)
+        serial = self.read_output()
+        with open(epa.clean._output_path('ozone', '.bin'), 'rb') as infile:
+            serial_columns = infile.read()
+
+        self.assertEqual(epa.clean.update_clean_data(self.specs, workers=2,
+                                                     force=True),
+                         self.specs)
+        self.assertEqual(self.read_output(), serial)
+        with open(epa.clean._output_path('ozone', '.bin'), 'rb') as infile:
+            self.assertEqual(infile.read(), serial_columns)
+        manifest = epa.clean.load_manifest()
+        self.assertEqual(sorted(manifest.keys()), ['ozone/1995',
+                                                   'ozone/1996'])
+        self.assertEqual(epa.clean.update_clean_data(self.specs, workers=2),
+                         [])
+
+    def test_deleted_raw_file(self):
+        """ Test that a shard outlives the raw file it was cleaned from. """
+        epa.clean.update_clean_data(self.specs)
+        os.remove(epa.clean._data_file_path('ozone', 1995))
+        self.assertEqual(epa.clean.update_clean_data(self.specs), [])
+        self.assertEqual(len(self.read_output()), 2)
+
+        # A raw file that was never cleaned is still an error.
+        os.remove(epa.clean._data_file_path('ozone', 1996))
+        os.remove(epa.clean._shard_path('ozone', 1996))
+        self.assertRaises(OSError, epa.clean.update_clean_data, self.specs)
@@ -0,0 +1,128 @@
+"""
+Test the epa/download.py module.
+
+This module provides unit tests that ensure that archives are downloaded,
+resumed, verified and cached correctly.  A local HTTP server stands in for
+the EPA site.
+"""
+
+
+import hashlib
+import os.path
+import unittest
+
+import epa.clean
+import epa.download
+
+from test.helpers import ArchiveServerMixin, DataRootMixin, make_archive
+
+
+class DownloadTestCase(ArchiveServerMixin, DataRootMixin,
+                       unittest.TestCase):
+    """ Test that epa.download fetches archives correctly. """
+
+    def setUp(self):
+        """ Start a local HTTP server and point epa.clean at a temp dir. """
+        self.start_server('/airdata/')
+        for year in (2001, 2002):
+            name = 'daily_42602_' + str(year) + '.zip'
+            self.server.files[name] = make_archive(
+                name.replace('.zip', '.csv'), 'header\n' + 'x,' * 5000)
+        self.patch_data_roots()
+        self.path = epa.clean.archive_path('no2', 2001)
+        self.url = self.base_url + 'daily_42602_2001.zip'
+
+    def tearDown(self):
+        """ Stop the server and restore the data directory roots. """
+        self.stop_server()
+        self.restore_data_roots()
+
+    def read(self, path):
+        """ Return the contents of the file at path. """
+        with open(path, 'rb') as infile:
+            return infile.read()
+
+    def test_iter_downloads(self):
+        """ Test downloading several archives, then skipping them. """
+        specs = [('no2', 2001), ('no2', 2002)]
+        results = sorted(epa.download.iter_downloads(specs, self.base_url,
+                                                     workers=2))
+        self.assertEqual(results, [(('no2', 2001), True, None),
+                                   (('no2', 2002), True, None)])
+        for spec in specs:
+            path = epa.clean.archive_path(*spec)
+            self.assertEqual(self.read(path),
+                             self.server.files[os.path.basename(path)])
+
+        # Archives that are present are not fetched again.
+        del self.server.requests[:]
+        results = sorted(epa.download.iter_downloads(specs, self.base_url))
+        self.assertEqual(results, [(('no2', 2001), False, None),
+                                   (('no2', 2002), False, None)])
+        self.assertEqual(self.server.requests, [])
+
+        # A missing archive is reported rather than raised.
+        results = list(epa.download.iter_downloads([('no2', 2003)],
+                                                   self.base_url))
+        self.assertEqual(len(results), 1)
+        self.assertEqual(results[0][2].code, 404)
+
+    def test_resume_partial_download(self):
+        """ Test that a partial download is resumed with a range request. """
+        body = self.server.files['daily_42602_2001.zip']
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path + epa.download.PART_SUFFIX, 'wb') as outfile:
+            outfile.write(body[:100])
+
+        self.assertTrue(epa.download.download_file(self.url, self.path))
+        self.assertEqual(self.read(self.path), body)
+        self.assertEqual(self.server.requests,
+                         [('daily_42602_2001.zip', 'bytes=100-')])
+        self.assertFalse(os.path.exists(self.path + epa.download.PART_SUFFIX))
+
+    def test_retry_truncated_download(self):
+        """ Test that a truncated response is resumed on the next try. """
+        body = self.server.files['daily_42602_2001.zip']
+        self.server.truncate.add('daily_42602_2001.zip')
+        os.makedirs(os.path.dirname(self.path))
+
+        self.assertTrue(epa.download.download_file(self.url, self.path))
+        self.assertEqual(self.read(self.path), body)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[0][1], None)
+        self.assertEqual(self.server.requests[1][1],
+                         'bytes=' + str(len(body) // 2) + '-')
+
+    def test_verify_checksum(self):
+        """ Test that a download must match its checksum. """
+        body = self.server.files['daily_42602_2001.zip']
+        os.makedirs(os.path.dirname(self.path))
+        self.assertRaises(IOError, epa.download.download_file, self.url,
+                          self.path, '0' * 40)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + epa.download.PART_SUFFIX))
+
+        checksum = hashlib.sha1(body).hexdigest()
+        self.assertTrue(epa.download.download_file(self.url, self.path,
+                                                   checksum))
+        self.assertFalse(epa.download.download_file(self.url, self.path,
+                                                    checksum))
+
+    def test_replace_corrupt_archive(self):
+        """ Test that a corrupt archive that is present is fetched again. """
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as outfile:
+            outfile.write('not a zip file')
+        self.assertTrue(epa.download.download_file(self.url, self.path))
+        self.assertEqual(self.read(self.path),
+                         self.server.files['daily_42602_2001.zip'])
+
+    def test_skip_extracted_archive(self):
+        """ Test that an archive whose CSV file was extracted is skipped. """
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path.replace('.zip', '.csv'), 'w') as outfile:
+            outfile.write('header\n')
+        results = list(epa.download.iter_downloads([('no2', 2001)],
+                                                   self.base_url))
+        self.assertEqual(results, [(('no2', 2001), False, None)])
+        self.assertEqual(self.server.requests, [])
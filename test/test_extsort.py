@@ -0,0 +1,83 @@
+"""
+Test the epa/extsort.py module.
+
+This module provides unit tests that ensure that iterables are sorted
+correctly, whether or not they spill to disk.
+"""
+
+
+import random
+import tempfile
+import unittest
+
+import epa.extsort
+
+
+class ExternalSortedTestCase(unittest.TestCase):
+    """ Test that epa.extsort.external_sorted() performs correctly. """
+
+    def setUp(self):
+        """ Count the run files created by external_sorted(). """
+        self.run_files = []
+        self.max_open = 0
+        self.saved_temporary_file = tempfile.TemporaryFile
+
+        def temporary_file(*args, **kwargs):
+            """ Record and return a new temporary file. """
+            run_file = self.saved_temporary_file(*args, **kwargs)
+            self.run_files.append(run_file)
+            self.max_open = max(self.max_open,
+                                len([f for f in self.run_files
+                                     if not f.closed]))
+            return run_file
+        tempfile.TemporaryFile = temporary_file
+
+        random.seed(0)
+        self.items = [{'key': random.randint(0, 20), 'index': i}
+                      for i in range(500)]
+
+    def tearDown(self):
+        """ Restore tempfile.TemporaryFile(). """
+        tempfile.TemporaryFile = self.saved_temporary_file
+
+    def key_func(self, item):
+        """ Return the sort key of an item. """
+        return item['key']
+
+    def test_sort_in_memory(self):
+        """ Test sorting an iterable that fits in a single run. """
+        result = list(epa.extsort.external_sorted(iter(self.items),
+                                                  self.key_func, 1000))
+        self.assertEqual(result, sorted(self.items, key=self.key_func))
+        self.assertEqual(self.run_files, [])
+
+    def test_sort_spilled(self):
+        """ Test that a tiny buffer spills runs and still sorts stably. """
+        result = list(epa.extsort.external_sorted(iter(self.items),
+                                                  self.key_func, 7))
+        self.assertEqual(result, sorted(self.items, key=self.key_func))
+        # The first MERGE_FAN_IN runs are merged into one along the way.
+        self.assertEqual(len(self.run_files), 500 // 7 + 1)
+        for run_file in self.run_files:
+            self.assertTrue(run_file.closed)
+
+    def test_sort_empty(self):
+        """ Test sorting an empty iterable. """
+        self.assertEqual(list(epa.extsort.external_sorted([], abs, 1)), [])
+        self.assertRaises(ValueError, list,
+                          epa.extsort.external_sorted([1], abs, 0))
+
+    def test_open_files_bounded(self):
+        """ Test that merging along the way bounds the open run files. """
+        items = self.items * 4
+        result = list(epa.extsort.external_sorted(iter(items),
+                                                  self.key_func, 2, 4))
+        self.assertEqual(result, sorted(items, key=self.key_func))
+
+        # 1000 runs are merged in 5 levels of at most 4 runs, plus the run
+        # being written.
+        self.assertTrue(self.max_open <= 4 * 5 + 1)
+        for run_file in self.run_files:
+            self.assertTrue(run_file.closed)
+        self.assertRaises(ValueError, list,
+                          epa.extsort.external_sorted([1], abs, 1, 1))
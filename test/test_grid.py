@@ -0,0 +1,45 @@
+"""
+Test the spark_job/grid.py module.
+
+This module provides unit tests that check the neighbor searches of the
+grid index against a brute force search, with cells of several shapes.
+"""
+
+
+import os.path
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'spark_job'))
+
+import grid
+
+from test.test_kdtree import NeighborSearchTests
+
+
+class GridIndexTestCase(NeighborSearchTests, unittest.TestCase):
+    """ Test that grid.GridIndex performs correctly. """
+
+    def build(self, points):
+        """ Return a GridIndex of points with cubic cells. """
+        return grid.GridIndex(points, 1.0)
+
+    def test_cell_shapes(self):
+        """ Test cells that are much smaller and larger than the lattice. """
+        for cell_size, months in ((0.3, None), (0.5, 12), (4.0, None),
+                                  (100.0, 1)):
+            self.engine = grid.GridIndex(self.points, cell_size,
+                                         months=months)
+            self.test_query()
+            self.test_query_radius()
+
+    def test_cells(self):
+        """ Test that the cells hold every point once. """
+        self.assertEqual(sum(end - start for start, end in
+                             self.engine.cells.values()), self.COUNT)
+        self.assertEqual(sorted(self.engine.indices), range(self.COUNT))
+        for key, (start, end) in self.engine.cells.items():
+            for position in range(start, end):
+                self.assertEqual(self.engine.cell(
+                    self.engine.location(position)), key)
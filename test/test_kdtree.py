@@ -0,0 +1,233 @@
+"""
+Test the spark_job/kdtree.py module.
+
+This module provides unit tests that check every neighbor search of the
+KD-trees against a brute force search, on points with many ties and
+duplicates.
+"""
+
+
+import cPickle
+import math
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'spark_job'))
+
+import kdtree
+import point
+
+
+def make_points(count, seed=0):
+    """
+    Return a list of count Points on a small lattice, so that many of them
+    are at equal distances or share a location.  The maximum and mean of
+    each Point hold its position in the list.
+    """
+    rand = random.Random(seed)
+    return [point.Point(longitude=rand.randint(0, 5),
+                        latitude=rand.randint(0, 5),
+                        month=rand.randint(1, 6),
+                        maximum=i, mean=-i).scale_time(0.5)
+            for i in range(count)]
+
+def make_queries(points, count, seed=1):
+    """
+    Return a list of count query Points, half of them at the locations of
+    points and half of them scattered in and around the lattice.
+    """
+    rand = random.Random(seed)
+    queries = [point.Point(longitude=p.longitude, latitude=p.latitude,
+                           month=p.month, maximum=0, mean=0).scale_time(0.5)
+               for p in rand.sample(points, count // 2)]
+    queries.extend(point.Point(longitude=rand.uniform(-3.0, 9.0),
+                               latitude=rand.uniform(-3.0, 9.0),
+                               month=rand.uniform(-2.0, 10.0),
+                               maximum=0, mean=0).scale_time(0.5)
+                   for _ in range(count - count // 2))
+    return queries
+
+def brute_force(points, query, k=None, r=None):
+    """
+    Return a list of "(squared_distance, index)" pairs for the k points
+    nearest to query, or all of them, leaving out any farther than r from
+    it.  Points at equal distances are taken in the order given.
+    """
+    entries = sorted((kdtree._squared_distance(query.location(),
+                                               p.location()), i)
+                     for i, p in enumerate(points))
+    if r is not None:
+        entries = [entry for entry in entries if entry[0] <= r * r]
+    return entries[:k]
+
+
+class NeighborSearchTests(object):
+    """
+    Tests of query(), query_radius() and query_many() that are shared by
+    every neighbor search engine.  Subclasses provide build().
+    """
+
+    # Number of points searched, and number of queries.
+    COUNT = 300
+    QUERIES = 60
+
+    def setUp(self):
+        """ Build the engine under test from a set of points. """
+        self.points = make_points(self.COUNT)
+        self.queries = make_queries(self.points, self.QUERIES)
+        self.engine = self.build(self.points)
+
+    def build(self, points):
+        """ Return the engine under test for points. """
+        raise NotImplementedError
+
+    def found(self, neighbors):
+        """ Return the indices of a list of neighbors. """
+        return [int(n.max) for n in neighbors]
+
+    def test_query(self):
+        """ Test k nearest neighbor queries. """
+        for k in (1, 3, 10, self.COUNT + 5):
+            for q in self.queries:
+                expected = [i for _, i in brute_force(self.points, q, k)]
+                self.assertEqual(self.found(self.engine.query(q, k)),
+                                 expected)
+
+    def test_query_radius(self):
+        """ Test queries for the neighbors within a radius. """
+        for r in (0.0, 1.0, 2.5):
+            for k in (None, 2):
+                for q in self.queries:
+                    expected = [i for _, i in brute_force(self.points, q, k,
+                                                          r)]
+                    self.assertEqual(
+                        self.found(self.engine.query_radius(q, r, k)),
+                        expected)
+
+    def test_query_many(self):
+        """ Test batched k nearest neighbor queries. """
+        for k in (1, 3, self.COUNT + 5):
+            indices, distances = self.engine.query_many(self.queries, k)
+            width = min(k, self.COUNT)
+            self.assertEqual(len(indices), width * len(self.queries))
+            self.assertEqual(len(distances), width * len(self.queries))
+            for row, q in enumerate(self.queries):
+                expected = brute_force(self.points, q, k)
+                start = row * width
+                self.assertEqual(list(indices[start:start + width]),
+                                 [i for _, i in expected])
+                for distance, (squared_distance, _) in zip(
+                        distances[start:start + width], expected):
+                    self.assertAlmostEqual(distance,
+                                           math.sqrt(squared_distance))
+
+
+class KDTreeTestCase(NeighborSearchTests, unittest.TestCase):
+    """ Test that kdtree.KDTree performs correctly. """
+
+    def build(self, points):
+        """ Return a KDTree of points. """
+        return kdtree.KDTree(list(points))
+
+    def test_add(self):
+        """ Test a tree grown one point at a time. """
+        self.engine = self.build(self.points[:self.COUNT // 2])
+        for p in self.points[self.COUNT // 2:]:
+            self.engine.add(p)
+        self.assertEqual(len(self.engine), self.COUNT)
+        self.test_query()
+
+    def test_query_nodes(self):
+        """ Test that the nodes found know their position. """
+        for q in self.queries:
+            self.assertEqual([node.index for node in self.engine.query(q, 5)],
+                             [i for _, i in brute_force(self.points, q, 5)])
+
+
+class FlatKDTreeTestCase(NeighborSearchTests, unittest.TestCase):
+    """ Test that kdtree.FlatKDTree performs correctly. """
+
+    def build(self, points):
+        """ Return a FlatKDTree of points with small leaves. """
+        return kdtree.FlatKDTree(points, leaf_size=4)
+
+    def test_leaf_sizes(self):
+        """ Test trees with a range of leaf sizes. """
+        for leaf_size in (1, 16, self.COUNT):
+            self.engine = kdtree.FlatKDTree(self.points, leaf_size)
+            self.test_query()
+
+
+class MappedKDTreeTestCase(NeighborSearchTests, unittest.TestCase):
+    """ Test that a kdtree.MappedKDTree answers as the tree it saved. """
+
+    def setUp(self):
+        """ Make a directory for the tree files. """
+        self.tree_dir = tempfile.mkdtemp()
+        NeighborSearchTests.setUp(self)
+
+    def tearDown(self):
+        """ Close the trees and remove their files. """
+        self.engine.close()
+        for path, tree in kdtree._OPEN_TREES.items():
+            if path.startswith(self.tree_dir):
+                tree.close()
+                del kdtree._OPEN_TREES[path]
+        shutil.rmtree(self.tree_dir)
+
+    def build(self, points):
+        """ Return a MappedKDTree opened from a saved FlatKDTree. """
+        path = os.path.join(self.tree_dir, 'tree.kdt')
+        kdtree.FlatKDTree(points, leaf_size=4).save(path)
+        return kdtree.MappedKDTree(path)
+
+    def test_pickle(self):
+        """ Test that a MappedKDTree pickles as its path. """
+        pickled = cPickle.dumps(self.engine, 2)
+        self.assertTrue(len(pickled) < 1000)
+        tree = cPickle.loads(pickled)
+        try:
+            self.assertEqual(len(tree), self.COUNT)
+            self.assertEqual(list(tree.values), list(self.engine.values))
+            q = self.queries[0]
+            self.assertEqual(self.found(tree.query(q, 5)),
+                             self.found(self.engine.query(q, 5)))
+        finally:
+            tree.close()
+
+    def test_open_tree(self):
+        """ Test that a tree file is opened once per process. """
+        path = self.engine.path
+        self.assertTrue(kdtree.open_tree(path) is kdtree.open_tree(path))
+
+    def test_bad_file(self):
+        """ Test that a file of another kind is refused. """
+        path = os.path.join(self.tree_dir, 'bad.kdt')
+        with open(path, 'wb') as bad_file:
+            bad_file.write('not a tree' * 10)
+        self.assertRaises(IOError, kdtree.MappedKDTree, path)
+
+
+class KDForestTestCase(NeighborSearchTests, unittest.TestCase):
+    """ Test that kdtree.KDForest performs correctly. """
+
+    def build(self, points):
+        """ Return a KDForest of points added in batches and one by one. """
+        forest = kdtree.KDForest(points[:50], leaf_size=4, buffer_size=16)
+        forest.add_all(points[50:120])
+        for p in points[120:]:
+            forest.add(p)
+        return forest
+
+    def test_forest_shape(self):
+        """ Test that the forest holds every point in a few trees. """
+        self.assertEqual(len(self.engine), self.COUNT)
+        self.assertEqual(sum(len(tree) for tree, _ in self.engine.trees) +
+                         len(self.engine.buffer), self.COUNT)
+        self.assertTrue(len(self.engine.trees) <= 8)
+        self.assertTrue(len(self.engine.buffer) < 16)
@@ -0,0 +1,182 @@
+"""
+Test the spark_job/kfold.py module.
+
+This module provides unit tests that ensure that the neighbor searches and
+the cross validation of kfold perform correctly.
+"""
+
+
+import math
+import os.path
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'spark_job'))
+
+import kdtree
+import kfold
+import point
+
+
+def make_point(longitude, latitude, month, maximum, mean):
+    """ Return a Point with the given fields. """
+    return point.Point(longitude=longitude, latitude=latitude, month=month,
+                       maximum=maximum, mean=mean)
+
+def make_point_set(count, seed=0):
+    """
+    Return a PointSet of count points scattered over a few stations and
+    months, with positive maximums and means.
+    """
+    rand = random.Random(seed)
+    return point.PointSet.from_points(
+        [make_point(rand.randint(0, 4), rand.randint(0, 4),
+                    rand.randint(1, 12), rand.uniform(0.01, 0.1),
+                    rand.uniform(0.01, 0.1))
+         for _ in range(count)])
+
+
+class RadiusNeighborsTestCase(unittest.TestCase):
+    """ Test that kfold.radius_neighbors() performs correctly. """
+
+    def setUp(self):
+        """ Build a KDTree of four points along a line. """
+        self.points = [make_point(i, 0, 0, i, -i).scale_time(1.0)
+                       for i in range(4)]
+        self.tree = kdtree.KDTree(list(self.points))
+        self.query = make_point(-0.4, 0, 0, 0, 0).scale_time(1.0)
+
+    def found(self, nodes):
+        """ Return the maximums of a list of nodes. """
+        return [n.max for n in nodes]
+
+    def test_within_radius(self):
+        """ Test that the nodes within the radius are found. """
+        conf = kfold.KFoldConf(10, None, 1.0, 1.5, 1.0, 0.75, 1)
+        self.assertEqual(
+            self.found(kfold.radius_neighbors(conf, self.tree, self.query)),
+            [0.0, 1.0])
+        conf.neighbors = 1
+        self.assertEqual(
+            self.found(kfold.radius_neighbors(conf, self.tree, self.query)),
+            [0.0])
+
+    def test_fallback(self):
+        """ Test that the nearest nodes are used when none are in range. """
+        conf = kfold.KFoldConf(10, 3, 1.0, 0.1, 1.0, 0.75, 1)
+        self.assertEqual(
+            self.found(kfold.radius_neighbors(conf, self.tree, self.query)),
+            [0.0, 1.0, 2.0])
+        conf.neighbors = None
+        self.assertEqual(
+            self.found(kfold.radius_neighbors(conf, self.tree, self.query)),
+            [0.0])
+
+
+class Broadcast(object):
+    """ A stand-in for a Spark broadcast variable. """
+
+    def __init__(self, value):
+        """ Hold the broadcast value. """
+        self.value = value
+
+
+class HandComputedTestCase(unittest.TestCase):
+    """
+    Test kfold.evaluate() against statistics worked out by hand.  Bags are
+    the whole training set, so each estimate is the value of the nearest
+    training point.
+    """
+
+    def setUp(self):
+        """ Make every bag a copy of the training set. """
+        self.sample_with_replacement = kfold.sample_with_replacement
+        kfold.sample_with_replacement = lambda population, k: list(
+            population)
+        self.conf = kfold.KFoldConf(2, 1, 1.0, None, 1.0, 1.0, 1)
+
+    def tearDown(self):
+        """ Restore the sampling of bags. """
+        kfold.sample_with_replacement = self.sample_with_replacement
+
+    def evaluate(self, maximums, metrics):
+        """
+        Return the statistics of the max target for points along a line,
+        at 0, 1, 10, 11 and 20, with the given maximums.
+        """
+        points = point.PointSet.from_points(
+            [make_point(x, 0, 0, maximum, 1.0)
+             for x, maximum in zip([0, 1, 10, 11, 20], maximums)])
+        (results,) = kfold.evaluate(self.conf, points, metrics, ['max'])
+        return results
+
+    def test_metrics(self):
+        """ Test each statistic of two folds of two points. """
+        # Fold 0 estimates 1 and 4 as 2 and 5, fold 1 estimates 2 and 5 as
+        # 1 and 4.
+        mare, rmspe, mae, rmse, bias = self.evaluate(
+            [1.0, 2.0, 4.0, 5.0], ['mare', 'rmspe', 'mae', 'rmse', 'bias'])
+        self.assertAlmostEqual(mare, ((1.0 + 0.25) / 2 + (0.5 + 0.2) / 2) / 2)
+        self.assertAlmostEqual(
+            rmspe, (math.sqrt((1.0 + 0.0625) / 2) * 100 +
+                    math.sqrt((0.25 + 0.04) / 2) * 100) / 2)
+        self.assertAlmostEqual(mae, 1.0)
+        self.assertAlmostEqual(rmse, 1.0)
+        self.assertAlmostEqual(bias, 0.0)
+
+    def test_fold_averages(self):
+        """ Test that each fold contributes the average over its points. """
+        # Fold 0 estimates 1, 4 and 16 as 2, 8 and 8, with errors 1, 4 and
+        # -8.  Fold 1 estimates 2 and 8 as 1 and 4, with errors -1 and -4.
+        mae, bias = self.evaluate([1.0, 2.0, 4.0, 8.0, 16.0],
+                                  ['mae', 'bias'])
+        self.assertAlmostEqual(mae, (13.0 / 3 + 5.0 / 2) / 2)
+        self.assertAlmostEqual(bias, (-3.0 / 3 + -5.0 / 2) / 2)
+
+
+class EvaluateTestCase(unittest.TestCase):
+    """ Test that kfold.evaluate() performs correctly. """
+
+    def setUp(self):
+        """ Build a PointSet and a configuration to evaluate it with. """
+        self.points = make_point_set(60)
+        self.conf = kfold.KFoldConf(5, 3, 2.0, None, 0.5, 0.75, 2)
+
+    def evaluate(self, metrics, targets, seed=1):
+        """ Return the results of evaluate() with the given seed. """
+        random.seed(seed)
+        return kfold.evaluate(self.conf, self.points, metrics, targets)
+
+    def test_targets(self):
+        """ Test that both targets match the runs of each one alone. """
+        metrics = sorted(kfold.METRICS)
+        self.assertEqual(self.evaluate(metrics, point.TARGETS),
+                         [self.evaluate(metrics, [target])[0]
+                          for target in point.TARGETS])
+
+    def test_one_target(self):
+        """ Test the statistics of the mean target alone. """
+        results = self.evaluate(['mare', 'rmspe'], ['mean'])
+        self.assertEqual(len(results), 1)
+        self.assertEqual(len(results[0]), 2)
+        self.assertTrue(all(result > 0.0 for result in results[0]))
+
+    def test_no_metrics(self):
+        """ Test that no statistics give an empty list for each target. """
+        self.assertEqual(self.evaluate([], point.TARGETS), [[], []])
+
+    def test_mare_rmspe(self):
+        """ Test that mare() and rmspe() match evaluate() as floats. """
+        for target in point.TARGETS:
+            (expected_mare, expected_rmspe), = self.evaluate(
+                ['mare', 'rmspe'], [target])
+            random.seed(1)
+            result = kfold.mare(self.conf, Broadcast(self.points), target)
+            self.assertTrue(isinstance(result, float))
+            self.assertEqual(result, expected_mare)
+            random.seed(1)
+            result = kfold.rmspe(self.conf, Broadcast(self.points), target)
+            self.assertTrue(isinstance(result, float))
+            self.assertEqual(result, expected_rmspe)
@@ -0,0 +1,70 @@
+"""
+Test the spark_job/partition.py module.
+
+This module provides unit tests that ensure that the CSV and binary
+columnar partitions hold the same records in the same order.
+"""
+
+
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'spark_job'))
+
+import epa.clean
+import partition
+import point
+
+
+class WriteRecordsTestCase(unittest.TestCase):
+    """ Test that partition.write_records() performs correctly. """
+
+    def setUp(self):
+        """ Write a clean CSV file and its columnar file to a temp dir. """
+        self.cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        os.mkdir('partitions')
+        os.mkdir('clean')
+        self.rows = [[str(i), str(-i), str(i % 12 + 1), str(0.001 * i),
+                      str(0.002 * i)] for i in range(1, 41)]
+        self.csv_path = os.path.join('clean', 'monthly_ozone_1990-2015.csv')
+        with open(self.csv_path, 'w') as csv_file:
+            csv_file.writelines(','.join(row) + '\r\n' for row in self.rows)
+        epa.clean.write_columnar_records(
+            self.rows, self.csv_path.replace('.csv', '.bin'))
+        self.out_path = os.path.join(
+            'partitions', 'monthly_ozone_1990-2015_partition.csv')
+
+    def tearDown(self):
+        """ Remove the temp dir. """
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp_dir)
+
+    def test_aligned(self):
+        """ Test that both partitions are shuffled in the same order. """
+        random.seed(0)
+        partition.write_records(self.csv_path)
+        with open(self.out_path, 'r') as csv_file:
+            csv_columns = point.parse_point_records(csv_file)
+        bin_columns = point.load_point_columns(
+            self.out_path.replace('.csv', '.bin'))
+        self.assertEqual(csv_columns, bin_columns)
+
+        # The records are all there, in a new order.
+        longitudes = list(bin_columns['longitude'])
+        self.assertNotEqual(longitudes, sorted(longitudes))
+        self.assertEqual(sorted(longitudes), range(1, 41))
+
+    def test_mismatched(self):
+        """ Test that a columnar file of other records is refused. """
+        epa.clean.write_columnar_records(
+            self.rows[1:], self.csv_path.replace('.csv', '.bin'))
+        self.assertRaises(IOError, partition.write_records, self.csv_path)
+        self.assertFalse(os.path.exists(self.out_path))
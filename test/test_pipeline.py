@@ -0,0 +1,152 @@
+"""
+Test the epa/pipeline.py module.
+
+This module provides unit tests that ensure that the download and cleaning
+stages of the pipeline work together.  A local HTTP server stands in for
+the EPA site.
+"""
+
+
+import os.path
+import threading
+import time
+import unittest
+
+import epa.clean
+import epa.download
+import epa.pipeline
+
+from test.helpers import (ArchiveServerMixin, DataRootMixin, make_archive,
+                          raw_ozone_record)
+
+
+class PipelineTestCase(ArchiveServerMixin, DataRootMixin,
+                       unittest.TestCase):
+    """ Test that epa.pipeline.run_pipeline() performs correctly. """
+
+    def setUp(self):
+        """ Start a local HTTP server and point epa.clean at a temp dir. """
+        self.start_server()
+        self.add_archive(1995, 2)
+        self.add_archive(1996, 1)
+        self.patch_data_roots()
+        self.specs = [('ozone', 1995), ('ozone', 1996)]
+
+    def tearDown(self):
+        """ Stop the server and restore the data directory roots. """
+        self.stop_server()
+        self.restore_data_roots()
+
+    def add_archive(self, year, days):
+        """ Serve an ozone archive for year with a record for each day. """
+        name = 'daily_44201_' + str(year) + '.zip'
+        payload = 'header\n' + ''.join(
+            raw_ozone_record(str(year) + '-01-0' + str(day))
+            for day in range(1, days + 1))
+        self.server.files[name] = make_archive(
+            name.replace('.zip', '.csv'), payload)
+
+    def read_output(self):
+        """ Return the lines of the clean ozone output file. """
+        with open(epa.clean._output_path('ozone'), 'r') as infile:
+            return infile.readlines()
+
+    def test_run_pipeline(self):
+        """ Test downloading and cleaning, then re-running with no work. """
+        failures = epa.pipeline.run_pipeline(self.specs, self.base_url,
+                                             clean_workers=2)
+        self.assertEqual(failures, [])
+        self.assertEqual(self.read_output(), ['-86.8,33.5,61,0.04,0.03\r\n',
+                                              '-86.8,33.5,73,0.04,0.03\r\n'])
+        manifest = epa.clean.load_manifest()
+        self.assertEqual(sorted(manifest.keys()), ['ozone/1995',
+                                                   'ozone/1996'])
+        for spec in self.specs:
+            self.assertFalse(epa.clean.is_stale(manifest, spec))
+
+        # Nothing is fetched or cleaned again.
+        del self.server.requests[:]
+        mtime = os.path.getmtime(epa.clean._shard_path('ozone', 1995))
+        failures = epa.pipeline.run_pipeline(self.specs, self.base_url)
+        self.assertEqual(failures, [])
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(
+            os.path.getmtime(epa.clean._shard_path('ozone', 1995)), mtime)
+        self.assertEqual(len(self.read_output()), 2)
+
+    def test_failed_download(self):
+        """ Test that a failed download leaves the outputs alone. """
+        del self.server.files['daily_44201_1996.zip']
+        failures = epa.pipeline.run_pipeline(self.specs, self.base_url,
+                                             clean_workers=1)
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0][0], ('ozone', 1996))
+        self.assertEqual(failures[0][1].code, 404)
+        self.assertFalse(os.path.exists(epa.clean._output_path('ozone')))
+
+        # The year that did arrive was cleaned all the same.
+        manifest = epa.clean.load_manifest()
+        self.assertEqual(manifest.keys(), ['ozone/1995'])
+
+    def test_throttled(self):
+        """ Test that downloads wait for room ahead of cleaning. """
+        saved_download_spec = epa.download._download_spec
+        saved_record = epa.clean.record_clean_data_file
+        counts = {'started': 0, 'cleaned': 0, 'ahead': 0}
+        lock = threading.Lock()
+
+        def download_spec(args):
+            """ Count the downloads that are ahead of cleaning. """
+            with lock:
+                counts['started'] += 1
+                counts['ahead'] = max(counts['ahead'],
+                                      counts['started'] - counts['cleaned'])
+            return saved_download_spec(args)
+
+        def record_clean_data_file(manifest, spec, entry):
+            """ Count the cleaned files. """
+            with lock:
+                counts['cleaned'] += 1
+            saved_record(manifest, spec, entry)
+        epa.download._download_spec = download_spec
+        epa.clean.record_clean_data_file = record_clean_data_file
+        try:
+            specs = [('ozone', year) for year in range(1990, 2000)]
+            for year in range(1990, 2000):
+                self.add_archive(year, 1)
+            failures = epa.pipeline.run_pipeline(specs, self.base_url,
+                                                 download_workers=1,
+                                                 clean_workers=1,
+                                                 queue_size=1)
+        finally:
+            epa.download._download_spec = saved_download_spec
+            epa.clean.record_clean_data_file = saved_record
+        self.assertEqual(failures, [])
+        self.assertEqual(counts['cleaned'], len(specs))
+        self.assertTrue(counts['ahead'] <= 2)
+        self.assertEqual(len(self.read_output()), len(specs))
+
+    def test_interrupted(self):
+        """ Test that an error in the main loop stops the downloads. """
+        threads = threading.active_count()
+        saved_is_stale = epa.clean.is_stale
+
+        def is_stale(manifest, spec):
+            """ Fail on the first archive that is downloaded. """
+            raise RuntimeError('interrupted')
+        epa.clean.is_stale = is_stale
+        try:
+            specs = [('ozone', year) for year in range(1990, 2016)]
+            self.assertRaises(RuntimeError, epa.pipeline.run_pipeline, specs,
+                              self.base_url, download_workers=1,
+                              clean_workers=1, queue_size=1)
+        finally:
+            epa.clean.is_stale = saved_is_stale
+
+        # The download threads wind down instead of fetching every archive.
+        for _ in range(50):
+            if threading.active_count() <= threads:
+                break
+            time.sleep(0.1)
+        self.assertEqual(threading.active_count(), threads)
+        self.assertTrue(len(self.server.requests) < len(specs))
@@ -0,0 +1,264 @@
+"""
+Test the spark_job/point.py module.
+
+This module provides unit tests that ensure that points, point sets and
+the inverse distance weighting functions perform correctly.
+"""
+
+
+import array
+import cPickle
+import math
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'spark_job'))
+
+import epa.clean
+import point
+
+
+def make_point(longitude, latitude, month, maximum, mean):
+    """ Return a Point with the given fields. """
+    return point.Point(longitude=longitude, latitude=latitude, month=month,
+                       maximum=maximum, mean=mean)
+
+
+class StubRDD(object):
+    """ A stand-in for an RDD that is held as a list of partitions. """
+
+    def __init__(self, partitions):
+        """ Hold the given list of partitions. """
+        self.partitions = partitions
+
+    def mapPartitions(self, f):
+        """ Return a StubRDD of f applied to each partition. """
+        return StubRDD([list(f(iter(records)))
+                        for records in self.partitions])
+
+
+class PointTestCase(unittest.TestCase):
+    """ Test that point.Point performs correctly. """
+
+    def test_point(self):
+        """ Test the fields, location and value of a Point. """
+        p = make_point('-86.8', '33.5', '61', '0.04', '0.03')
+        self.assertEqual(p.location(), (-86.8, 33.5, None))
+        self.assertTrue(p.scale_time(0.5) is p)
+        self.assertEqual(p.location(), (-86.8, 33.5, 30.5))
+        self.assertEqual(p.value(), 0.04)
+        self.assertEqual(p.value('mean'), 0.03)
+        self.assertEqual(p.distance((-86.8, 33.5, 34.5)), 4.0)
+
+    def test_slots(self):
+        """ Test that a Point holds its fields in slots. """
+        p = make_point(1, 2, 3, 4, 5)
+        self.assertFalse(hasattr(p, '__dict__'))
+        self.assertRaises(AttributeError, setattr, p, 'pm25', 4.0)
+        copy = cPickle.loads(cPickle.dumps(p.scale_time(2.0), 2))
+        self.assertEqual((copy.location(), copy.max, copy.mean),
+                         ((1.0, 2.0, 6.0), 4.0, 5.0))
+
+
+class PointSetTestCase(unittest.TestCase):
+    """ Test that point.PointSet and point.PointView perform correctly. """
+
+    def setUp(self):
+        """ Build a PointSet of three points. """
+        self.points = [make_point(1, 2, 3, 4, 5), make_point(6, 7, 8, 9, 10),
+                       make_point(11, 12, 13, 14, 15)]
+        self.point_set = point.PointSet.from_points(self.points)
+
+    def test_columns(self):
+        """ Test that the columns hold the fields of the points. """
+        self.assertEqual(len(self.point_set), 3)
+        columns = self.point_set.columns()
+        self.assertEqual(sorted(columns), sorted(point.COLUMNAR_FIELDS))
+        self.assertEqual(list(columns['month']), [3.0, 8.0, 13.0])
+        self.assertEqual(list(columns['mean']), [5.0, 10.0, 15.0])
+
+    def test_views(self):
+        """ Test that each PointView behaves as its Point. """
+        self.point_set.scale_time(0.5)
+        for p, view in zip(self.points, self.point_set):
+            p.scale_time(0.5)
+            self.assertEqual(view.location(), p.location())
+            self.assertEqual((view.longitude, view.latitude, view.month,
+                              view.max, view.mean, view.scaled_time,
+                              view.time_scale),
+                             (p.longitude, p.latitude, p.month, p.max,
+                              p.mean, p.scaled_time, p.time_scale))
+            self.assertEqual(view.value('mean'), p.value('mean'))
+            self.assertEqual(str(view), str(p))
+        self.assertEqual(self.point_set[-1].location(), (11.0, 12.0, 6.5))
+        self.assertRaises(IndexError, self.point_set.__getitem__, 3)
+
+    def test_view_slots(self):
+        """ Test that a PointView holds nothing but its set and index. """
+        view = self.point_set[1]
+        self.assertFalse(hasattr(view, '__dict__'))
+        self.assertRaises(AttributeError, setattr, view, 'foo', 1)
+        self.assertRaises(AttributeError, setattr, view, 'max', 1.0)
+
+    def test_scale_time(self):
+        """ Test that scaling a PointSet scales each of its PointViews. """
+        view = self.point_set[1]
+        self.assertFalse(hasattr(view, 'scale_time'))
+        self.assertEqual(self.point_set.location(0), (1.0, 2.0, None))
+        self.assertTrue(self.point_set.scale_time(2.0) is self.point_set)
+        self.assertEqual((view.time_scale, view.scaled_time), (2.0, 16.0))
+        self.assertEqual(list(self.point_set.scaled_time()),
+                         [6.0, 16.0, 26.0])
+
+        # A new scale replaces the cached column.
+        self.point_set.scale_time(1.0)
+        self.assertEqual(self.point_set.location(2), (11.0, 12.0, 13.0))
+
+    def test_scaled(self):
+        """ Test that scaled() shares the columns and leaves the set alone. """
+        scaled = self.point_set.scaled(0.5)
+        self.assertEqual(self.point_set.time_scale, None)
+        self.assertEqual(scaled.time_scale, 0.5)
+        self.assertTrue(scaled.month is self.point_set.month)
+        self.assertEqual(scaled.location(1), (6.0, 7.0, 4.0))
+        self.assertEqual(self.point_set.location(1), (6.0, 7.0, None))
+
+    def test_take(self):
+        """ Test taking points by index, with repeats. """
+        taken = self.point_set.scale_time(2.0).take([2, 0, 2])
+        self.assertEqual(len(taken), 3)
+        self.assertEqual(taken.time_scale, 2.0)
+        self.assertEqual([p.location() for p in taken],
+                         [(11.0, 12.0, 26.0), (1.0, 2.0, 6.0),
+                          (11.0, 12.0, 26.0)])
+
+    def test_pickle(self):
+        """ Test that the scaled time column is left out of pickles. """
+        self.point_set.scale_time(2.0).scaled_time()
+        state = self.point_set.__getstate__()
+        self.assertEqual(state['_scaled_time'], None)
+        copy = cPickle.loads(cPickle.dumps(self.point_set, 2))
+        self.assertEqual(copy.location(1), (6.0, 7.0, 16.0))
+
+    def test_parse_point_records(self):
+        """ Test parsing CSV records into columns and PointSets. """
+        lines = ['1,2,3,4,5\r\n', '\r\n', '6,7,8,9,10\r\n']
+        columns = point.parse_point_records(lines)
+        self.assertEqual(list(columns['latitude']), [2.0, 7.0])
+        self.assertEqual([str(p) for p in point.points_from_columns(columns)],
+                         [str(p) for p in self.points[:2]])
+        empty = point.parse_point_records([])
+        self.assertEqual(len(point.PointSet(empty)), 0)
+
+    def test_parse_bad_records(self):
+        """ Test that records of the wrong width are refused. """
+        for line in ('1,2,3,4\r\n', '1,2,3,4,5,6\r\n'):
+            self.assertRaises(ValueError, point.parse_point_records,
+                              ['1,2,3,4,5\r\n', line])
+
+    def test_load_point_rdd(self):
+        """ Test loading an RDD of Points or of one PointSet a partition. """
+        rdd = StubRDD([['1,2,3,4,5', '6,7,8,9,10'], [], ['11,12,13,14,15']])
+        loaded = point.load_point_rdd(rdd)
+        self.assertEqual([[str(p) for p in records]
+                          for records in loaded.partitions],
+                         [[str(p) for p in self.points[:2]], [],
+                          [str(self.points[2])]])
+        loaded = point.load_point_rdd(rdd, arrays=True)
+        self.assertEqual([len(records) for records in loaded.partitions],
+                         [1, 1, 1])
+        self.assertEqual([[str(p) for p in point_set]
+                          for point_set, in loaded.partitions],
+                         [[str(p) for p in self.points[:2]], [],
+                          [str(self.points[2])]])
+
+
+class InverseDistanceWeightingTestCase(unittest.TestCase):
+    """ Test the inverse distance weighting functions of point. """
+
+    def test_inverse_distance_weights(self):
+        """ Test the weights of neighbors at a range of distances. """
+        weights = point.inverse_distance_weights([1.0, 2.0], 1.0)
+        self.assertAlmostEqual(weights[0], 2.0 / 3.0)
+        self.assertAlmostEqual(weights[1], 1.0 / 3.0)
+
+        # Neighbors at distance zero share all of the weight.
+        self.assertEqual(point.inverse_distance_weights([0.0, 1.0, 0.0], 2.0),
+                         [0.5, 0.0, 0.5])
+
+    def test_idw_estimates(self):
+        """ Test batched estimates of several targets. """
+        indices = [0, 1, 2, 0, 1, 2]
+        distances = [1.0, 2.0, 2.0, 0.0, 1.0, 3.0]
+        maxes = [1.0, 2.0, 4.0]
+        means = [10.0, 20.0, 40.0]
+        max_ests, mean_ests = point.idw_estimates(indices, distances, 2, 1.0,
+                                                  [maxes, means])
+        weights = point.inverse_distance_weights([1.0, 2.0, 2.0], 1.0)
+        self.assertAlmostEqual(max_ests[0],
+                               sum(w * m for w, m in zip(weights, maxes)))
+        self.assertAlmostEqual(mean_ests[0], 10.0 * max_ests[0])
+        self.assertEqual((max_ests[1], mean_ests[1]), (1.0, 10.0))
+
+    def test_idw_estimates_no_neighbors(self):
+        """ Test that queries with no neighbors get NaN estimates. """
+        estimates, = point.idw_estimates([], [], 2, 1.0, [[1.0]])
+        self.assertEqual(len(estimates), 2)
+        self.assertTrue(all(math.isnan(e) for e in estimates))
+        self.assertEqual(point.idw_estimates([], [], 0, 1.0, [[1.0]]),
+                         [array.array('d')])
+
+
+class ColumnarFileTestCase(unittest.TestCase):
+    """
+    Test that the binary columnar files written by epa.clean are read back
+    by point, and that both sides write the same layout.
+    """
+
+    ROWS = [['-86.8', '33.5', '61', '0.04', '0.03'],
+            ['-86.8', '33.5', '73', '0.05', '0.02'],
+            ['-112.1', '33.4', '62', '0.06', '0.01']]
+
+    def setUp(self):
+        """ Make a directory for the columnar files. """
+        self.tmp_dir = tempfile.mkdtemp()
+        self.clean_path = os.path.join(self.tmp_dir, 'clean.bin')
+        epa.clean.write_columnar_records(self.ROWS, self.clean_path)
+
+    def tearDown(self):
+        """ Remove the columnar files. """
+        shutil.rmtree(self.tmp_dir)
+
+    def test_fields(self):
+        """ Test that both sides lay out the same fields in one order. """
+        self.assertEqual(point.COLUMNAR_MAGIC, epa.clean.COLUMNAR_MAGIC)
+        self.assertEqual(
+            [field.replace('maximum', 'max')
+             for field in point.COLUMNAR_FIELDS],
+            epa.clean.COLUMNAR_FIELDS)
+
+    def test_round_trip(self):
+        """ Test reading a file written by epa.clean. """
+        columns = point.load_point_columns(self.clean_path)
+        for field, values in zip(point.COLUMNAR_FIELDS, zip(*self.ROWS)):
+            self.assertEqual(list(columns[field]),
+                             [float(value) for value in values])
+        self.assertEqual(
+            [str(p) for p in point.load_point_binary(self.clean_path)],
+            [str(make_point(*row)) for row in self.ROWS])
+        self.assertEqual(
+            [p.mean for p in point.load_point_set(self.clean_path)],
+            [0.03, 0.02, 0.01])
+
+    def test_same_layout(self):
+        """ Test that point writes the bytes that epa.clean writes. """
+        path = os.path.join(self.tmp_dir, 'point.bin')
+        point.write_point_columns(point.load_point_columns(self.clean_path),
+                                  path)
+        with open(self.clean_path, 'rb') as clean_file:
+            with open(path, 'rb') as point_file:
+                self.assertEqual(point_file.read(), clean_file.read())